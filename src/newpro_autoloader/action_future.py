@@ -0,0 +1,57 @@
+"""Futures for long-running actions, with progress reported by the status polls"""
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, List, NamedTuple, Optional
+
+from newpro_autoloader.status_snapshot import StatusSnapshot
+
+class ActionProgress(NamedTuple):
+    """Progress of an action as of one status poll"""
+    current_action: str
+    percent_extended: float
+    closest_slot: int
+    timestamp: float
+
+ProgressCallback = Callable[[ActionProgress], None]
+
+class ActionFuture(Future):
+    """Future of a long-running command, which resolves when the device responds.
+    Until then, each status poll updates its progress.  Progress is only reported
+    while the status is polled, that is while the loader context is entered."""
+
+    def __init__(self):
+        super().__init__()
+        self._progress_lock = Lock()
+        self._progress: Optional[ActionProgress] = None
+        self._progress_callbacks: List[ProgressCallback] = []
+
+    @property
+    def progress(self) -> Optional[ActionProgress]:
+        """Progress from the latest status poll, if any"""
+        return self._progress
+
+    def add_progress_callback(self, callback: ProgressCallback):
+        """Call back with the progress after each status poll while the action runs.
+        Callbacks run on the status update thread."""
+        with self._progress_lock:
+            self._progress_callbacks.append(callback)
+
+    def update_progress(self, snapshot: StatusSnapshot):
+        """Report the progress shown by a status snapshot"""
+        if self.done():
+            return
+
+        progress = ActionProgress(
+            snapshot.current_action,
+            snapshot.main.percent_extended,
+            snapshot.main.closest_slot,
+            snapshot.timestamp,
+        )
+        self._progress = progress
+        with self._progress_lock:
+            callbacks = list(self._progress_callbacks)
+        for callback in callbacks:
+            try:
+                callback(progress)
+            except Exception as ex:   # pylint: disable=broad-exception-caught
+                print(ex)
@@ -0,0 +1,356 @@
+"""Native asyncio interface to the autoloader, built on asyncio streams"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from newpro_autoloader.connection import DEFAULT_TIMEOUT
+from newpro_autoloader.device_error import DeviceError, DeviceException
+from newpro_autoloader.loader import (
+    Axis,
+    BaseLoader,
+    EVAC_TIMEOUT,
+    HOME_TIMEOUT,
+    LOAD_TIMEOUT,
+    PORT_NUMBER,
+    PORT_NUMBER_STATUS,
+)
+from newpro_autoloader.loader_connection import (
+    CommandEncoder,
+    LoaderCommand,
+    RECEIVE_BLOCK_NUMBER_INDEX,
+    RECEIVE_BLOCK_SIZE,
+    RECEIVE_DATA_START_INDEX,
+    RECEIVE_START_SYMBOL1_INDEX,
+    RECEIVE_START_SYMBOL2_INDEX,
+    START_SYMBOL1,
+    START_SYMBOL2,
+    next_message_id,
+    parse_response,
+)
+from newpro_autoloader.poll_scheduler import FAST_POLL_INTERVAL, IDLE_POLL_INTERVAL
+
+# Checksum and end symbols follow the message body
+FRAME_TRAILER_LENGTH = 4
+
+_logger = logging.getLogger(__name__)
+
+class AsyncLoaderConnection:  # pylint: disable=too-many-instance-attributes
+    """Asyncio counterpart of LoaderConnection.  Frames are read using the length
+    field of the header, so a single event loop can serve any number of connections."""
+
+    def __init__(self, address: List[str], port: int):
+        """Create a loader connection.  Does not try to connect until
+        a command is sent."""
+
+        self._address = address
+        self._port = port
+
+        self._address_active: Optional[str] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        # Created on first use so that it belongs to the running event loop
+        self._lock: Optional[asyncio.Lock] = None
+
+        self._device_address: int = 1
+        self._host_address: int = 0
+        # Frames are reused, but a command is answered before the next one is encoded
+        self._encoder = CommandEncoder(self._device_address, self._host_address)
+        self._message_id: int = 0
+        self._stale_responses: int = 0
+        # Responses to priority commands, handed over by whichever command reads them
+        self._waiters: Dict[int, "asyncio.Future[bytearray]"] = {}
+
+    @property
+    def address_active(self) -> Optional[str]:
+        """Address of the active connection, if any"""
+        return self._address_active
+
+    @property
+    def stale_responses(self) -> int:
+        """Number of responses discarded because their message ID did not match"""
+        return self._stale_responses
+
+    async def command(self,
+                      cmd_type: LoaderCommand,
+                      msg: Optional[bytearray] = None,
+                      timeout: float = DEFAULT_TIMEOUT,
+    ) -> bytearray:
+        """Send a command and receive the response"""
+
+        async with self._command_lock():
+            message_id = self._next_message_id()
+            cmd = self._encoder.encode(cmd_type, msg, message_id)
+
+            if self._writer is None:
+                await self._connect(timeout)
+
+            async with self._closing_on_error():
+                self._writer.write(cmd)
+                await self._writer.drain()
+                resp = await asyncio.wait_for(self._read_response(message_id), timeout)
+
+        return parse_response(resp, cmd_type)
+
+    async def priority_command(self,
+                               cmd_type: LoaderCommand,
+                               msg: Optional[bytearray] = None,
+                               timeout: float = DEFAULT_TIMEOUT,
+    ) -> bytearray:
+        """Send a command ahead of one waiting for its response, such as STOP.  It is
+        written right away, and the command holding the connection hands over its
+        response if that arrives first."""
+        if self._writer is None:
+            return await self.command(cmd_type, msg, timeout)
+
+        message_id = self._next_message_id()
+        response: "asyncio.Future[bytearray]" = asyncio.get_running_loop().create_future()
+        self._waiters[message_id] = response
+        try:
+            async with self._closing_on_error():
+                # Written whole before anything else runs, so it cannot split another frame
+                self._writer.write(self._encoder.encode(cmd_type, msg, message_id))
+                resp = await asyncio.wait_for(
+                    self._priority_response(message_id, response), timeout)
+        finally:
+            self._waiters.pop(message_id, None)
+
+        return parse_response(resp, cmd_type)
+
+    async def connect(self, timeout: float = DEFAULT_TIMEOUT):
+        """Open the connection now rather than with the first command"""
+        async with self._command_lock():
+            if self._writer is None:
+                await self._connect(timeout)
+
+    async def close(self):
+        """Close the connection, if open"""
+        writer = self._writer
+        self._reader = None
+        self._writer = None
+        self._address_active = None
+
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _priority_response(self,
+                                 message_id: int,
+                                 response: "asyncio.Future[bytearray]",
+    ) -> bytearray:
+        async with self._command_lock():
+            if response.done():
+                return response.result()
+            return await self._read_response(message_id)
+
+    @asynccontextmanager
+    async def _closing_on_error(self) -> AsyncIterator[None]:
+        """Close the connection if the exchange fails, which leaves the stream at an
+        unknown position"""
+        try:
+            yield
+        except asyncio.TimeoutError:
+            await self.close()
+            raise DeviceException(DeviceError.TIMEOUT)   # pylint: disable=raise-missing-from
+        except asyncio.CancelledError:
+            await self.close()
+            raise
+        except (OSError, asyncio.IncompleteReadError):
+            await self.close()
+            raise DeviceException(DeviceError.NETWORK_READ_FAILED)  # pylint: disable=raise-missing-from
+        except DeviceException:
+            await self.close()
+            raise
+
+    def _next_message_id(self) -> int:
+        self._message_id = next_message_id(self._message_id)
+        return self._message_id
+
+    def _command_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _read_response(self, message_id: int) -> bytearray:
+        while True:
+            frame = await self._read_frame()
+            frame_id = frame[RECEIVE_BLOCK_NUMBER_INDEX]
+            if frame_id == message_id:
+                return frame
+
+            waiter = self._waiters.pop(frame_id, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(frame)
+            else:
+                self._stale_responses += 1
+
+    async def _read_frame(self) -> bytearray:
+        header = await self._reader.readexactly(RECEIVE_DATA_START_INDEX)
+        if (header[RECEIVE_START_SYMBOL1_INDEX] != START_SYMBOL1 or
+            header[RECEIVE_START_SYMBOL2_INDEX] != START_SYMBOL2):
+            raise DeviceException(DeviceError.INVALID_START_BYTE)
+
+        body_len = int.from_bytes(header[RECEIVE_BLOCK_SIZE:RECEIVE_BLOCK_SIZE+2], "little")
+        rest = await self._reader.readexactly(body_len + FRAME_TRAILER_LENGTH)
+        return bytearray(header + rest)
+
+    async def _connect(self, timeout: float):
+        ex_saved: Optional[Exception] = None
+
+        for address in self._address:
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(address, self._port),
+                    timeout,
+                )
+                self._address_active = address
+                return
+
+            except (OSError, asyncio.TimeoutError):
+                ex_saved = DeviceException(DeviceError.CONNECTION_FAILED)
+
+        if ex_saved is not None:
+            raise ex_saved
+
+
+class AsyncLoader(BaseLoader):
+    """Asyncio counterpart of Loader.  Use as an async context manager, which performs
+    the initial handshake and keeps the status updated in a background task."""
+
+    def __init__(self,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 address: str = "autoloader",
+                 fallback_address: str = "192.168.0.9",
+                 port: int = PORT_NUMBER,
+                 status_port: int = PORT_NUMBER_STATUS,
+                 poll_interval: float = FAST_POLL_INTERVAL,
+                 idle_poll_interval: float = IDLE_POLL_INTERVAL):
+        """Create a loader interface.  No communication takes place until
+        initialize() is awaited or the context is entered."""
+        super().__init__(poll_interval, idle_poll_interval)
+
+        self._addresses = [address, fallback_address]
+        self._connection = AsyncLoaderConnection(self._addresses, port)
+        self._status_connection = AsyncLoaderConnection(self._addresses, status_port)
+        self._update_task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        await self.initialize()
+        self._update_task = asyncio.ensure_future(self._updater())
+        return self
+
+    async def __aexit__(self, *args):
+        if self._update_task is not None:
+            self._update_task.cancel()
+            try:
+                await self._update_task
+            except asyncio.CancelledError:
+                pass
+            self._update_task = None
+
+        await self._connection.close()
+        await self._status_connection.close()
+
+    async def _updater(self):
+        # The scheduler is woken from any thread, such as by an action starting
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        self._scheduler.set_wake_callback(lambda: loop.call_soon_threadsafe(wake.set))
+        try:
+            while True:
+                try:
+                    await self._get_status()
+                except Exception as ex:   # pylint: disable=broad-exception-caught
+                    # Keep polling, which reconnects once the device answers again
+                    _logger.warning("Status poll failed: %s", ex)
+
+                try:
+                    await asyncio.wait_for(wake.wait(), self._scheduler.next_delay())
+                except asyncio.TimeoutError:
+                    continue
+                wake.clear()
+                # Restart the deadline grid from the early poll
+                self._scheduler.restart()
+        finally:
+            self._scheduler.set_wake_callback(None)
+
+    async def initialize(self):
+        """Connect both links and read the device identity and the first status"""
+        await asyncio.gather(self._connection.connect(), self._status_connection.connect())
+        self._version, self._sub_version, self._number_of_slots = await self.get_version()
+        await self._get_status()
+
+    async def get_version(self) -> Tuple[int, int, int]:
+        """ Get basic info from the device
+        returns:
+            version: Main version number
+            sub_version: Sub version number
+            number_of_slots: Number of slots currently configured in the loader"""
+
+        response: bytearray = await self._connection.command(LoaderCommand.GET_VERSION)
+        return self._parse_version(response)
+
+    async def home(self, axis: Axis = Axis.ALL, vacuum_safe: bool = True):
+        """Initialize all motion axes, locating them with respect to their limit
+        switches if necessary. Both axes are also moved to the home positions."""
+        with self._scheduler.action():
+            await self._connection.command(
+                LoaderCommand.HOME,
+                bytearray([axis, vacuum_safe]),
+                HOME_TIMEOUT
+            )
+        await self._get_status()
+
+    async def stop(self):
+        """Immediately stops loader motion/action.  Sent without waiting for a status
+        poll in progress."""
+        await self._status_connection.priority_command(LoaderCommand.STOP)
+
+    async def load(self, slot_number: int):
+        """Place the sample in the provided slot into the imaging location.
+        See Loader.load."""
+        with self._scheduler.action():
+            await self._connection.command(
+                LoaderCommand.LOAD,
+                bytearray([slot_number]),
+                LOAD_TIMEOUT
+            )
+
+    async def load_cassette(self, vacuum_safe: bool = True):
+        """Bring the system to a state where the user can remove and replace the
+        sample cassette.  See Loader.load_cassette."""
+        with self._scheduler.action():
+            await self._connection.command(
+                LoaderCommand.LOAD_CASSETTE,
+                bytearray([vacuum_safe]),
+                LOAD_TIMEOUT
+            )
+        await self._get_status()
+
+    async def evac(self):
+        """Retract from the imaging position to the evac position, or return
+        to the imaging position when already in the evac position."""
+        with self._scheduler.action():
+            await self._connection.command(
+                LoaderCommand.EVAC,
+                timeout=EVAC_TIMEOUT
+            )
+
+    async def clear_last_error(self):
+        """Reset the latched last error code"""
+        await self._connection.command(LoaderCommand.CLEAR_LAST_ERROR)
+
+    async def clear(self):
+        """Indicate to the loader that the gripper and cassette are both empty.
+        See Loader.clear."""
+        await self._connection.command(
+            LoaderCommand.SET_SLOT_STATE,
+            bytearray([255,255,255,255,0,0,0,0]),
+        )
+        await self._get_status()
+
+    async def _get_status(self):
+        resp: bytearray = await self._status_connection.command(LoaderCommand.GET_STATUS)
+        self._update_status(resp)
@@ -1,7 +1,7 @@
 """Functions for parsing autoloader status at the per-axis level"""
 from enum import IntEnum
-from struct import unpack_from
-from typing import Optional
+from struct import Struct
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
 
 SIZE_OF_ACTION_NAME = 32
 
@@ -17,42 +17,110 @@ class LoaderType(IntEnum):
     ALPHA = 0
     BETA = 1
 
-class MainStatus:
+# Status layouts as (field, struct format) in the order they are transmitted.  Fields
+# named None are reserved space that is skipped.  Decoded fields must be listed in the
+# order of the constructor arguments of the status class they belong to.
+Layout = Tuple[Tuple[Optional[str], str], ...]
+
+AXIS_LAYOUTS: Dict[LoaderType, Layout] = {
+    LoaderType.ALPHA: (
+        ("position", "d"),
+        (None, "4x"),       # ElectricalCyclePosition
+        (None, "4x"),       # LatchedEncoderPosition
+        (None, "4x"),       # PhaseSyncError
+        (None, "2x"),       # StatorAngle
+        (None, "2x"),       # RotorAngle
+        (None, "2x"),       # StatorFrequency
+        (None, "2x"),       # RotorFrequency
+        (None, "4x"),       # CommutationCounts
+        (None, "4x"),       # CapturedElectricalCyclePosition
+        (None, "4x"),       # PhaseSyncAdjustment
+        (None, "4x"),       # StepCyclePosition
+        (None, "4x"),       # PositionCapture
+        ("overall_status", "H"),
+        (None, "50x"),
+    ),
+    LoaderType.BETA: (
+        ("position", "d"),
+        ("overall_status", "H"),
+        ("drive_status", "I"),
+        ("step_count_status", "I"),
+        ("actual_current_status", "I"),
+        ("motion_status", "I"),
+        ("motor_position", "I"),
+        ("encoder_position", "I"),
+        ("motor_velocity", "I"),
+        ("pwm_status", "I"),
+        ("general_status", "I"),
+    ),
+}
+
+MAIN_LAYOUT: Layout = (
+    ("slot_known", "I"),
+    ("slot_state", "I"),
+    ("closest_slot", "i"),
+    ("percent_extended", "d"),
+    ("current_action", f"{SIZE_OF_ACTION_NAME}s"),
+    ("last_error", "I"),
+    ("gripped_from_slot", "i"),
+)
+
+def _layout_format(layout: Layout) -> str:
+    return "".join(fmt for _, fmt in layout)
+
+def _layout_fields(layout: Layout, constructor_fields: Sequence[str]) -> Tuple[str, ...]:
+    fields = tuple(name for name, _ in layout if name is not None)
+    if fields != tuple(constructor_fields[:len(fields)]):
+        raise ValueError(f"Layout fields {fields} must follow the order {constructor_fields}")
+    return fields
+
+def _layout_defaults(layout: Layout) -> Tuple[Any, ...]:
+    return tuple(b"" if fmt.endswith("s") else 0 for name, fmt in layout if name is not None)
+
+class MainStatus:   # pylint: disable=too-many-instance-attributes
     """Status object related to the autoloader overall"""
 
-    def __init__(self):
-        self._slot_known: int = 0
-        self._slot_state: int = 0
-        self._closest_slot: int = 0
-        self._percent_extended: float = 0
-        self._current_action: str = ""
-        self._last_error: int = 0
-        self._gripped_from_slot: int = 0
+    FIELDS = tuple(name for name, _ in MAIN_LAYOUT)
+    __slots__ = tuple("_" + name for name in FIELDS)
+
+    def __init__(self,   # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 slot_known: int = 0,
+                 slot_state: int = 0,
+                 closest_slot: int = 0,
+                 percent_extended: float = 0,
+                 current_action: bytes = b"",
+                 last_error: int = 0,
+                 gripped_from_slot: int = 0):
+        self._slot_known: int = slot_known
+        self._slot_state: int = slot_state
+        self._closest_slot: int = closest_slot
+        self._percent_extended: float = percent_extended
+        self._current_action: bytes = current_action
+        self._last_error: int = last_error
+        self._gripped_from_slot: int = gripped_from_slot
 
     def unpack(self, data: bytearray, start_idx: int) -> int:
         """Initialize fields based on the incoming byte stream status"""
-        self._slot_known, = unpack_from("I", data, start_idx)
-        start_idx += 4
+        values = _MAIN_STRUCT.unpack_from(data, start_idx)
+        for name, value in zip(self.FIELDS, values):
+            setattr(self, "_" + name, value)
 
-        self._slot_state, = unpack_from("I", data, start_idx)
-        start_idx += 4
+        return start_idx + _MAIN_STRUCT.size
 
-        self._closest_slot, = unpack_from("i", data, start_idx)
-        start_idx += 4
-
-        self._percent_extended, = unpack_from("d", data, start_idx)
-        start_idx += 8
-
-        self._current_action, = unpack_from(f"{SIZE_OF_ACTION_NAME}s", data, start_idx)
-        start_idx += SIZE_OF_ACTION_NAME
-
-        self._last_error, = unpack_from("I", data, start_idx)
-        start_idx += 4
+    @property
+    def closest_slot(self) -> int:
+        """Slot number nearest to the current elevator position"""
+        return self._closest_slot
 
-        self._gripped_from_slot, = unpack_from("i", data, start_idx)
-        start_idx += 4
+    @property
+    def percent_extended(self) -> float:
+        """Extension of the loader axis toward the imaging position"""
+        return self._percent_extended
 
-        return start_idx
+    @property
+    def current_action(self) -> str:
+        """Name of the action in progress, empty when idle"""
+        return self._current_action.split(b"\0", 1)[0].decode(errors="replace")
 
     @property
     def gripped_from_slot(self):
@@ -78,90 +146,154 @@ class MainStatus:
 class AxisStatus:  # pylint: disable=too-many-instance-attributes
     """Status object related to one or the other autoloader axes (elevator or loader)"""
 
-    def __init__(self):
-        self._position: float = 0.0
-        self._overall_status: Optional[OverallSystemStatus] = None
-
-        self._overall_status: int = 0
-        self._drive_status: int = 0
-        self._step_count_status: int = 0
-        self._actual_current_status: int = 0
-        self._motion_status: int = 0
-        self._motor_position: int = 0
-        self._encoder_position: int = 0
-        self._motor_velocity: int = 0
-        self._pwm_status: int = 0
-        self._general_status: int = 0
+    FIELDS = tuple(name for name, _ in AXIS_LAYOUTS[LoaderType.BETA] if name is not None)
+    __slots__ = tuple("_" + name for name in FIELDS)
+
+    def __init__(self,   # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 position: float = 0.0,
+                 overall_status: int = 0,
+                 drive_status: int = 0,
+                 step_count_status: int = 0,
+                 actual_current_status: int = 0,
+                 motion_status: int = 0,
+                 motor_position: int = 0,
+                 encoder_position: int = 0,
+                 motor_velocity: int = 0,
+                 pwm_status: int = 0,
+                 general_status: int = 0):
+        self._position: float = position
+        self._overall_status: int = overall_status
+        self._drive_status: int = drive_status
+        self._step_count_status: int = step_count_status
+        self._actual_current_status: int = actual_current_status
+        self._motion_status: int = motion_status
+        self._motor_position: int = motor_position
+        self._encoder_position: int = encoder_position
+        self._motor_velocity: int = motor_velocity
+        self._pwm_status: int = pwm_status
+        self._general_status: int = general_status
 
     def unpack(self, data: bytearray, start_idx: int, loader_type: LoaderType) -> int:
         """Initialize fields based on the incoming byte stream status"""
-        self._position, = unpack_from("d", data, start_idx)
-        start_idx += 8
-
-        if loader_type == LoaderType.BETA:
-            self._overall_status, = unpack_from("H", data, start_idx)
-            start_idx += 2
-
-            self._drive_status, = unpack_from("I", data, start_idx)
-            start_idx += 4
-
-            self._step_count_status, = unpack_from("I", data, start_idx)
-            start_idx += 4
-
-            self._actual_current_status, = unpack_from("I", data, start_idx)
-            start_idx += 4
-
-            self._motion_status, = unpack_from("I", data, start_idx)
-            start_idx += 4
-
-            self._motor_position, = unpack_from("I", data, start_idx)
-            start_idx += 4
-
-            self._encoder_position, = unpack_from("I", data, start_idx)
-            start_idx += 4
-
-            self._motor_velocity, = unpack_from("I", data, start_idx)
-            start_idx += 4
-
-            self._pwm_status, = unpack_from("I", data, start_idx)
-            start_idx += 4
-
-            self._general_status, = unpack_from("I", data, start_idx)
-            start_idx += 4
-        else:
-            # ElectricalCyclePosition
-            start_idx += 4
-            # LatchedEncoderPosition
-            start_idx += 4
-            # PhaseSyncError
-            start_idx += 4
-            # StatorAngle
-            start_idx += 2
-            # RotorAngle
-            start_idx += 2
-            # StatorFrequency
-            start_idx += 2
-            # RotorFrequency
-            start_idx += 2
-            # CommutationCounts
-            start_idx += 4
-            # CapturedElectricalCyclePosition
-            start_idx += 4
-            # PhaseSyncAdjustment
-            start_idx += 4
-            # StepCyclePosition
-            start_idx += 4
-            # PositionCapture
-            start_idx += 4
-
-            self._overall_status, = unpack_from("H", data, start_idx)
-            start_idx += 2
-
-            start_idx += 50
-
-        return start_idx
+        axis_struct, fields = _AXIS_STRUCTS[loader_type]
+        values = axis_struct.unpack_from(data, start_idx)
+        for name, value in zip(fields, values):
+            setattr(self, "_" + name, value)
+
+        return start_idx + axis_struct.size
 
     @property
     def status(self):
         """Axis status"""
         return self._overall_status
+
+    @property
+    def position(self) -> float:
+        """Axis position"""
+        return self._position
+
+    @property
+    def actual_current_status(self) -> int:
+        """Motor current reported by the drive (BETA only)"""
+        return self._actual_current_status
+
+    @property
+    def motor_position(self) -> int:
+        """Commanded motor position in counts (BETA only)"""
+        return self._motor_position
+
+    @property
+    def encoder_position(self) -> int:
+        """Measured encoder position in counts (BETA only)"""
+        return self._encoder_position
+
+    @property
+    def motor_velocity(self) -> int:
+        """Motor velocity reported by the drive (BETA only)"""
+        return self._motor_velocity
+
+
+class StatusCodec:
+    """The complete GetStatus data of one loader type, both axes followed by the main
+    status, compiled into a single struct so that it is decoded in one call"""
+
+    def __init__(self, loader_type: LoaderType):
+        axis_layout = AXIS_LAYOUTS[loader_type]
+        self._loader_type = loader_type
+        self._axis_fields = _layout_fields(axis_layout, AxisStatus.FIELDS)
+        self._main_fields = _layout_fields(MAIN_LAYOUT, MainStatus.FIELDS)
+        self._axis_defaults = _layout_defaults(axis_layout)
+        self._main_defaults = _layout_defaults(MAIN_LAYOUT)
+        self._axis_count = len(self._axis_fields)
+        self._struct = Struct(
+            "<" + _layout_format(axis_layout) * 2 + _layout_format(MAIN_LAYOUT)
+        )
+
+    @property
+    def loader_type(self) -> LoaderType:
+        """Loader type of the layout"""
+        return self._loader_type
+
+    @property
+    def size(self) -> int:
+        """Number of bytes of status data"""
+        return self._struct.size
+
+    def decode(self,
+               data: bytearray,
+               offset: int = 0,
+    ) -> Tuple[AxisStatus, AxisStatus, MainStatus]:
+        """Decode the elevator, loader and main status starting at offset"""
+        values = self._struct.unpack_from(data, offset)
+        count = self._axis_count
+        return (
+            AxisStatus(*values[:count]),
+            AxisStatus(*values[count:2*count]),
+            MainStatus(*values[2*count:]),
+        )
+
+    def encode(self,
+               elevator: Mapping[str, Any],
+               loader: Mapping[str, Any],
+               main: Mapping[str, Any],
+    ) -> bytes:
+        """Encode status data from field values keyed by field name.  Fields that
+        are not given are sent as zero."""
+        return self._struct.pack(*self._values(elevator, loader, main))
+
+    def encode_into(self,   # pylint: disable=too-many-arguments,too-many-positional-arguments
+                    buffer: bytearray,
+                    offset: int,
+                    elevator: Mapping[str, Any],
+                    loader: Mapping[str, Any],
+                    main: Mapping[str, Any]):
+        """Encode status data into an existing buffer at offset"""
+        self._struct.pack_into(buffer, offset, *self._values(elevator, loader, main))
+
+    def _values(self,
+                elevator: Mapping[str, Any],
+                loader: Mapping[str, Any],
+                main: Mapping[str, Any],
+    ) -> list:
+        values = []
+        for axis in (elevator, loader):
+            values.extend(axis.get(name, default)
+                          for name, default in zip(self._axis_fields, self._axis_defaults))
+        values.extend(main.get(name, default)
+                      for name, default in zip(self._main_fields, self._main_defaults))
+        return values
+
+
+_AXIS_STRUCTS: Dict[LoaderType, Tuple[Struct, Tuple[str, ...]]] = {
+    loader_type: (
+        Struct("<" + _layout_format(layout)),
+        _layout_fields(layout, AxisStatus.FIELDS),
+    )
+    for loader_type, layout in AXIS_LAYOUTS.items()
+}
+
+_MAIN_STRUCT = Struct("<" + _layout_format(MAIN_LAYOUT))
+
+STATUS_CODECS: Dict[LoaderType, StatusCodec] = {
+    loader_type: StatusCodec(loader_type) for loader_type in LoaderType
+}
@@ -0,0 +1,162 @@
+"""Loading a queue of samples one after another, with timing of each sample"""
+from collections import deque
+from time import monotonic
+from typing import Callable, Deque, Iterable, List, NamedTuple, Optional, Tuple
+
+from newpro_autoloader.action_future import ActionFuture
+from newpro_autoloader.loader import Loader, PayloadState
+
+SampleHook = Callable[[Loader, int], None]
+# Called with the slot only, as it runs while the loader moves on to the next sample
+OverlapHook = Callable[[int], None]
+
+class SampleTiming(NamedTuple):
+    """Times of one sample in seconds.  idle_before is the time from the end of the
+    previous sample's imaging until this sample's load started."""
+    slot: int
+    load_time: float
+    dwell_time: float
+    idle_before: float
+
+class CampaignReport:
+    """Outcome of a campaign run: the timing of each imaged sample and the slots
+    that were skipped"""
+
+    def __init__(self):
+        self.samples: List[SampleTiming] = []
+        self.skipped: List[Tuple[int, PayloadState]] = []
+        self.elapsed: float = 0.0
+
+    def __repr__(self) -> str:
+        return (
+            f"CampaignReport(samples={len(self.samples)}, skipped={len(self.skipped)}, "
+            f"elapsed={self.elapsed:.1f}, samples_per_hour={self.samples_per_hour:.1f})"
+        )
+
+    @property
+    def samples_per_hour(self) -> float:
+        """Imaged samples per hour of the run"""
+        if self.elapsed <= 0:
+            return 0.0
+        return len(self.samples) * 3600 / self.elapsed
+
+    @property
+    def load_time(self) -> float:
+        """Total time spent loading"""
+        return sum(sample.load_time for sample in self.samples)
+
+    @property
+    def dwell_time(self) -> float:
+        """Total time spent at the imaging position"""
+        return sum(sample.dwell_time for sample in self.samples)
+
+    @property
+    def idle_time(self) -> float:
+        """Total time between the imaging of one sample and the load of the next"""
+        return sum(sample.idle_before for sample in self.samples)
+
+class Campaign:
+    """Loads each queued slot in turn and calls at_imaging_position once the sample is
+    in place.  Slots whose payload is ABSENT or UNKNOWN are skipped.
+
+    The hooks that follow imaging are split by whether they need the loader.
+    imaging_done runs while the sample is still in place and may command the loader,
+    so the next load waits for it and its time is reported as idle time.
+    after_sample runs once the next load has started, overlapping its motion, so
+    saving or processing the data of a sample costs no loader time.  It must not
+    command the loader, and the sample it is called for is no longer in place."""
+
+    def __init__(self,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 loader: Loader,
+                 slots: Iterable[int],
+                 at_imaging_position: SampleHook,
+                 imaging_done: Optional[SampleHook] = None,
+                 after_sample: Optional[OverlapHook] = None):
+        self._loader = loader
+        self._queue: Deque[int] = deque(slots)
+        self._at_imaging_position = at_imaging_position
+        self._imaging_done = imaging_done
+        self._after_sample = after_sample
+        self._stop = False
+
+    @property
+    def pending(self) -> List[int]:
+        """Slots still queued"""
+        return list(self._queue)
+
+    def add(self, slot: int):
+        """Queue another slot, also while the campaign runs"""
+        self._queue.append(slot)
+
+    def stop(self):
+        """Stop after the sample being imaged.  Slots still queued are kept."""
+        self._stop = True
+
+    def run(self) -> CampaignReport:
+        """Load and image the queued slots until the queue is empty or stop is called.
+        Errors of a load or a hook end the run and are raised."""
+        report = CampaignReport()
+        self._stop = False
+        start = monotonic()
+        imaged_at = start
+        previous: Optional[int] = None
+
+        try:
+            while not self._stop:
+                slot = self._next_slot(report)
+                if slot is None:
+                    break
+
+                load_start = monotonic()
+                load = self._loader.load_async(slot)
+                self._finish_previous(previous, load)
+                previous = None
+                load.result()
+                loaded_at = monotonic()
+
+                self._at_imaging_position(self._loader, slot)
+                done = monotonic()
+                report.samples.append(SampleTiming(
+                    slot,
+                    loaded_at - load_start,
+                    done - loaded_at,
+                    load_start - imaged_at,
+                ))
+                imaged_at = done
+
+                if self._imaging_done is not None:
+                    self._imaging_done(self._loader, slot)
+                previous = slot
+
+            self._finish_previous(previous, None)
+
+        finally:
+            report.elapsed = monotonic() - start
+
+        return report
+
+    def _next_slot(self, report: CampaignReport) -> Optional[int]:
+        while self._queue:
+            slot = self._queue.popleft()
+            if self._loader.index_loaded == slot:
+                return slot
+
+            state = self._loader.slot_state(slot)
+            if state == PayloadState.PRESENT:
+                return slot
+            report.skipped.append((slot, state))
+
+        return None
+
+    def _finish_previous(self, slot: Optional[int], load: Optional[ActionFuture]):
+        """Run after_sample for the previous sample, while the next load runs"""
+        if slot is None or self._after_sample is None:
+            return
+
+        try:
+            self._after_sample(slot)
+        except:
+            # Do not leave the next load running unobserved
+            if load is not None:
+                load.exception()
+            raise
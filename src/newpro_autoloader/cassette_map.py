@@ -0,0 +1,149 @@
+"""Immutable view of the payload state of every cassette slot in one status frame"""
+from enum import IntEnum
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None     # pylint: disable=invalid-name
+
+class PayloadState(IntEnum):
+    """State of payload presence"""
+    ABSENT = 0
+    PRESENT = 1
+    UNKNOWN = 2
+
+class SlotChange(NamedTuple):
+    """A slot whose payload state differs between two cassette maps"""
+    slot: int
+    old: PayloadState
+    new: PayloadState
+
+class CassetteMap:
+    """Payload state of slots 1 to number_of_slots, decoded once from the slot bitfields
+    of a status frame.  Maps are never modified and compare equal when all slot states
+    match, so they can be cached, shared between threads and diffed."""
+
+    __slots__ = ("_slot_state", "_slot_known", "_number_of_slots", "_states")
+    _slot_state: int
+    _slot_known: int
+    _number_of_slots: int
+    _states: bytes
+
+    def __init__(self, slot_state: int, slot_known: int, number_of_slots: int):
+        mask = (1 << number_of_slots) - 1
+        known = slot_known & mask
+        present = slot_state & known
+        setter = object.__setattr__
+        setter(self, "_slot_state", present)
+        setter(self, "_slot_known", known)
+        setter(self, "_number_of_slots", number_of_slots)
+        setter(self, "_states", bytes(
+            (PayloadState.PRESENT if present >> idx & 1 else PayloadState.ABSENT)
+            if known >> idx & 1 else PayloadState.UNKNOWN
+            for idx in range(number_of_slots)
+        ))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CassetteMap is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("CassetteMap is immutable")
+
+    def __repr__(self) -> str:
+        return (
+            f"CassetteMap(occupied={self.occupied}, "
+            f"unknown={self.count(PayloadState.UNKNOWN)})"
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, CassetteMap):
+            return NotImplemented
+        return self.bitfields == other.bitfields
+
+    def __hash__(self) -> int:
+        return hash(self.bitfields)
+
+    def __len__(self) -> int:
+        return self._number_of_slots
+
+    def __iter__(self) -> Iterator[PayloadState]:
+        """States of slots 1 to number_of_slots, in order"""
+        return (PayloadState(state) for state in self._states)
+
+    @property
+    def bitfields(self) -> Tuple[int, int, int]:
+        """Slot state and slot known bitfields, limited to the cassette, and the number
+        of slots.  Maps with the same bitfields are equal."""
+        return self._slot_state, self._slot_known, self._number_of_slots
+
+    @property
+    def number_of_slots(self) -> int:
+        """Number of slots in the cassette"""
+        return self._number_of_slots
+
+    @property
+    def states(self) -> bytes:
+        """PayloadState value of each slot, starting with slot 1"""
+        return self._states
+
+    @property
+    def occupied(self) -> Tuple[int, ...]:
+        """Numbers of the slots known to hold a payload"""
+        return tuple(slot for slot in range(1, self._number_of_slots + 1)
+                     if self._slot_state >> (slot - 1) & 1)
+
+    def to_numpy(self) -> "np.ndarray":
+        """PayloadState value of each slot as a read-only uint8 array, starting with
+        slot 1.  Requires NumPy."""
+        if np is None:
+            raise ImportError("NumPy is required for cassette map arrays: pip install numpy")
+        return np.frombuffer(self._states, dtype=np.uint8)
+
+    def state(self, slot_number: int) -> PayloadState:
+        """Payload state of one slot, numbered from 1"""
+        if not 1 <= slot_number <= self._number_of_slots:
+            raise IndexError(f"Slot {slot_number} is not in the cassette")
+        return PayloadState(self._states[slot_number - 1])
+
+    def count(self, state: PayloadState = PayloadState.PRESENT) -> int:
+        """Number of slots in the given state"""
+        if state == PayloadState.PRESENT:
+            return bin(self._slot_state).count("1")
+        if state == PayloadState.UNKNOWN:
+            return self._number_of_slots - bin(self._slot_known).count("1")
+        return bin(self._slot_known & ~self._slot_state).count("1")
+
+    def counts(self) -> Dict[PayloadState, int]:
+        """Number of slots in each state"""
+        return {state: self.count(state) for state in PayloadState}
+
+    def next_occupied(self, after: int = 0) -> Optional[int]:
+        """Lowest occupied slot number above after, if any"""
+        remaining = self._slot_state >> max(after, 0)
+        if not remaining:
+            return None
+        return max(after, 0) + (remaining & -remaining).bit_length()
+
+    def previous_occupied(self, before: Optional[int] = None) -> Optional[int]:
+        """Highest occupied slot number below before, or overall if not given"""
+        remaining = self._slot_state
+        if before is not None:
+            remaining &= (1 << max(before - 1, 0)) - 1
+        return remaining.bit_length() or None
+
+    def diff(self, newer: "CassetteMap") -> List[SlotChange]:
+        """Slots whose state differs in the newer map, such as after load_cassette.
+        Slots present in only one of the maps are compared with UNKNOWN."""
+        if self.bitfields == newer.bitfields:
+            return []
+
+        newer_states = newer.states
+        changes: List[SlotChange] = []
+        for idx in range(max(self._number_of_slots, len(newer_states))):
+            old = self._states[idx] if idx < self._number_of_slots else PayloadState.UNKNOWN
+            new = newer_states[idx] if idx < len(newer_states) else PayloadState.UNKNOWN
+            if old != new:
+                changes.append(SlotChange(idx + 1, PayloadState(old), PayloadState(new)))
+
+        return changes
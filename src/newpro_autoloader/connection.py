@@ -1,78 +1,579 @@
 """Low-level communication functions including message framing"""
+import errno
+import itertools
+import socket as socket_module
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from select import select
-from socket import socket
-from threading import RLock
-from time import time
-from typing import List, Optional
+from socket import socket, socketpair
+from threading import Condition, Lock, RLock
+from time import monotonic, perf_counter, sleep, time
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
 
 from newpro_autoloader.device_error import DeviceError, DeviceException
+from newpro_autoloader.metrics import LinkMetrics
+from newpro_autoloader.tracing import Stage
 
 DEFAULT_TIMEOUT: float = 5.0
 SELECT_TIMEOUT: float = 0.5
 RECEIVE_COUNT: int = 2048
 
-class Connection:
+# Longest time to establish a connection to any of the addresses
+CONNECT_TIMEOUT: float = 2.0
+# Head start of an attempt before the next address is tried alongside it
+ATTEMPT_DELAY: float = 0.25
+# Seconds a resolved name is reused before it is resolved again
+RESOLVE_TTL: float = 60.0
+# Check for finished name lookups this often while connecting
+RESOLVE_POLL: float = 0.02
+
+# Seconds of silence before keepalive probes start, between probes, and probes before giving up
+KEEPALIVE_IDLE: int = 10
+KEEPALIVE_INTERVAL: int = 5
+KEEPALIVE_COUNT: int = 3
+
+# One result of getaddrinfo: family, type, protocol, canonical name and socket address
+AddressInfo = Tuple[int, int, int, str, tuple]
+
+# Receives the stages of a traced send: the stage, its start and its end
+StageCallback = Callable[[Stage, float, float], None]
+
+_resolve_lock = Lock()
+_resolved: Dict[Tuple[str, int], Tuple[float, List[AddressInfo]]] = {}
+_RESOLVER: Optional[ThreadPoolExecutor] = None
+
+def resolve(address: str, port: int) -> "Future[List[AddressInfo]]":
+    """Look up the socket addresses of a host name on a background thread, so a
+    name that does not resolve cannot hold up other addresses.  Results are cached
+    for RESOLVE_TTL seconds.
+        returns a future for the getaddrinfo results"""
+    global _RESOLVER    # pylint: disable=global-statement
+
+    future: "Future[List[AddressInfo]]" = Future()
+    with _resolve_lock:
+        cached = _resolved.get((address, port))
+        if cached is not None and cached[0] > monotonic():
+            future.set_result(cached[1])
+            return future
+        if _RESOLVER is None:
+            _RESOLVER = ThreadPoolExecutor(max_workers=4, thread_name_prefix="Resolver")
+
+    return _RESOLVER.submit(_lookup, address, port)
+
+def _lookup(address: str, port: int) -> List[AddressInfo]:
+    infos = socket_module.getaddrinfo(address, port, type=socket_module.SOCK_STREAM)
+    with _resolve_lock:
+        _resolved[(address, port)] = (monotonic() + RESOLVE_TTL, infos)
+    return infos
+
+def configure_socket(sock: socket):
+    """Send small frames right away and detect a dead peer with keepalive probes"""
+    sock.setsockopt(socket_module.IPPROTO_TCP, socket_module.TCP_NODELAY, 1)
+    sock.setsockopt(socket_module.SOL_SOCKET, socket_module.SO_KEEPALIVE, 1)
+    # Not available on every platform
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+                          ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+        if hasattr(socket_module, option):
+            sock.setsockopt(socket_module.IPPROTO_TCP, getattr(socket_module, option), value)
+
+class _ConnectRace:
+    """Connection attempts to the socket addresses of several names, started one after
+    the other and running concurrently"""
+
+    def __init__(self, addresses: List[str], port: int):
+        # Lookups of the names not yet tried, in order
+        self._lookups = [(address, resolve(address, port)) for address in addresses]
+        # Resolved socket addresses not yet tried, in order
+        self._candidates: List[Tuple[str, AddressInfo]] = []
+        self._attempts: Dict[socket, str] = {}
+        self._next_start = monotonic() + ATTEMPT_DELAY
+
+    @property
+    def exhausted(self) -> bool:
+        """True once every address has failed"""
+        return not self._attempts and not self._candidates and not self._lookups
+
+    def collect_lookups(self, now: float):
+        """Queue the socket addresses of the names resolved so far, keeping their order"""
+        for entry in list(self._lookups):
+            address, lookup = entry
+            if not lookup.done():
+                # A slow lookup only holds up the later names for its head start
+                if now < self._next_start:
+                    break
+                continue
+            self._lookups.remove(entry)
+            if lookup.exception() is None:
+                self._candidates.extend((address, info) for info in lookup.result())
+
+    def start_attempt(self, now: float) -> bool:
+        """Start connecting to the next socket address if it is due.
+            returns True if one was due"""
+        if not self._candidates or (self._attempts and now < self._next_start):
+            return False
+
+        address, (family, sock_type, proto, _, sockaddr) = self._candidates.pop(0)
+        sock = socket(family, sock_type, proto)
+        sock.setblocking(False)
+        ret = sock.connect_ex(sockaddr)
+        if ret in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._attempts[sock] = address
+            self._next_start = now + ATTEMPT_DELAY
+        else:
+            sock.close()
+        return True
+
+    def wait(self, now: float, deadline: float) -> Optional[Tuple[socket, str]]:
+        """Wait for an attempt to finish, the next one to be due or a lookup to end.
+            returns the socket and address of an attempt that connected, if any"""
+        wait = deadline - now
+        if self._candidates:
+            wait = min(wait, self._next_start - now)
+        if self._lookups:
+            wait = min(wait, RESOLVE_POLL)
+        if not self._attempts:
+            sleep(max(wait, 0.0))
+            return None
+
+        _, writable, _ = select([], list(self._attempts), [], max(wait, 0.0))
+        for sock in writable:
+            address = self._attempts.pop(sock)
+            if sock.getsockopt(socket_module.SOL_SOCKET, socket_module.SO_ERROR) == 0:
+                return sock, address
+            sock.close()
+        return None
+
+    def close(self):
+        """Abandon the attempts still running"""
+        for sock in self._attempts:
+            sock.close()
+        self._attempts.clear()
+
+def connect_any(addresses: List[str],
+                port: int,
+                timeout: float = CONNECT_TIMEOUT,
+) -> Tuple[socket, str]:
+    """Connect to the first of the addresses that answers.  Attempts start in order,
+    each ATTEMPT_DELAY after the previous one or as soon as it fails, and run
+    concurrently, so an unreachable or unresolvable address costs at most the delay.
+        returns the non-blocking, configured socket and the address it connected to"""
+    deadline = monotonic() + timeout
+    race = _ConnectRace(addresses, port)
+    try:
+        while True:
+            now = monotonic()
+            race.collect_lookups(now)
+            if race.start_attempt(now):
+                continue
+            if race.exhausted or now >= deadline:
+                break
+
+            connected = race.wait(now, deadline)
+            if connected is not None:
+                configure_socket(connected[0])
+                return connected
+
+    finally:
+        race.close()
+
+    raise DeviceException(DeviceError.CONNECTION_FAILED)
+
+class FrameParser:  # pylint: disable=too-many-instance-attributes
+    """Incremental splitter of a received byte stream into frames ending with a
+    terminator byte sequence.  Data is received into one reusable buffer, only newly
+    arrived bytes are scanned, and complete frames that arrive together are queued."""
+
+    def __init__(self, terminator: Optional[bytearray], capacity: int = 2 * RECEIVE_COUNT):
+        self._terminator = None if terminator is None else bytes(terminator)
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        # Start of the data not yet returned as a frame
+        self._start = 0
+        # End of the received data
+        self._end = 0
+        # Where the search for the end of the current frame resumes
+        self._scan = 0
+        self._frames: Deque[bytearray] = deque()
+        # Arrival of the first bytes of each queued frame, of the frame being
+        # received, and of the last receive
+        self._arrivals: Deque[float] = deque()
+        self._head_arrival: float = 0.0
+        self._received_at: float = 0.0
+        self._first_byte: float = 0.0
+
+    @property
+    def first_byte(self) -> float:
+        """perf_counter time at which the first bytes of the frame last returned by
+        next_frame arrived"""
+        return self._first_byte
+
+    def recv_into(self, sock: socket) -> int:
+        """Receive the available bytes from the socket and split off complete frames"""
+        self._reserve(RECEIVE_COUNT)
+        try:
+            count = sock.recv_into(self._view[self._end:], RECEIVE_COUNT)
+        except BlockingIOError:
+            return 0
+
+        if count == 0:
+            # Orderly shutdown by the peer
+            raise DeviceException(DeviceError.NETWORK_READ_FAILED)
+
+        self._received_at = perf_counter()
+        if self._start == self._end:
+            self._head_arrival = self._received_at
+        self._end += count
+        self._split()
+        return count
+
+    def next_frame(self) -> Optional[bytearray]:
+        """Oldest complete frame, if any"""
+        if self._frames:
+            self._first_byte = self._arrivals.popleft()
+            return self._frames.popleft()
+        return None
+
+    def clear(self):
+        """Discard buffered data and queued frames, such as after a reconnect"""
+        self._start = self._end = self._scan = 0
+        self._frames.clear()
+        self._arrivals.clear()
+
+    def _split(self):
+        if self._terminator is None:
+            self._emit(self._end)
+            return
+
+        size = len(self._terminator)
+        while True:
+            idx = self._buffer.find(self._terminator, max(self._scan, self._start), self._end)
+            if idx == -1:
+                # The terminator may be split across receives
+                self._scan = max(self._end - size + 1, self._start)
+                return
+            self._emit(idx + size)
+
+    def _emit(self, end: int):
+        self._frames.append(self._buffer[self._start:end])
+        self._arrivals.append(self._head_arrival)
+        # Frames are split off as they arrive, so the rest came with the last receive
+        self._head_arrival = self._received_at
+        self._start = self._scan = end
+
+    def _reserve(self, room: int):
+        if len(self._buffer) - self._end >= room:
+            return
+
+        pending = self._end - self._start
+        if pending + room > len(self._buffer):
+            self._view.release()
+            buffer = bytearray(max(2 * len(self._buffer), pending + room))
+            buffer[:pending] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(self._buffer)
+        else:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+
+        self._scan -= self._start
+        self._start = 0
+        self._end = pending
+
+class _Cancellation:
+    """Cancel state of a Connection.  Each send and receive takes a ticket when it
+    starts, and cancel stops those whose ticket is below the one it takes.  cancel also
+    writes to a socket pair, which every wait selects on, to interrupt it right away.
+    A hold also turns away the communications that start before its release."""
+
+    def __init__(self):
+        self._tickets = itertools.count(1)
+        self._cancelled_below: int = 0
+        self._lock = Lock()
+        self._held: int = 0
+        self._wakeup_receive, self._wakeup_send = socketpair()
+        self._wakeup_receive.setblocking(False)
+        self._wakeup_send.setblocking(False)
+
+    @property
+    def held(self) -> bool:
+        """True between hold and release"""
+        return self._held > 0
+
+    @property
+    def wakeup(self) -> socket:
+        """Readable once cancel was called, until clear"""
+        return self._wakeup_receive
+
+    def ticket(self) -> int:
+        """A ticket for a communication starting now"""
+        return next(self._tickets)
+
+    def cancel(self):
+        """Cancel the communications with a ticket from before the call"""
+        self._cancelled_below = next(self._tickets)
+        self.wake()
+
+    def wake(self):
+        """Interrupt the waits without cancelling them, so they check their state"""
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            # Already woken
+            pass
+
+    def hold(self):
+        """Cancel, and keep turning communications away until release"""
+        with self._lock:
+            self._held += 1
+        self.cancel()
+
+    def release(self):
+        """End a hold"""
+        with self._lock:
+            self._held -= 1
+
+    def check(self, ticket: int):
+        """Raise CANCELLED if the communication with ticket was cancelled"""
+        if ticket < self._cancelled_below:
+            raise DeviceException(DeviceError.CANCELLED)
+
+    def clear(self):
+        """Consume the wakeups written by cancel"""
+        try:
+            while self._wakeup_receive.recv(RECEIVE_COUNT):
+                pass
+        except BlockingIOError:
+            pass
+
+# The address list and active address, the socket and its lock, the parser, metrics,
+# cancel state and the handover of the socket with a receiving thread are all needed
+# by every send
+class Connection:   # pylint: disable=too-many-instance-attributes
     """Send and receive byte arrays with message framing based on 
-    a terminator byte sequence"""
+    a terminator byte sequence, or on the given frame parser"""
 
     def __init__(self,
                  address: List[str],
                  port: int,
-                 terminator: bytearray):
+                 terminator: bytearray,
+                 parser: Optional[FrameParser] = None,
+                 metrics: Optional[LinkMetrics] = None):
         """Create a socket connection.  Does not try to connect until
-        a message is sent."""
+        a message is sent.  Traffic is counted in metrics, if given."""
 
         self._address = address
         self._port = port
-        self._terminator = terminator
+        self._parser = parser if parser is not None else FrameParser(terminator)
+        self._metrics = metrics if metrics is not None else LinkMetrics()
 
         self._address_active: Optional[str] = None
+        # Tried first on the next connect
+        self._address_preferred: Optional[str] = None
         self._lock = RLock()
         self._socket: Optional[socket] = None
-        self._abort_send = False
+        self._cancellation = _Cancellation()
+        # A thread in receive uses the socket and parser without the lock, so only it
+        # closes them.  Other threads ask it to, and wait for it before reconnecting.
+        self._receiving = False
+        self._close_requested = False
+        self._received = Condition(self._lock)
+
+    @property
+    def metrics(self) -> LinkMetrics:
+        """Traffic counters of the connection"""
+        return self._metrics
+
+    @property
+    def first_byte(self) -> float:
+        """perf_counter time at which the first bytes of the frame last returned by
+        send or receive arrived"""
+        return self._parser.first_byte
 
     def cancel(self):
-        """Stop a communication in progress"""
-        self._abort_send = True
+        """Stop the communications in progress.  A send or receive that started before
+        the cancel raises CANCELLED right away, also if it is still waiting for the
+        connection."""
+        self._cancellation.cancel()
 
-    def send(self,
+    def send(self,  # pylint: disable=too-many-arguments,too-many-positional-arguments
              msg: bytearray,
              timeout: float = DEFAULT_TIMEOUT,
+             accept: Optional[Callable[[bytearray], bool]] = None,
+             trace: Optional[StageCallback] = None,
+             priority: bool = False,
     ) -> bytearray:
-        """Send a byte array and wait for a response"""
-        with self._lock:
+        """Send a byte array and wait for a response.  If given, frames for which
+        accept returns False are discarded and the wait continues, and trace receives
+        the time spent in each stage.  A priority send, such as STOP, cancels the
+        communications in progress and those that would take the connection before
+        it, so it is sent next."""
+        waited = perf_counter() if trace is not None else 0.0
+        sending = sent = waited
+        with self._locked(priority) as ticket:
+            if trace is not None:
+                trace(Stage.LOCK_WAIT, waited, perf_counter())
             if not self._is_connected:
                 self._connect()
 
             try:
-                self._socket.send(msg)
-                self._abort_send = False
+                if trace is not None:
+                    sending = perf_counter()
+                self._send_all(msg, ticket)
+                if trace is not None:
+                    sent = perf_counter()
+                    trace(Stage.SEND, sending, sent)
+            except:
+                self._disconnect()
+                raise
 
-                start: float = time()
-                response: bytearray = bytearray()
+            try:
+                deadline: float = time() + timeout
                 while True:
-                    if self._abort_send:
-                        raise DeviceException(DeviceError.CANCELLED)
-
-                    if time() - start > timeout:
+                    response = self._next_frame(deadline, ticket)
+                    if response is None:
                         raise DeviceException(DeviceError.TIMEOUT)
+                    if accept is None or accept(response):
+                        if trace is not None:
+                            # The response may arrive before the send is timed
+                            first_byte = max(self._parser.first_byte, sent)
+                            trace(Stage.FIRST_BYTE, sent, first_byte)
+                            trace(Stage.REASSEMBLY, first_byte, perf_counter())
+                        return response
 
-                    ready_sockets = select([self._socket], [], [], SELECT_TIMEOUT)
-                    if ready_sockets[0]:
-                        response.extend(self._socket.recv(RECEIVE_COUNT))
-                        if self._terminator is None:
-                            return response
-
-                        idx: int = response.find(self._terminator)
-                        if idx == -1:
-                            continue
+            except DeviceException as ex:
+                # accept discards the late response, so a cancelled wait can leave the
+                # connection open for the next command
+                if ex.error_code != DeviceError.CANCELLED or accept is None:
+                    self._disconnect()
+                raise
+            except:
+                self._disconnect()
+                raise
 
-                        return response[:idx + len(self._terminator)]
+    def write(self, msg: bytearray, trace: Optional[StageCallback] = None):
+        """Send a byte array without waiting for a response.  Responses are collected
+        with receive, which must not run on more than one thread, and send must not
+        be used on the same connection."""
+        waited = perf_counter() if trace is not None else 0.0
+        sending = waited
+        with self._locked() as ticket:
+            if trace is not None:
+                trace(Stage.LOCK_WAIT, waited, perf_counter())
+            if not self._is_connected:
+                self._connect()
 
+            try:
+                if trace is not None:
+                    sending = perf_counter()
+                self._send_all(msg, ticket)
+                if trace is not None:
+                    trace(Stage.SEND, sending, perf_counter())
             except:
                 self._disconnect()
                 raise
 
+    def receive(self,
+                timeout: float = DEFAULT_TIMEOUT,
+                ticket: Optional[int] = None,
+    ) -> Optional[bytearray]:
+        """Wait for the next frame following write.  The wait is cancelled by a cancel
+        after ticket, from cancellable, or else by one after the call.  A write that
+        fails meanwhile ends the wait with NETWORK_READ_FAILED.
+            returns None if no frame arrives within timeout"""
+        if ticket is None:
+            ticket = self._cancellation.ticket()
+        with self._lock:
+            if not self._is_connected:
+                self._disconnect()
+                raise DeviceException(DeviceError.NETWORK_READ_FAILED)
+            self._receiving = True
+
+        failed = True
+        try:
+            frame = self._next_frame(time() + timeout, ticket)
+            failed = False
+            return frame
+        finally:
+            with self._lock:
+                self._receiving = False
+                if failed or self._close_requested:
+                    self._disconnect()
+                self._received.notify_all()
+
+    def cancellable(self) -> int:
+        """A ticket for receive, such that a cancel from now on interrupts it"""
+        return self._cancellation.ticket()
+
+    def close(self):
+        """Close the connection, if open"""
+        self._disconnect()
+
+    @contextmanager
+    def _locked(self, priority: bool = False) -> Iterator[int]:
+        """Take a ticket and the lock, unless cancelled meanwhile.  A priority caller
+        holds off the others until it has the lock."""
+        if priority:
+            self._cancellation.hold()
+        try:
+            ticket = self._cancellation.ticket()
+            self._lock.acquire()    # pylint: disable=consider-using-with
+        finally:
+            if priority:
+                self._cancellation.release()
+        try:
+            if not priority and self._cancellation.held:
+                raise DeviceException(DeviceError.CANCELLED)
+            self._cancellation.check(ticket)
+            yield ticket
+        finally:
+            self._lock.release()
+
+    def _next_frame(self, deadline: float, ticket: int) -> Optional[bytearray]:
+        # A frame may already have arrived along with the previous response
+        response = self._parser.next_frame()
+        while response is None:
+            self._cancellation.check(ticket)
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                return None
+            if self._close_requested:
+                raise DeviceException(DeviceError.NETWORK_READ_FAILED)
+
+            wakeup = self._cancellation.wakeup
+            ready_sockets = select(
+                [self._socket, wakeup], [], [], min(remaining, SELECT_TIMEOUT))
+            if wakeup in ready_sockets[0]:
+                self._cancellation.clear()
+            if self._socket in ready_sockets[0]:
+                self._metrics.record_received(self._parser.recv_into(self._socket))
+                response = self._parser.next_frame()
+
+        return response
+
+    def _send_all(self, msg: bytearray, ticket: int):
+        # sendall for the non-blocking socket.  A frame normally goes out in one send,
+        # and only a partial send takes a view of the remainder.
+        try:
+            sent = self._socket.send(msg)
+        except BlockingIOError:
+            sent = 0
+        self._metrics.record_sent(sent)
+        if sent == len(msg):
+            return
+
+        view = memoryview(msg)[sent:]
+        while view:
+            self._cancellation.check(ticket)
+            try:
+                sent = self._socket.send(view)
+                self._metrics.record_sent(sent)
+                view = view[sent:]
+            except BlockingIOError:
+                select([self._cancellation.wakeup], [self._socket], [], SELECT_TIMEOUT)
+                self._cancellation.clear()
+
     @property
     def address_active(self) -> str:
         """Address of the active connection, if any"""
@@ -80,33 +581,31 @@ class Connection:
 
     @property
     def _is_connected(self) -> bool:
-        return self._socket is not None
+        return self._socket is not None and not self._close_requested
 
     def _connect(self):
-        ex_saved: Exception = None
-
         with self._lock:
-            for address in self._address:
-                try:
-                    self._disconnect()
-                    self._socket = socket()
-                    ret = self._socket.connect_ex((address, self._port))
-                    if ret != 0:
-                        raise DeviceException(DeviceError.CONNECTION_FAILED)
-                    self._socket.setblocking(False)
-                    self._address_active = address
-                    return
-
-                except Exception as ex:   # pylint: disable=broad-exception-caught
-                    self._socket = None
-                    self._address_active = None
-                    ex_saved = ex
-
-        if ex_saved is not None:
-            raise ex_saved
+            while self._receiving:
+                self._received.wait()
+            self._disconnect()
+            addresses = list(self._address)
+            if self._address_preferred in addresses:
+                addresses.remove(self._address_preferred)
+                addresses.insert(0, self._address_preferred)
+
+            self._socket, self._address_active = connect_any(addresses, self._port)
+            self._metrics.record_connect()
+            self._address_preferred = self._address_active
 
     def _disconnect(self):
         with self._lock:
+            if self._receiving:
+                # Closed by the receiving thread once woken
+                self._close_requested = True
+                self._cancellation.wake()
+                return
+            self._close_requested = False
+            self._parser.clear()
             if self._is_connected:
                 self._socket.close()
                 self._socket = None
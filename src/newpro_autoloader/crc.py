@@ -0,0 +1,158 @@
+"""Checksum used by the autoloader protocol (CRC-16/KERMIT: reflected CCITT polynomial,
+zero initial value).  Single messages use the C implementation in binascii, batches of
+recorded frames can be checked with NumPy."""
+from binascii import crc_hqx
+from typing import Sequence, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None     # pylint: disable=invalid-name
+
+CrcL = [0x0, 0x89, 0x12, 0x9B, 0x24, 0xAD, 0x36, 0xBF, 0x48, 0xC1,
+        0x5A, 0xD3, 0x6C, 0xE5, 0x7E, 0xF7, 0x81, 0x8, 0x93, 0x1A,
+        0xA5, 0x2C, 0xB7, 0x3E, 0xC9, 0x40, 0xDB, 0x52, 0xED, 0x64,
+        0xFF, 0x76, 0x2, 0x8B, 0x10, 0x99, 0x26, 0xAF, 0x34, 0xBD,
+        0x4A, 0xC3, 0x58, 0xD1, 0x6E, 0xE7, 0x7C, 0xF5, 0x83, 0xA,
+        0x91, 0x18, 0xA7, 0x2E, 0xB5, 0x3C, 0xCB, 0x42, 0xD9, 0x50,
+        0xEF, 0x66, 0xFD, 0x74, 0x4, 0x8D, 0x16, 0x9F, 0x20, 0xA9,
+        0x32, 0xBB, 0x4C, 0xC5, 0x5E, 0xD7, 0x68, 0xE1, 0x7A, 0xF3,
+        0x85, 0xC, 0x97, 0x1E, 0xA1, 0x28, 0xB3, 0x3A, 0xCD, 0x44,
+        0xDF, 0x56, 0xE9, 0x60, 0xFB, 0x72, 0x6, 0x8F, 0x14, 0x9D,
+        0x22, 0xAB, 0x30, 0xB9, 0x4E, 0xC7, 0x5C, 0xD5, 0x6A, 0xE3,
+        0x78, 0xF1, 0x87, 0xE, 0x95, 0x1C, 0xA3, 0x2A, 0xB1, 0x38,
+        0xCF, 0x46, 0xDD, 0x54, 0xEB, 0x62, 0xF9, 0x70, 0x8, 0x81,
+        0x1A, 0x93, 0x2C, 0xA5, 0x3E, 0xB7, 0x40, 0xC9, 0x52, 0xDB,
+        0x64, 0xED, 0x76, 0xFF, 0x89, 0x0, 0x9B, 0x12, 0xAD, 0x24,
+        0xBF, 0x36, 0xC1, 0x48, 0xD3, 0x5A, 0xE5, 0x6C, 0xF7, 0x7E,
+        0xA, 0x83, 0x18, 0x91, 0x2E, 0xA7, 0x3C, 0xB5, 0x42, 0xCB,
+        0x50, 0xD9, 0x66, 0xEF, 0x74, 0xFD, 0x8B, 0x2, 0x99, 0x10,
+        0xAF, 0x26, 0xBD, 0x34, 0xC3, 0x4A, 0xD1, 0x58, 0xE7, 0x6E,
+        0xF5, 0x7C, 0xC, 0x85, 0x1E, 0x97, 0x28, 0xA1, 0x3A, 0xB3,
+        0x44, 0xCD, 0x56, 0xDF, 0x60, 0xE9, 0x72, 0xFB, 0x8D, 0x4,
+        0x9F, 0x16, 0xA9, 0x20, 0xBB, 0x32, 0xC5, 0x4C, 0xD7, 0x5E,
+        0xE1, 0x68, 0xF3, 0x7A, 0xE, 0x87, 0x1C, 0x95, 0x2A, 0xA3,
+        0x38, 0xB1, 0x46, 0xCF, 0x54, 0xDD, 0x62, 0xEB, 0x70, 0xF9,
+        0x8F, 0x6, 0x9D, 0x14, 0xAB, 0x22, 0xB9, 0x30, 0xC7, 0x4E,
+        0xD5, 0x5C, 0xE3, 0x6A, 0xF1, 0x78]
+
+CrcH = [0x0, 0x11, 0x23, 0x32, 0x46, 0x57, 0x65, 0x74, 0x8C, 0x9D,
+        0xAF, 0xBE, 0xCA, 0xDB, 0xE9, 0xF8, 0x10, 0x1, 0x33, 0x22,
+        0x56, 0x47, 0x75, 0x64, 0x9C, 0x8D, 0xBF, 0xAE, 0xDA, 0xCB,
+        0xF9, 0xE8, 0x21, 0x30, 0x2, 0x13, 0x67, 0x76, 0x44, 0x55,
+        0xAD, 0xBC, 0x8E, 0x9F, 0xEB, 0xFA, 0xC8, 0xD9, 0x31, 0x20,
+        0x12, 0x3, 0x77, 0x66, 0x54, 0x45, 0xBD, 0xAC, 0x9E, 0x8F,
+        0xFB, 0xEA, 0xD8, 0xC9, 0x42, 0x53, 0x61, 0x70, 0x4, 0x15,
+        0x27, 0x36, 0xCE, 0xDF, 0xED, 0xFC, 0x88, 0x99, 0xAB, 0xBA,
+        0x52, 0x43, 0x71, 0x60, 0x14, 0x5, 0x37, 0x26, 0xDE, 0xCF,
+        0xFD, 0xEC, 0x98, 0x89, 0xBB, 0xAA, 0x63, 0x72, 0x40, 0x51,
+        0x25, 0x34, 0x6, 0x17, 0xEF, 0xFE, 0xCC, 0xDD, 0xA9, 0xB8,
+        0x8A, 0x9B, 0x73, 0x62, 0x50, 0x41, 0x35, 0x24, 0x16, 0x7,
+        0xFF, 0xEE, 0xDC, 0xCD, 0xB9, 0xA8, 0x9A, 0x8B, 0x84, 0x95,
+        0xA7, 0xB6, 0xC2, 0xD3, 0xE1, 0xF0, 0x8, 0x19, 0x2B, 0x3A,
+        0x4E, 0x5F, 0x6D, 0x7C, 0x94, 0x85, 0xB7, 0xA6, 0xD2, 0xC3,
+        0xF1, 0xE0, 0x18, 0x9, 0x3B, 0x2A, 0x5E, 0x4F, 0x7D, 0x6C,
+        0xA5, 0xB4, 0x86, 0x97, 0xE3, 0xF2, 0xC0, 0xD1, 0x29, 0x38,
+        0xA, 0x1B, 0x6F, 0x7E, 0x4C, 0x5D, 0xB5, 0xA4, 0x96, 0x87,
+        0xF3, 0xE2, 0xD0, 0xC1, 0x39, 0x28, 0x1A, 0xB, 0x7F, 0x6E,
+        0x5C, 0x4D, 0xC6, 0xD7, 0xE5, 0xF4, 0x80, 0x91, 0xA3, 0xB2,
+        0x4A, 0x5B, 0x69, 0x78, 0xC, 0x1D, 0x2F, 0x3E, 0xD6, 0xC7,
+        0xF5, 0xE4, 0x90, 0x81, 0xB3, 0xA2, 0x5A, 0x4B, 0x79, 0x68,
+        0x1C, 0xD, 0x3F, 0x2E, 0xE7, 0xF6, 0xC4, 0xD5, 0xA1, 0xB0,
+        0x82, 0x93, 0x6B, 0x7A, 0x48, 0x59, 0x2D, 0x3C, 0xE, 0x1F,
+        0xF7, 0xE6, 0xD4, 0xC5, 0xB1, 0xA0, 0x92, 0x83, 0x7B, 0x6A,
+        0x58, 0x49, 0x3D, 0x2C, 0x1E, 0xF]
+
+# Both tables combined into one 16-bit table indexed by (state ^ byte) & 0xFF
+CRC_TABLE = [low | high << 8 for low, high in zip(CrcL, CrcH)]
+
+# binascii.crc_hqx computes the unreflected CCITT checksum, which gives the same
+# result as the tables above when the bits of every byte are reversed going in
+# and the bits of the checksum are reversed coming out
+_REVERSED_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+def _reflect16(value: int) -> int:
+    return _REVERSED_BITS[value >> 8] | _REVERSED_BITS[value & 0xFF] << 8
+
+def crc16(data: bytes, state: int = 0) -> int:
+    """Checksum of data as a 16-bit value, low byte first on the wire.  Pass the result
+    for a prefix as state to continue the checksum over the data that follows."""
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return _reflect16(crc_hqx(data.translate(_REVERSED_BITS), _reflect16(state) if state else 0))
+
+def crc16_table(data: bytes, state: int = 0) -> int:
+    """Reference implementation of crc16 using the combined lookup table"""
+    table = CRC_TABLE
+    for datum in data:
+        state = table[(state ^ datum) & 0xFF] ^ (state >> 8)
+    return state
+
+def calculate_crc(data: bytearray) -> bytearray:
+    """Calculate the checksum bytes (2) for the message to/from the device.
+        data: message data
+
+        returns 2 checksum bytes"""
+
+    crc = crc16(data)
+    return bytearray((crc & 0xFF, crc >> 8))
+
+def right_align(frames: Sequence[bytes]) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Pack frames of any length into the rows of a uint8 matrix, aligned to the right
+    and padded with leading zeros, which do not change the checksum.
+        returns the matrix and the length of each frame"""
+
+    _require_numpy()
+    lengths = np.fromiter((len(frame) for frame in frames), dtype=np.int64, count=len(frames))
+    width = int(lengths.max()) if len(frames) else 0
+    matrix = np.zeros((len(frames), width), dtype=np.uint8)
+
+    # Recorded frames come in a few distinct lengths, copy each group as one block
+    for length in np.unique(lengths):
+        if not length:
+            continue
+        rows = np.flatnonzero(lengths == length)
+        block = b"".join(bytes(frames[row]) for row in rows)
+        matrix[rows, width - length:] = np.frombuffer(block, dtype=np.uint8).reshape(-1, length)
+
+    return matrix, lengths
+
+def crc16_batch(data: Union["np.ndarray", Sequence[bytes]]) -> "np.ndarray":
+    """Checksums of many messages at once.
+        data: uint8 matrix with one right-aligned message per row, or a sequence of messages
+
+        returns a uint16 array with one checksum per message"""
+
+    _require_numpy()
+    if not isinstance(data, np.ndarray):
+        data, _ = right_align(data)
+
+    # Two bytes per step: pad to an even width with a leading zero column and view
+    # each row as little-endian 16-bit words
+    if data.shape[1] % 2:
+        data = np.pad(data, ((0, 0), (1, 0)))
+    words = np.ascontiguousarray(data).view("<u2")
+
+    table = _word_table()
+    state = np.zeros(data.shape[0], dtype=np.uint16)
+    for column in words.T:
+        np.bitwise_xor(state, column, out=state)
+        np.take(table, state, out=state)
+
+    return state
+
+def _word_table() -> "np.ndarray":
+    """Table giving the state after two bytes, indexed by the state xor the two bytes"""
+    global _WORD_TABLE    # pylint: disable=global-statement
+    if _WORD_TABLE is None:
+        table = np.asarray(CRC_TABLE, dtype=np.uint16)
+        index = np.arange(65536, dtype=np.uint16)
+        state = table[index & 0xFF] ^ (index >> 8)
+        _WORD_TABLE = table[state & 0xFF] ^ (state >> 8)
+    return _WORD_TABLE
+
+_WORD_TABLE = None
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("NumPy is required for batch checksums: pip install numpy")
@@ -239,6 +239,9 @@ class DeviceError(IntEnum):
     # Action was cancelled
     CANCELLED = 118
 
+    # A gateway refused a command because another client is in control of the loader
+    NOT_OWNER = 119
+
 
 class DeviceException(Exception):
     """Autoloader exception with error code"""
@@ -0,0 +1,560 @@
+"""Many autoloaders served by a single I/O thread.  The fleet owns the command and status
+sockets of every device, multiplexes them with a selector, and schedules the status polls
+of all devices, so the number of threads does not grow with the number of loaders."""
+import errno
+import logging
+import selectors
+import socket
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, current_thread
+from time import monotonic, perf_counter
+from typing import Callable, Deque, List, NamedTuple, Optional, Tuple
+
+from newpro_autoloader.connection import (
+    CONNECT_TIMEOUT,
+    DEFAULT_TIMEOUT,
+    AddressInfo,
+    RECEIVE_COUNT,
+    configure_socket,
+    resolve,
+)
+from newpro_autoloader.device_error import DeviceError, DeviceException
+from newpro_autoloader.identity_cache import DeviceIdentity, IdentityCache
+from newpro_autoloader.loader import Loader, PORT_NUMBER, PORT_NUMBER_STATUS
+from newpro_autoloader.loader_connection import (
+    LoaderCommand,
+    LoaderFrameParser,
+    MAX_IN_FLIGHT,
+    CommandEncoder,
+    PendingRequest,
+    RequestTracker,
+)
+from newpro_autoloader.poll_scheduler import FAST_POLL_INTERVAL, IDLE_POLL_INTERVAL
+from newpro_autoloader.recorder import RecordKind, TelemetryRecorder
+from newpro_autoloader.tracing import Stage
+
+# Longest wait of the I/O thread when nothing is scheduled
+IDLE_WAIT: float = 1.0
+
+_logger = logging.getLogger(__name__)
+
+class _FleetHooks(NamedTuple):
+    """What the connections and loaders of a fleet use of it"""
+    thread: Thread
+    selector: selectors.BaseSelector
+    queue_request: Callable[["FleetConnection", Optional[bytearray], PendingRequest], None]
+    lookup_done: Callable[["FleetConnection", "Future[List[AddressInfo]]"], None]
+    set_polling: Callable[["FleetLoader", bool], None]
+    wake_loader: Callable[["FleetLoader"], None]
+
+class FleetConnection(RequestTracker):  # pylint: disable=too-many-instance-attributes
+    """One socket of a fleet device.  Takes the place of a LoaderConnection: commands
+    are queued to the fleet I/O thread and matched to responses by message ID."""
+
+    def __init__(self, fleet: _FleetHooks, address: List[str], port: int):
+        super().__init__()
+        self._fleet = fleet
+        self._address = address
+        self._port = port
+
+        self._socket: Optional[socket.socket] = None
+        self._connected = False
+        self._address_index = 0
+        # Name lookup of the address being connected to, and the socket addresses it
+        # gave that are not yet tried
+        self._lookup: Optional["Future[List[AddressInfo]]"] = None
+        self._candidates: List[AddressInfo] = []
+        self._connect_deadline: float = 0.0
+        self._parser = LoaderFrameParser()
+        self._output = bytearray()
+
+        # Used on the I/O thread only, which copies each frame to the output buffer
+        self._encoder = CommandEncoder(self._device_address, self._host_address)
+
+    @property
+    def address_active(self) -> Optional[str]:
+        """Address of the active connection, if any"""
+        return self._address[self._address_index] if self._connected else None
+
+    @property
+    def pipelined(self) -> bool:
+        """Always True, commands are sent without waiting for earlier responses"""
+        return True
+
+    def command(self,
+             cmd_type: LoaderCommand,
+             msg: Optional[bytearray] = None,
+             timeout: float = DEFAULT_TIMEOUT,
+    ) -> bytearray:
+        """Send a command and receive the response"""
+        if current_thread() is self._fleet.thread:
+            raise RuntimeError("Blocking commands cannot run on the fleet I/O thread")
+        return self.submit(cmd_type, msg, timeout).result()
+
+    def priority_command(self,
+                         cmd_type: LoaderCommand,
+                         msg: Optional[bytearray] = None,
+                         timeout: float = DEFAULT_TIMEOUT,
+    ) -> bytearray:
+        """Send a command ahead of all queued requests of the fleet, such as STOP"""
+        if current_thread() is self._fleet.thread:
+            raise RuntimeError("Blocking commands cannot run on the fleet I/O thread")
+        return self.submit(cmd_type, msg, timeout, priority=True).result()
+
+    def submit(self,
+               cmd_type: LoaderCommand,
+               msg: Optional[bytearray] = None,
+               timeout: float = DEFAULT_TIMEOUT,
+               priority: bool = False,
+    ) -> "Future[bytearray]":
+        """Queue a command for the I/O thread.  Priority commands go to the front of
+        the queue and are not limited by the requests in flight.
+            returns a future for the message body, or for the DeviceException"""
+        future: "Future[bytearray]" = Future()
+        future.set_running_or_notify_cancel()
+        request = PendingRequest(
+            future,
+            cmd_type,
+            monotonic() + timeout,
+            perf_counter(),
+            self._start_trace(cmd_type),
+            not priority,
+        )
+        self._fleet.queue_request(self, msg, request)
+        return future
+
+    # The methods below run on the fleet I/O thread
+
+    def start(self, msg: Optional[bytearray], request: PendingRequest):
+        """Send a queued request, connecting first if needed"""
+        cmd_type = request.cmd_type
+        if len(self._pending) >= MAX_IN_FLIGHT and request.limited:
+            self._fail_request(request, DeviceException(DeviceError.TIMEOUT))
+            return
+
+        message_id = self._next_message_id()
+        while message_id in self._pending:
+            message_id = self._next_message_id()
+
+        building = perf_counter()
+        cmd = self._encoder.encode(cmd_type, msg, message_id)
+        if request.trace is not None:
+            request.trace(Stage.BUILD, building, perf_counter())
+        if self._recorder is not None and cmd_type != LoaderCommand.GET_STATUS:
+            self._recorder.record(self._channel, RecordKind.REQUEST, cmd)
+
+        self._pending[message_id] = request
+        self._output += cmd
+        if self._connected:
+            self._flush()
+        elif self._socket is None and self._lookup is None:
+            self._connect()
+
+    def poll(self, cmd_type: LoaderCommand, now: float) -> "Future[bytearray]":
+        """Send a poll of the fleet, without queueing it first.
+            returns a future for the message body, or for the DeviceException"""
+        future: "Future[bytearray]" = Future()
+        future.set_running_or_notify_cancel()
+        self.start(None, PendingRequest(
+            future,
+            cmd_type,
+            now + DEFAULT_TIMEOUT,
+            perf_counter(),
+            self._start_trace(cmd_type),
+        ))
+        return future
+
+    def expire(self, now: float) -> Optional[float]:
+        """Fail the requests past their deadline, and give up on an address that
+        does not connect in time.
+            returns the earliest remaining deadline, if any"""
+        earliest: Optional[float] = None
+        if (self._socket is not None and not self._connected) or self._lookup is not None:
+            if self._connect_deadline <= now:
+                self._next_address()
+            else:
+                earliest = self._connect_deadline
+
+        for message_id, request in list(self._pending.items()):
+            if request.deadline <= now:
+                del self._pending[message_id]
+                self._fail_request(request, DeviceException(DeviceError.TIMEOUT))
+            elif earliest is None or request.deadline < earliest:
+                earliest = request.deadline
+
+        return earliest
+
+    def handle(self, events: int):
+        """Connect, receive or send, as the selector events allow"""
+        try:
+            if not self._connected:
+                self._finish_connect()
+                return
+
+            if events & selectors.EVENT_READ:
+                self._metrics.record_received(self._parser.recv_into(self._socket))
+                frame = self._parser.next_frame()
+                while frame is not None:
+                    self._complete(frame, self._parser.first_byte)
+                    frame = self._parser.next_frame()
+
+            if events & selectors.EVENT_WRITE:
+                self._flush()
+
+        except (OSError, DeviceException):
+            self.fail(DeviceException(DeviceError.NETWORK_READ_FAILED))
+
+    def _connect(self):
+        """Look up the current address on the resolver threads, which the I/O thread
+        must not wait for, and connect once it is resolved"""
+        self._connect_deadline = monotonic() + CONNECT_TIMEOUT
+        lookup = resolve(self._address[self._address_index], self._port)
+        self._lookup = lookup
+        if lookup.done():
+            self.resolved(lookup)
+        else:
+            lookup.add_done_callback(lambda _: self._fleet.lookup_done(self, lookup))
+
+    def resolved(self, lookup: "Future[List[AddressInfo]]"):
+        """Connect to the addresses of a finished name lookup"""
+        if lookup is not self._lookup:
+            # Given up on after the connect deadline
+            return
+        self._lookup = None
+        if lookup.exception() is not None:
+            self._next_address()
+            return
+        self._candidates = list(lookup.result())
+        self._attempt()
+
+    def _attempt(self):
+        """Start connecting to the next socket address of the current address"""
+        while self._candidates:
+            family, sock_type, proto, _, sockaddr = self._candidates.pop(0)
+            sock = socket.socket(family, sock_type, proto)
+            sock.setblocking(False)
+            ret = sock.connect_ex(sockaddr)
+            if ret in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self._socket = sock
+                self._fleet.selector.register(sock, selectors.EVENT_WRITE, self)
+                return
+            sock.close()
+
+        self._next_address()
+
+    def _finish_connect(self):
+        if self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            self._close_socket()
+            self._attempt()
+            return
+
+        configure_socket(self._socket)
+        self._metrics.record_connect()
+        self._connected = True
+        self._update_events()
+        self._flush()
+
+    def _next_address(self):
+        self._close_socket()
+        self._candidates.clear()
+        self._address_index += 1
+        if self._address_index < len(self._address):
+            self._connect()
+        else:
+            self._address_index = 0
+            self.fail(DeviceException(DeviceError.CONNECTION_FAILED))
+
+    def _flush(self):
+        if self._output:
+            try:
+                sent = self._socket.send(self._output)
+            except BlockingIOError:
+                sent = 0
+            self._metrics.record_sent(sent)
+            del self._output[:sent]
+        self._update_events()
+
+    def _update_events(self):
+        events = selectors.EVENT_READ
+        if self._output:
+            events |= selectors.EVENT_WRITE
+        self._fleet.selector.modify(self._socket, events, self)
+
+    def fail(self, error: DeviceException):
+        """Close the socket and fail all pending requests"""
+        self._close_socket()
+        self._output.clear()
+        pending = list(self._pending.values())
+        self._pending.clear()
+        for request in pending:
+            self._fail_request(request, error)
+
+    def _close_socket(self):
+        if self._socket is not None:
+            try:
+                self._fleet.selector.unregister(self._socket)
+            except (KeyError, ValueError):
+                pass
+            self._socket.close()
+        self._socket = None
+        self._lookup = None
+        self._connected = False
+        self._parser.clear()
+
+class FleetLoader(Loader):
+    """Loader served by an AutoloaderFleet.  Offers the full Loader interface, but
+    while the context is entered the status is polled by the fleet I/O thread instead
+    of a thread of its own.  Status callbacks run on the fleet I/O thread and must not
+    send commands."""
+
+    def __init__(self,
+                 fleet: _FleetHooks,
+                 connection: FleetConnection,
+                 status_connection: FleetConnection,
+                 **kwargs):
+        self._fleet = fleet
+        self._fleet_connection = connection
+        self._fleet_status_connection = status_connection
+        self._next_poll: float = 0.0
+        self._poll_pending = False
+        super().__init__(connection=connection, status_connection=status_connection, **kwargs)
+
+    def __enter__(self):
+        self._scheduler.set_wake_callback(lambda: self._fleet.wake_loader(self))
+        self._fleet.set_polling(self, True)
+        return self
+
+    def __exit__(self, *args):
+        self._scheduler.set_wake_callback(None)
+        self._fleet.set_polling(self, False)
+
+    # The methods below run on the fleet I/O thread
+
+    def restart_polling(self, now: float):
+        """Poll right away and restart the deadline grid from there"""
+        self._scheduler.restart()
+        self._next_poll = now
+
+    def poll(self, now: float) -> float:
+        """Poll the status if due.
+            returns when it is next due"""
+        if self._poll_pending:
+            return now + IDLE_WAIT
+        if self._next_poll > now:
+            return self._next_poll
+
+        self._poll_pending = True
+        # Status frames can only be decoded once the version is known, which is asked
+        # on the command port like the handshake of Loader
+        if self._needs_identity():
+            self._fleet_connection.poll(LoaderCommand.GET_VERSION, now).add_done_callback(
+                self._polled_version)
+        else:
+            self._fleet_status_connection.poll(LoaderCommand.GET_STATUS, now).add_done_callback(
+                self._polled_status)
+        return now + IDLE_WAIT
+
+    def _polled_status(self, future: "Future[bytearray]"):
+        self._poll_pending = False
+        try:
+            self._update_status(future.result())
+        except (DeviceException, OSError) as ex:
+            _logger.warning("Status poll failed: %s", ex)
+            self._scheduler.poll_failed()
+        except Exception:   # pylint: disable=broad-exception-caught
+            _logger.exception("Status update failed")
+        self._next_poll = monotonic() + self._scheduler.next_delay()
+
+    def _polled_version(self, future: "Future[bytearray]"):
+        self._poll_pending = False
+        try:
+            self._set_identity(DeviceIdentity(*self._parse_version(future.result())))
+        except (DeviceException, OSError) as ex:
+            _logger.warning("Version poll failed: %s", ex)
+            self._scheduler.poll_failed()
+        except Exception:   # pylint: disable=broad-exception-caught
+            _logger.exception("Version update failed")
+        else:
+            # The status is polled right away
+            return
+        self._next_poll = monotonic() + self._scheduler.next_delay()
+
+class AutoloaderFleet:  # pylint: disable=too-many-instance-attributes
+    """Owns the connections of any number of loaders and serves them from one I/O thread.
+    Use add to create a Loader-compatible handle for each device."""
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_receive, self._wakeup_send = socket.socketpair()
+        self._wakeup_receive.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_receive, selectors.EVENT_READ, None)
+
+        self._requests: Deque[Tuple[FleetConnection, Optional[bytearray], PendingRequest]] = deque()
+        self._connections: List[FleetConnection] = []
+        self._polled: List[FleetLoader] = []
+        # Changes queued by other threads for the I/O thread
+        self._polling_changes: Deque[Tuple[FleetLoader, bool]] = deque()
+        self._woken: Deque[FleetLoader] = deque()
+        self._lookups: Deque[Tuple[FleetConnection, "Future[List[AddressInfo]]"]] = deque()
+        self._running = True
+        self._thread = Thread(target=self._run, name="Fleet I/O", daemon=True)
+        self._hooks = _FleetHooks(
+            self._thread,
+            self._selector,
+            self._queue_request,
+            self._lookup_done,
+            self._set_polling,
+            self._wake_loader,
+        )
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def thread(self) -> Thread:
+        """The I/O thread"""
+        return self._thread
+
+    @property
+    def loaders(self) -> List[FleetLoader]:
+        """Loaders being polled"""
+        return list(self._polled)
+
+    def add(self,   # pylint: disable=too-many-arguments,too-many-positional-arguments
+            address: str = "autoloader",
+            fallback_address: str = "192.168.0.9",
+            port: int = PORT_NUMBER,
+            status_port: int = PORT_NUMBER_STATUS,
+            poll_interval: float = FAST_POLL_INTERVAL,
+            idle_poll_interval: float = IDLE_POLL_INTERVAL,
+            recorder: Optional[TelemetryRecorder] = None,
+            lazy: bool = False,
+            identity_cache: Optional[IdentityCache] = None) -> FleetLoader:
+        """Connect to another loader, with the same arguments as Loader.  Enter the
+        returned loader's context to poll its status.  A lazy loader that has no
+        version yet is polled with GetVersion until the device answers."""
+        addresses = [address, fallback_address]
+        connection = FleetConnection(self._hooks, addresses, port)
+        status_connection = FleetConnection(self._hooks, addresses, status_port)
+        self._connections.extend((connection, status_connection))
+
+        return FleetLoader(
+            self._hooks,
+            address=address,
+            fallback_address=fallback_address,
+            poll_interval=poll_interval,
+            idle_poll_interval=idle_poll_interval,
+            recorder=recorder,
+            connection=connection,
+            status_connection=status_connection,
+            lazy=lazy,
+            identity_cache=identity_cache,
+        )
+
+    def close(self):
+        """Stop the I/O thread and close all connections.  Outstanding commands fail."""
+        if self._thread.is_alive():
+            self._running = False
+            self._wake()
+            self._thread.join()
+
+    def _queue_request(self,
+                       connection: FleetConnection,
+                       msg: Optional[bytearray],
+                       request: PendingRequest):
+        if not self._running:
+            request.future.set_exception(DeviceException(DeviceError.CANCELLED))
+            return
+        if not request.limited:
+            self._requests.appendleft((connection, msg, request))
+        else:
+            self._requests.append((connection, msg, request))
+        self._wake()
+
+    def _set_polling(self, loader: FleetLoader, polling: bool):
+        self._polling_changes.append((loader, polling))
+        self._wake()
+
+    def _lookup_done(self,
+                     connection: FleetConnection,
+                     lookup: "Future[List[AddressInfo]]"):
+        self._lookups.append((connection, lookup))
+        self._wake()
+
+    def _wake_loader(self, loader: FleetLoader):
+        self._woken.append(loader)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _run(self):
+        try:
+            while self._running:
+                for key, events in self._selector.select(self._serve()):
+                    if key.data is None:
+                        try:
+                            self._wakeup_receive.recv(RECEIVE_COUNT)
+                        except BlockingIOError:
+                            pass
+                    else:
+                        key.data.handle(events)
+        finally:
+            self._shut_down()
+
+    def _serve(self) -> float:
+        """Start queued requests and due polls and expire overdue requests.
+            returns the time until something is next due"""
+        while self._requests:
+            connection, msg, request = self._requests.popleft()
+            try:
+                connection.start(msg, request)
+            except Exception as ex:   # pylint: disable=broad-exception-caught
+                request.future.set_exception(ex)
+
+        while self._lookups:
+            connection, lookup = self._lookups.popleft()
+            connection.resolved(lookup)
+
+        now = monotonic()
+        due = now + IDLE_WAIT
+        for connection in self._connections:
+            deadline = connection.expire(now)
+            if deadline is not None:
+                due = min(due, deadline)
+
+        while self._polling_changes:
+            loader, polling = self._polling_changes.popleft()
+            if polling and loader not in self._polled:
+                loader.restart_polling(now)
+                self._polled.append(loader)
+            elif not polling and loader in self._polled:
+                self._polled.remove(loader)
+
+        while self._woken:
+            loader = self._woken.popleft()
+            loader.restart_polling(now)
+
+        for loader in self._polled:
+            due = min(due, loader.poll(now))
+
+        return max(due - monotonic(), 0.0)
+
+    def _shut_down(self):
+        for connection in self._connections:
+            connection.fail(DeviceException(DeviceError.CANCELLED))
+        while self._requests:
+            self._requests.popleft()[2].future.set_exception(
+                DeviceException(DeviceError.CANCELLED))
+        self._selector.close()
+        self._wakeup_receive.close()
+        self._wakeup_send.close()
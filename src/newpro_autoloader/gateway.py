@@ -0,0 +1,405 @@
+"""Gateway that serves the autoloader protocol to any number of clients over a single
+pair of connections to the device.  Status requests are answered from the latest
+status, which the gateway polls at a fixed rate, so the load on the device and its
+heartbeat do not depend on the number of clients.  Loader works unchanged when given
+the address and ports of the gateway."""
+import argparse
+import socketserver
+from concurrent.futures import Future
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Dict, List, Optional, Tuple, Union
+
+from newpro_autoloader.connection import DEFAULT_TIMEOUT
+from newpro_autoloader.device_error import DeviceError, DeviceException
+from newpro_autoloader.loader import (
+    EVAC_TIMEOUT,
+    HOME_TIMEOUT,
+    LOAD_TIMEOUT,
+    PORT_NUMBER,
+    PORT_NUMBER_STATUS,
+)
+from newpro_autoloader.loader_connection import (
+    COMMAND_CODE_INDEX,
+    LoaderCommand,
+    LoaderConnection,
+    RECEIVE_BLOCK_NUMBER_INDEX,
+    RECEIVE_FROM_ID_INDEX,
+    RECEIVE_TO_ID_INDEX,
+    build_frame,
+)
+from newpro_autoloader.metrics import LinkMetrics
+from newpro_autoloader.poll_scheduler import FAST_POLL_INTERVAL
+from newpro_autoloader.simulator import (
+    add_server_arguments,
+    read_request,
+    serve_until_interrupted,
+)
+
+# Seconds that a client keeps control of the loader after its last command completes,
+# so that a sequence of commands is not interleaved with those of another client
+OWNER_HOLD: float = 5.0
+
+# Timeouts of the commands forwarded to the device, as used by Loader
+_COMMAND_TIMEOUTS: Dict[int, float] = {
+    LoaderCommand.HOME: HOME_TIMEOUT,
+    LoaderCommand.LOAD: LOAD_TIMEOUT,
+    LoaderCommand.LOAD_CASSETTE: LOAD_TIMEOUT,
+    LoaderCommand.EVAC: EVAC_TIMEOUT,
+}
+
+# Latest status response body, or the error of the latest poll
+_Status = Union[bytearray, DeviceException]
+
+class _ClientHandler(socketserver.StreamRequestHandler):
+    """Reads command frames from one client.  Requests are answered as they complete,
+    so pipelined clients can have several outstanding."""
+
+    def handle(self):
+        gateway: LoaderGateway = self.server.gateway     # type: ignore[attr-defined]
+        self._write_lock = Lock()
+        try:
+            while True:
+                request = read_request(self.rfile)
+                if request is None:
+                    return
+
+                cmd_type: Union[LoaderCommand, int] = request.body[COMMAND_CODE_INDEX]
+                try:
+                    cmd_type = LoaderCommand(cmd_type)
+                except ValueError:
+                    # Forwarded like any other command
+                    pass
+                if not request.crc_valid:
+                    self.reply(request.header, cmd_type, DeviceError.INVALID_CRC)
+                    continue
+
+                gateway._request(   # pylint: disable=protected-access
+                    self, request.header, cmd_type, request.body[1:])
+        finally:
+            gateway._disconnected(self)   # pylint: disable=protected-access
+
+    def reply(self,
+              header: bytes,
+              cmd_type: int,
+              code: DeviceError,
+              body: Optional[bytearray] = None):
+        """Answer the request with the given header.  body is the complete response
+        body, which starts with the command code and error code, if successful."""
+        response = build_frame(
+            header[RECEIVE_FROM_ID_INDEX],
+            header[RECEIVE_TO_ID_INDEX],
+            header[RECEIVE_BLOCK_NUMBER_INDEX],
+            body if body is not None else bytearray([cmd_type, code, 0]),
+        )
+        with self._write_lock:
+            try:
+                self.wfile.write(response)
+            except (OSError, ValueError):
+                # Closed, ValueError if a response outlives the connection
+                pass
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], gateway: "LoaderGateway"):
+        self.gateway = gateway
+        super().__init__(address, _ClientHandler)
+
+class LoaderGateway:    # pylint: disable=too-many-instance-attributes
+    """Serves the command and status ports of one autoloader to many clients.
+
+    GetStatus is answered from the latest status, polled every poll_interval seconds,
+    and GetVersion from the answer the device gave once.  Once any other command
+    completes, the device is polled at once, and GetStatus is answered with that status,
+    so a client sees the effect of its own command.  Meanwhile the other requests of the
+    client are still read and forwarded.  STOP is always forwarded,
+    ahead of everything else.  Other commands are forwarded for one client at a time:
+    the client whose command is in progress, or completed less than owner_hold seconds
+    ago, is in control, and commands of other clients fail with NOT_OWNER."""
+
+    def __init__(self,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 address: str = "autoloader",
+                 fallback_address: str = "192.168.0.9",
+                 device_port: int = PORT_NUMBER,
+                 device_status_port: int = PORT_NUMBER_STATUS,
+                 host: str = "127.0.0.1",
+                 port: int = PORT_NUMBER,
+                 status_port: int = PORT_NUMBER_STATUS,
+                 poll_interval: float = FAST_POLL_INTERVAL,
+                 owner_hold: float = OWNER_HOLD):
+        """Bind both ports.  Serving and polling start with start() or by entering
+        the context.  Use port 0 to pick free ports."""
+        addresses = [address, fallback_address]
+        self._connection = LoaderConnection(addresses, device_port, pipelined=True)
+        self._status_connection = LoaderConnection(addresses, device_status_port, pipelined=True)
+        self._poll_interval = poll_interval
+        self._owner_hold = owner_hold
+
+        self._lock = Lock()
+        # Guards the status and the requests waiting for a fresh one
+        self._status_lock = Lock()
+        self._status: Optional[_Status] = None
+        # Number of the poll that _status came from, and of the first poll that may
+        # answer GetStatus, which is one sent after the latest command completed
+        self._status_poll: int = 0
+        self._fresh_poll: int = 1
+        # GetStatus requests answered by the poll thread once a fresh status arrives
+        self._status_waiters: List[Tuple[_ClientHandler, bytes]] = []
+        self._version: Optional["Future[bytearray]"] = None
+        # Client in control of the loader, the number of its commands in progress, and
+        # when control lapses once none are
+        self._owner: Optional[_ClientHandler] = None
+        self._owner_commands: int = 0
+        self._owner_until: float = 0.0
+        self._status_polls: int = 0
+        self._status_requests: int = 0
+
+        self._stop = Event()
+        # Set to poll before the next interval
+        self._wake = Event()
+        self._servers = [
+            _Server((host, port), self),
+            _Server((host, status_port), self),
+        ]
+        self._threads: List[Thread] = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def port(self) -> int:
+        """Bound command port"""
+        return self._servers[0].server_address[1]
+
+    @property
+    def status_port(self) -> int:
+        """Bound status port"""
+        return self._servers[1].server_address[1]
+
+    @property
+    def owner(self) -> Optional[Tuple[str, int]]:
+        """Address of the client in control of the loader, if any"""
+        with self._lock:
+            if self._owner is None or not self._owns(self._owner, monotonic()):
+                return None
+            return self._owner.client_address
+
+    @property
+    def status_polls(self) -> int:
+        """Number of GetStatus requests sent to the device"""
+        return self._status_polls
+
+    @property
+    def status_requests(self) -> int:
+        """Number of GetStatus requests answered to clients"""
+        return self._status_requests
+
+    @property
+    def metrics(self) -> Dict[str, LinkMetrics]:
+        """Traffic, failures and command latency of the "command" and "status"
+        connections to the device"""
+        return {"command": self._connection.metrics, "status": self._status_connection.metrics}
+
+    def start(self):
+        """Poll the device and serve both ports from background threads"""
+        if self._threads:
+            return
+        self._stop.clear()
+        self._threads.append(Thread(target=self._poll, name="Gateway poll", daemon=True))
+        for server in self._servers:
+            self._threads.append(
+                Thread(target=server.serve_forever, name="Gateway", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def close(self):
+        """Stop serving and polling, and close the connections to the device"""
+        self._stop.set()
+        self._wake.set()
+        for server in self._servers:
+            if self._threads:
+                server.shutdown()
+            server.server_close()
+        self._connection.close()
+        self._status_connection.close()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def _poll(self):
+        deadline = monotonic()
+        while not self._stop.is_set():
+            with self._status_lock:
+                # Cleared with the lock, so a command that completes from now on asks
+                # for the next poll rather than this one
+                self._wake.clear()
+                self._status_polls += 1
+                poll = self._status_polls
+            try:
+                status: _Status = self._status_connection.command(LoaderCommand.GET_STATUS)
+            except DeviceException as ex:
+                status = ex
+            waiters: List[Tuple[_ClientHandler, bytes]] = []
+            with self._status_lock:
+                self._status = status
+                self._status_poll = poll
+                if poll >= self._fresh_poll:
+                    waiters, self._status_waiters = self._status_waiters, []
+            for client, header in waiters:
+                self._send_status(client, header, status)
+
+            # A fixed rate, however long the poll took, unless a command completed
+            deadline = max(deadline + self._poll_interval, monotonic())
+            if self._wake.wait(deadline - monotonic()):
+                deadline = monotonic()
+
+        with self._status_lock:
+            waiters, self._status_waiters = self._status_waiters, []
+        for client, header in waiters:
+            self._send_status(client, header, DeviceException(DeviceError.CANCELLED))
+
+    # The methods below run on the client threads
+
+    def _request(self,
+                 client: _ClientHandler,
+                 header: bytes,
+                 cmd_type: Union[LoaderCommand, int],
+                 payload: bytes):
+        if cmd_type == LoaderCommand.GET_STATUS:
+            self._reply_status(client, header)
+        elif cmd_type == LoaderCommand.GET_VERSION:
+            self._forward(client, header, cmd_type, self._get_version())
+        elif cmd_type == LoaderCommand.STOP:
+            response = self._status_connection.submit(
+                LoaderCommand.STOP, None, DEFAULT_TIMEOUT, priority=True)
+            response.add_done_callback(self._invalidate_status)
+            self._forward(client, header, cmd_type, response)
+        else:
+            self._command(client, header, cmd_type, payload)
+
+    def _reply_status(self, client: _ClientHandler, header: bytes):
+        with self._status_lock:
+            self._status_requests += 1
+            if self._status_poll < self._fresh_poll:
+                # Answered by the poll thread, so that this client's next requests,
+                # such as STOP, are read and forwarded meanwhile
+                self._status_waiters.append((client, header))
+                return
+            status = self._status
+        self._send_status(client, header, status)
+
+    @staticmethod
+    def _send_status(client: _ClientHandler, header: bytes, status: _Status):
+        if isinstance(status, DeviceException):
+            client.reply(header, LoaderCommand.GET_STATUS, status.error_code)
+        else:
+            client.reply(header, LoaderCommand.GET_STATUS, DeviceError.NO_ERROR, status)
+
+    def _get_version(self) -> "Future[bytearray]":
+        with self._lock:
+            version = self._version
+            # Asked again only if the last attempt failed
+            if version is None or (version.done() and version.exception() is not None):
+                version = self._version = self._connection.submit(LoaderCommand.GET_VERSION)
+            return version
+
+    def _command(self,
+                 client: _ClientHandler,
+                 header: bytes,
+                 cmd_type: Union[LoaderCommand, int],
+                 payload: bytes):
+        with self._lock:
+            if self._owner is not client and self._owns(self._owner, monotonic()):
+                client.reply(header, cmd_type, DeviceError.NOT_OWNER)
+                return
+            self._owner = client
+            self._owner_commands += 1
+
+        try:
+            response = self._connection.submit(
+                cmd_type,
+                bytearray(payload) if payload else None,
+                _COMMAND_TIMEOUTS.get(cmd_type, DEFAULT_TIMEOUT),
+            )
+        except DeviceException as ex:
+            self._command_done(client)
+            client.reply(header, cmd_type, ex.error_code)
+            return
+
+        response.add_done_callback(lambda done: self._command_done(client))
+        # Before the client has the response, as callbacks run in order
+        response.add_done_callback(self._invalidate_status)
+        self._forward(client, header, cmd_type, response)
+
+    def _invalidate_status(self, _response: "Future[bytearray]"):
+        """Answer GetStatus only with a status polled from now on, and poll at once"""
+        with self._status_lock:
+            self._fresh_poll = self._status_polls + 1
+            self._wake.set()
+
+    def _owns(self, client: Optional[_ClientHandler], now: float) -> bool:
+        """True if client is in control.  Requires the lock."""
+        return (client is not None and client is self._owner and
+                (self._owner_commands > 0 or now < self._owner_until))
+
+    def _command_done(self, client: _ClientHandler):
+        with self._lock:
+            if self._owner is client:
+                self._owner_commands -= 1
+                self._owner_until = monotonic() + self._owner_hold
+
+    def _disconnected(self, client: _ClientHandler):
+        with self._lock:
+            # Commands in progress keep control until they complete
+            if self._owner is client and self._owner_commands == 0:
+                self._owner = None
+
+    @staticmethod
+    def _forward(client: _ClientHandler,
+                 header: bytes,
+                 cmd_type: Union[LoaderCommand, int],
+                 response: "Future[bytearray]"):
+        def reply(done: "Future[bytearray]"):
+            error = done.exception()
+            if error is None:
+                client.reply(header, cmd_type, DeviceError.NO_ERROR, done.result())
+            elif isinstance(error, DeviceException):
+                client.reply(header, cmd_type, error.error_code)
+            else:
+                client.reply(header, cmd_type, DeviceError.UNKNOWN_FAILURE)
+
+        response.add_done_callback(reply)
+
+def main():
+    """Run a gateway until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("address", help="address of the autoloader")
+    parser.add_argument("--fallback-address", default="192.168.0.9")
+    parser.add_argument("--device-port", type=int, default=PORT_NUMBER)
+    parser.add_argument("--device-status-port", type=int, default=PORT_NUMBER_STATUS)
+    add_server_arguments(parser)
+    parser.add_argument("--poll-interval", type=float, default=FAST_POLL_INTERVAL)
+    args = parser.parse_args()
+
+    gateway = LoaderGateway(
+        args.address,
+        args.fallback_address,
+        args.device_port,
+        args.device_status_port,
+        args.host,
+        args.port,
+        args.status_port,
+        args.poll_interval,
+    )
+    serve_until_interrupted(
+        gateway, f"Serving on {args.host}:{gateway.port} and {args.host}:{gateway.status_port}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""On-disk cache of the version and cassette size of each autoloader, so that a Loader
+can be created without waiting for the device to answer"""
+import json
+import os
+from threading import Lock
+from typing import Dict, NamedTuple, Optional
+
+class DeviceIdentity(NamedTuple):
+    """What GetVersion reports about a device"""
+    version: int
+    sub_version: int
+    number_of_slots: int
+
+def default_cache_path() -> str:
+    """identity.json in the user's cache directory"""
+    base = os.environ.get("LOCALAPPDATA") if os.name == "nt" else os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "newpro_autoloader", "identity.json")
+
+def identity_key(address: str, fallback_address: str, port: int) -> str:
+    """Cache key of the device reached through the given addresses"""
+    return f"{address}|{fallback_address}|{port}"
+
+class IdentityCache:
+    """Device identities by key, kept in a small JSON file.  The cache only speeds up
+    startup, so a missing or unreadable file is treated as empty and a failed write
+    is ignored."""
+
+    def __init__(self, path: Optional[str] = None):
+        self._path = path if path is not None else default_cache_path()
+        self._lock = Lock()
+
+    @property
+    def path(self) -> str:
+        """File holding the cache"""
+        return self._path
+
+    def load(self, key: str) -> Optional[DeviceIdentity]:
+        """The identity last stored for key, if any"""
+        with self._lock:
+            entry = self._read().get(key)
+        try:
+            return DeviceIdentity(*(int(value) for value in entry))
+        except (TypeError, ValueError):
+            return None
+
+    def store(self, key: str, identity: DeviceIdentity):
+        """Remember identity for key.  The file is only written if it changes."""
+        with self._lock:
+            entries = self._read()
+            if entries.get(key) == list(identity):
+                return
+            entries[key] = list(identity)
+
+            # Replaced in one step, so that other processes never read part of a file
+            temporary = f"{self._path}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+                with open(temporary, "w", encoding="utf-8") as file:
+                    json.dump(entries, file)
+                os.replace(temporary, self._path)
+            except OSError:
+                pass
+
+    def _read(self) -> Dict[str, list]:
+        try:
+            with open(self._path, encoding="utf-8") as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
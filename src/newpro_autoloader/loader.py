@@ -1,12 +1,25 @@
 """Top-level functions for accessing the autoloader"""
+import logging
+from concurrent.futures import Future
 from enum import IntEnum
-from threading import Thread
-from time import sleep
-from typing import Optional, Tuple, Union
-
-from newpro_autoloader.axis_status import AxisStatus, LoaderType, MainStatus, OverallSystemStatus
-from newpro_autoloader.device_error import DeviceError
+from threading import Lock, Thread
+from time import perf_counter, time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from newpro_autoloader.action_future import ActionFuture
+from newpro_autoloader.axis_status import AxisStatus, LoaderType, MainStatus, STATUS_CODECS
+from newpro_autoloader.cassette_map import CassetteMap
+from newpro_autoloader.device_error import DeviceError, DeviceException
+from newpro_autoloader.identity_cache import DeviceIdentity, IdentityCache, identity_key
 from newpro_autoloader.loader_connection import LoaderCommand, LoaderConnection
+from newpro_autoloader.metrics import LinkMetrics
+from newpro_autoloader.poll_scheduler import FAST_POLL_INTERVAL, IDLE_POLL_INTERVAL, PollScheduler
+from newpro_autoloader.recorder import RecordChannel, TelemetryRecorder
+from newpro_autoloader.shared_status import StatusPublisher
+from newpro_autoloader.status_events import StatusCallback, StatusField, StatusNotifier
+from newpro_autoloader.status_history import StatusHistory
+from newpro_autoloader.status_snapshot import PayloadState, StatusSnapshot
+from newpro_autoloader.tracing import Span, Stage, Tracer
 
 PORT_NUMBER = 1234
 PORT_NUMBER_STATUS = 1235
@@ -18,57 +31,39 @@ EVAC_TIMEOUT = 15
 HOME_TIMEOUT = 60
 LOAD_TIMEOUT = 180
 
+_logger = logging.getLogger(__name__)
+
 class Axis(IntEnum):
     """Which autoloader axis"""
     ELEVATOR = 0
     LOADER = 1
     ALL = 2
 
-class PayloadState(IntEnum):
-    """State of payload presence"""
-    ABSENT = 0
-    PRESENT = 1
-    UNKNOWN = 2
-
-class Loader:  # pylint: disable=too-many-instance-attributes
-    """Top-level class for accessing the autoloader.  Can be used as a context
-    manager to maintain the connection resources."""
-    def _updater(self):
-        try:
-            while self._run_thread:
-                self._get_status()
-                sleep(0.5)
-        except Exception as ex:   # pylint: disable=broad-exception-caught
-            print(ex)
+class BaseLoader:  # pylint: disable=too-many-instance-attributes
+    """Loader state and status decoding shared by the blocking and asyncio interfaces"""
 
     def __init__(self,
-                 address: str = "autoloader",
-                 fallback_address: str = "192.168.0.9"):
-        """Create a loader interface."""
-
-        self._addresses = [address, fallback_address]
-        self._connection: LoaderConnection = LoaderConnection(self._addresses, PORT_NUMBER)
-        self._status_connection: LoaderConnection = LoaderConnection(
-            self._addresses,
-            PORT_NUMBER_STATUS,
-        )
-        self._update_thread = Thread(target=self._updater, name="Update thread", daemon=True)
-        self._run_thread = False
-
-        self._elevator_status: AxisStatus = AxisStatus()
-        self._loader_status: AxisStatus = AxisStatus()
-        self._main_status: MainStatus = MainStatus()
-
-        self._version, self._sub_version, self._number_of_slots = self.get_version()
-        self._get_status()
-
-    def __enter__(self):
-        self._run_thread = True
-        self._update_thread.start()
-        return self
-
-    def __exit__(self, *args):
-        self._run_thread = False
+                 poll_interval: float = FAST_POLL_INTERVAL,
+                 idle_poll_interval: float = IDLE_POLL_INTERVAL):
+        # Replaced as a whole by each status update, never modified
+        self._snapshot: StatusSnapshot = StatusSnapshot(AxisStatus(), AxisStatus(), MainStatus())
+
+        self._version: int = 0
+        self._sub_version: int = 0
+        self._number_of_slots: int = 0
+        # True once the values above came from the device or the identity cache
+        self._identified: bool = False
+
+        self._notifier = StatusNotifier()
+        self._scheduler = PollScheduler(poll_interval, idle_poll_interval)
+        self._history: Optional[StatusHistory] = None
+        # Source of the receive times of status snapshots
+        self._clock: Callable[[], float] = time
+        # Actions started without waiting, which receive progress from status updates
+        self._actions_lock = Lock()
+        self._actions: List[ActionFuture] = []
+        self._tracer: Optional[Tracer] = None
+        self._publisher: Optional[StatusPublisher] = None
 
     @property
     def number_of_slots(self) -> int:
@@ -88,46 +83,41 @@ class Loader:  # pylint: disable=too-many-instance-attributes
     @property
     def is_cassette_present(self) -> bool:
         """Return True if a cassette is installed in the loader"""
-        return self.slot_state(self.number_of_slots + 1) == PayloadState.PRESENT
+        return self._current_snapshot().is_cassette_present
 
     @property
     def is_gripped(self) -> bool:
         """Return True if the gripper is full"""
-        return self._main_status.gripped_from_slot != 0
+        return self._current_snapshot().is_gripped
 
     @property
     def grip_state(self) -> PayloadState:
         """Return the payload state of the gripper"""
-        return self.slot_state(self.number_of_slots + 2)
+        return self._current_snapshot().grip_state
 
     @property
     def index_loaded(self) -> Optional[int]:
         """This indicates the slot number of the currently gripped payload, if any.
         It does not indicate if the payload is fully loaded into the microscope."""
-        slot = self._main_status.gripped_from_slot
-        if slot:
-            return slot
-
-        return None
+        return self._current_snapshot().index_loaded
 
     @property
     def is_homed(self) -> bool:
         """This indicates if the homing process has been completed so that
         the positions have been determined.  It does not indicate if the loader
         is presently at the home position."""
-        loader_homed: bool = self._loader_status.status & \
-            OverallSystemStatus.ABSOLUTE_POSITION_KNOWN
-        elevator_homed: bool = self._elevator_status.status & \
-            OverallSystemStatus.ABSOLUTE_POSITION_KNOWN
-        return loader_homed and elevator_homed
+        return self._current_snapshot().is_homed
 
     @property
     def last_error(self) -> Union[DeviceError, int]:
         """The latched last error code"""
-        try:
-            return DeviceError(self._main_status.last_error)
-        except IndexError:
-            return self._main_status.last_error
+        return self._current_snapshot().last_error
+
+    @property
+    def identified(self) -> bool:
+        """True once version, sub_version and number_of_slots are known, from the device
+        or from the identity cache"""
+        return self._identified
 
     @property
     def _loader_type(self) -> LoaderType:
@@ -135,24 +125,65 @@ class Loader:  # pylint: disable=too-many-instance-attributes
 
     def slot_state(self, slot_number: int) -> PayloadState:
         """Get the state of the given slot number: Present, Absent, or Unknown."""
-        state: bool = self._main_status.slot_state & (1 << slot_number-1) > 0
-        known: bool = self._main_status.slot_known & (1 << slot_number-1) > 0
-        if known:
-            if state:
-                return PayloadState.PRESENT
+        return self._current_snapshot().slot_state(slot_number)
 
-            return PayloadState.ABSENT
+    @property
+    def cassette(self) -> CassetteMap:
+        """State of every cassette slot as of the latest status update.  Use diff
+        between two maps to find the slots that changed."""
+        return self._current_snapshot().cassette
 
-        return PayloadState.UNKNOWN
+    @property
+    def current_action(self) -> str:
+        """Name of the action in progress, empty when idle"""
+        return self._current_snapshot().current_action
 
-    def get_version(self) -> Tuple[int, int, int]:
-        """ Get basic info from the device
-        returns:
-            version: Main version number  
-            sub_version: Sub version number
-            number_of_slots: Number of slots currently configured in the loader"""
+    def snapshot(self) -> StatusSnapshot:
+        """The latest status as one consistent, immutable object.  Use it to read
+        several properties from the same status frame."""
+        return self._current_snapshot()
 
-        response: bytearray = self._connection.command(LoaderCommand.GET_VERSION)
+    def _current_snapshot(self) -> StatusSnapshot:
+        return self._snapshot
+
+    @property
+    def missed_deadlines(self) -> int:
+        """Number of status polls that started late because the previous poll took
+        longer than the poll interval"""
+        return self._scheduler.missed_deadlines
+
+    @property
+    def history(self) -> Optional[StatusHistory]:
+        """Recent status samples, if enabled with enable_history"""
+        return self._history
+
+    def enable_history(self, capacity: int) -> StatusHistory:
+        """Keep the most recent capacity status samples of both axes and the
+        main status.  Requires NumPy."""
+        self._history = StatusHistory(capacity)
+        return self._history
+
+    def attach_publisher(self, publisher: Optional[StatusPublisher]):
+        """Publish every status update to other processes, which read it with
+        StatusReader.  Pass None to stop.  The publisher is not closed by the loader."""
+        self._publisher = publisher
+
+    def subscribe(self,
+                  callback: StatusCallback,
+                  fields: Optional[Iterable[StatusField]] = None,
+    ) -> int:
+        """Call back with a list of StatusChange whenever any of the given fields (or any
+        field, if none are given) changes between status updates.  Callbacks run on the
+        status update thread.
+            returns a handle for unsubscribe"""
+        return self._notifier.subscribe(callback, fields)
+
+    def unsubscribe(self, handle: int):
+        """Stop the callbacks of a subscription"""
+        self._notifier.unsubscribe(handle)
+
+    @staticmethod
+    def _parse_version(response: bytearray) -> Tuple[int, int, int]:
         version = int.from_bytes(
             response[RESPONSE_BODY_OFFSET:RESPONSE_BODY_OFFSET+2],
             "little",
@@ -168,34 +199,215 @@ class Loader:  # pylint: disable=too-many-instance-attributes
 
         return version, sub_version, number_of_slots
 
+    def _update_status(self, resp: bytearray):
+        decoding = perf_counter() if self._tracer is not None else None
+        elevator, loader, main = STATUS_CODECS[self._loader_type].decode(
+            resp,
+            RESPONSE_BODY_OFFSET,
+        )
+        self._apply_status(elevator, loader, main, resp, decoding)
+
+    def _apply_status(self,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                      elevator: AxisStatus,
+                      loader: AxisStatus,
+                      main: MainStatus,
+                      resp: Optional[bytearray],
+                      decoding: Optional[float]):
+        """Make a decoded status the latest.  It is published only if resp is given,
+        and traced only if decoding, the time decoding started, is given."""
+        tracer = self._tracer
+        snapshot = StatusSnapshot(elevator, loader, main, self._clock(), self._number_of_slots)
+        self._snapshot = snapshot
+        publisher = self._publisher
+        if publisher is not None and resp is not None:
+            publisher.publish(self._version, self._sub_version, self._number_of_slots,
+                              snapshot.timestamp, resp)
+        if tracer is not None and decoding is not None:
+            tracer.span(Span(
+                0, Stage.DECODE, LoaderCommand.GET_STATUS, "status", decoding, perf_counter()))
+
+        self._notifier.update(elevator, loader, main)
+        self._scheduler.observe(elevator, loader, main)
+        if self._history is not None:
+            self._history.append(snapshot.timestamp, elevator, loader, main)
+        if self._actions:
+            with self._actions_lock:
+                actions = list(self._actions)
+            for action in actions:
+                action.update_progress(snapshot)
+
+class Loader(BaseLoader):  # pylint: disable=too-many-instance-attributes
+    """Top-level class for accessing the autoloader.  Can be used as a context
+    manager to maintain the connection resources."""
+    def _updater(self):
+        while self._run_thread:
+            try:
+                if self._needs_identity():
+                    self._identify()
+                self._get_status()
+            except (DeviceException, OSError) as ex:
+                # A poll cancelled to send STOP says nothing about the device
+                if not isinstance(ex, DeviceException) or \
+                        ex.error_code != DeviceError.CANCELLED:
+                    # Retried with backoff until the device answers again
+                    _logger.warning("Status poll failed: %s", ex)
+                    self._scheduler.poll_failed()
+            except Exception:   # pylint: disable=broad-exception-caught
+                # Such as a failing subscriber, while the device is fine
+                _logger.exception("Status update failed")
+            self._scheduler.wait()
+
+    def __init__(self,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 address: str = "autoloader",
+                 fallback_address: str = "192.168.0.9",
+                 port: int = PORT_NUMBER,
+                 status_port: int = PORT_NUMBER_STATUS,
+                 poll_interval: float = FAST_POLL_INTERVAL,
+                 idle_poll_interval: float = IDLE_POLL_INTERVAL,
+                 recorder: Optional[TelemetryRecorder] = None,
+                 connection: Optional[LoaderConnection] = None,
+                 status_connection: Optional[LoaderConnection] = None,
+                 lazy: bool = False,
+                 identity_cache: Optional[IdentityCache] = None,
+                 pipelined: bool = False):
+        """Create a loader interface.  While the context is entered the status is
+        polled every poll_interval seconds during actions and motion, and every
+        idle_poll_interval seconds otherwise.  Frames are logged to recorder if given.
+        connection and status_connection replace the network connections, such as
+        for replaying a recorded session.
+
+        stop cancels a status poll in flight and is sent right away.  With pipelined,
+        both connections keep several requests in flight, each with a thread that reads
+        the responses, so actions started with the _async methods do not need a thread
+        of their own and stop is written without waiting for the poll.
+
+        The device is asked for its version and status before returning, unless lazy.
+        A lazy loader returns at once, takes the version from identity_cache (by default
+        one in the user's cache directory) and checks it in the background.  Without a
+        cached version, the first status update waits for the device instead."""
+        super().__init__(poll_interval, idle_poll_interval)
+
+        self._addresses = [address, fallback_address]
+        self._connection: LoaderConnection = (
+            connection if connection is not None
+            else LoaderConnection(self._addresses, port, pipelined=pipelined)
+        )
+        self._status_connection: LoaderConnection = (
+            status_connection if status_connection is not None
+            else LoaderConnection(self._addresses, status_port, pipelined=pipelined)
+        )
+        self._update_thread = Thread(target=self._updater, name="Update thread", daemon=True)
+        self._run_thread = False
+        self.attach_recorder(recorder)
+
+        self._identity_key = identity_key(address, fallback_address, port)
+        self._identity_cache = (
+            identity_cache if identity_cache is not None or not lazy else IdentityCache())
+        self._handshake: Optional["Future[None]"] = None
+        # True once the identity was read from the device rather than the cache
+        self._verified = False
+        if not lazy:
+            self._identify()
+            self._get_status()
+            return
+
+        cached = self._identity_cache.load(self._identity_key)
+        if cached is not None:
+            self._version, self._sub_version, self._number_of_slots = cached
+            self._identified = True
+        self._handshake = Future()
+        self._handshake.set_running_or_notify_cancel()
+        Thread(target=self._background_handshake, name="Handshake", daemon=True).start()
+
+    def __enter__(self):
+        self._run_thread = True
+        self._update_thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._run_thread = False
+        self._scheduler.wake()
+
+    @property
+    def handshake(self) -> Optional["Future[None]"]:
+        """For a lazy loader, a future that completes once the version and status have
+        been read from the device, or fails if it could not be reached.  None otherwise.
+        After a failure, the status updates retry the handshake until it succeeds."""
+        return self._handshake
+
+    def attach_recorder(self, recorder: Optional[TelemetryRecorder]):
+        """Log the raw frames on both connections to recorder, or stop logging if None.
+        The recorder is not closed by the loader."""
+        self._connection.attach_recorder(recorder, RecordChannel.COMMAND)
+        self._status_connection.attach_recorder(recorder, RecordChannel.STATUS)
+
+    def attach_tracer(self, tracer: Optional[Tracer]):
+        """Report the stages of every command, and the decoding of each status, to
+        tracer.  Pass None to stop tracing."""
+        self._tracer = tracer
+        for name, connection in (("command", self._connection),
+                                 ("status", self._status_connection)):
+            attach = getattr(connection, "attach_tracer", None)
+            if attach is not None:
+                attach(tracer, name)
+
+    @property
+    def metrics(self) -> Dict[str, LinkMetrics]:
+        """Traffic, failures and command latency of the "command" and "status"
+        connections, for those that keep metrics.  Pass to MetricsServer to serve them."""
+        links: Dict[str, LinkMetrics] = {}
+        for name, connection in (("command", self._connection),
+                                 ("status", self._status_connection)):
+            metrics = getattr(connection, "metrics", None)
+            if metrics is not None:
+                links[name] = metrics
+        return links
+
+    def get_version(self) -> Tuple[int, int, int]:
+        """ Get basic info from the device
+        returns:
+            version: Main version number  
+            sub_version: Sub version number
+            number_of_slots: Number of slots currently configured in the loader"""
+
+        response: bytearray = self._connection.command(LoaderCommand.GET_VERSION)
+        return self._parse_version(response)
+
     def home(self, axis: Axis = Axis.ALL, vacuum_safe: bool = True):
         """Initialize all motion axes, locating them with respect to their limit
         switches if necessary. Both axes are also moved to the home positions."""
-        self._connection.command(
-            LoaderCommand.HOME,
-            bytearray([axis, vacuum_safe]),
-            HOME_TIMEOUT
-        )
+        with self._scheduler.action():
+            self._connection.command(
+                LoaderCommand.HOME,
+                bytearray([axis, vacuum_safe]),
+                HOME_TIMEOUT
+            )
         self._get_status()
 
     def stop(self, signum = None, frame = None):    # pylint: disable=unused-argument
-        """Immediately stops loader motion/action
+        """Immediately stops loader motion/action.  STOP is sent ahead of any
+        status poll in progress.
         args:
             signum and frame so that this can be used
             as an OS signal handler
         """
-        self._status_connection.command(LoaderCommand.STOP)
+        priority_command = getattr(self._status_connection, "priority_command", None)
+        if priority_command is not None:
+            priority_command(LoaderCommand.STOP)
+        else:
+            self._status_connection.command(LoaderCommand.STOP)
 
     def load(self, slot_number: int):
         """Take whatever actions are necessary to place the sample in the provided slot
         into the imaging location.  The actions can include retracting and placing a sample
         already held in the gripper, picking the desired sample from its shelf, and extending
         to the imaging location."""
-        self._connection.command(
-            LoaderCommand.LOAD,
-            bytearray([slot_number]),
-            LOAD_TIMEOUT
-        )
+        with self._scheduler.action():
+            self._connection.command(
+                LoaderCommand.LOAD,
+                bytearray([slot_number]),
+                LOAD_TIMEOUT
+            )
 
     def load_cassette(self, vacuum_safe: bool = True):
         """Bring the system to a state where the user can remove and replace the sample cassette.
@@ -204,21 +416,55 @@ class Loader:  # pylint: disable=too-many-instance-attributes
         and lock the door and then cause this command to be issued a second time.  When this command
         is executed a second time, the load lock is locked and the cassette is mapped and made ready
         for use."""
-        self._connection.command(
-            LoaderCommand.LOAD_CASSETTE,
-            bytearray([vacuum_safe]),
-            LOAD_TIMEOUT
-        )
+        with self._scheduler.action():
+            self._connection.command(
+                LoaderCommand.LOAD_CASSETTE,
+                bytearray([vacuum_safe]),
+                LOAD_TIMEOUT
+            )
         self._get_status()
 
     def evac(self):
         """Retract from the imaging position to the evac position.  When in the evac position, this
         command will cause the loader to return/extend to the imaging position."""
-        self._connection.command(
-            LoaderCommand.EVAC,
-            timeout=EVAC_TIMEOUT
+        with self._scheduler.action():
+            self._connection.command(
+                LoaderCommand.EVAC,
+                timeout=EVAC_TIMEOUT
+            )
+
+    def home_async(self, axis: Axis = Axis.ALL, vacuum_safe: bool = True) -> ActionFuture:
+        """Start home without waiting for it to complete.
+            returns a future that resolves when the device responds"""
+        return self._start_action(
+            LoaderCommand.HOME,
+            bytearray([axis, vacuum_safe]),
+            HOME_TIMEOUT,
+        )
+
+    def load_async(self, slot_number: int) -> ActionFuture:
+        """Start load without waiting for it to complete.
+            returns a future that resolves when the device responds"""
+        return self._start_action(
+            LoaderCommand.LOAD,
+            bytearray([slot_number]),
+            LOAD_TIMEOUT,
         )
 
+    def load_cassette_async(self, vacuum_safe: bool = True) -> ActionFuture:
+        """Start load_cassette without waiting for it to complete.
+            returns a future that resolves when the device responds"""
+        return self._start_action(
+            LoaderCommand.LOAD_CASSETTE,
+            bytearray([vacuum_safe]),
+            LOAD_TIMEOUT,
+        )
+
+    def evac_async(self) -> ActionFuture:
+        """Start evac without waiting for it to complete.
+            returns a future that resolves when the device responds"""
+        return self._start_action(LoaderCommand.EVAC, None, EVAC_TIMEOUT)
+
     def clear_last_error(self):
         """Reset the latched last error code"""
         self._connection.command(LoaderCommand.CLEAR_LAST_ERROR)
@@ -235,10 +481,91 @@ class Loader:  # pylint: disable=too-many-instance-attributes
         )
         self._get_status()
 
+    def _start_action(self,
+                      cmd_type: LoaderCommand,
+                      msg: Optional[bytearray],
+                      timeout: float,
+    ) -> ActionFuture:
+        action = ActionFuture()
+        action.set_running_or_notify_cancel()
+        with self._actions_lock:
+            self._actions.append(action)
+        self._scheduler.begin_action()
+
+        try:
+            response = self._submit(cmd_type, msg, timeout)
+        except:
+            self._end_action(action)
+            raise
+
+        response.add_done_callback(lambda done: self._finish_action(action, done))
+        return action
+
+    def _submit(self,
+                cmd_type: LoaderCommand,
+                msg: Optional[bytearray],
+                timeout: float,
+    ) -> "Future[bytearray]":
+        if getattr(self._connection, "pipelined", False):
+            return self._connection.submit(cmd_type, msg, timeout)
+
+        # Connections that only block, such as replays, get a thread of their own
+        response: "Future[bytearray]" = Future()
+        response.set_running_or_notify_cancel()
+
+        def run():
+            try:
+                response.set_result(self._connection.command(cmd_type, msg, timeout))
+            except Exception as ex:   # pylint: disable=broad-exception-caught
+                response.set_exception(ex)
+
+        Thread(target=run, name="Action thread", daemon=True).start()
+        return response
+
+    def _finish_action(self, action: ActionFuture, response: "Future[bytearray]"):
+        self._end_action(action)
+        error = response.exception()
+        if error is not None:
+            action.set_exception(error)
+        else:
+            action.set_result(None)
+
+    def _end_action(self, action: ActionFuture):
+        with self._actions_lock:
+            self._actions.remove(action)
+        self._scheduler.end_action()
+        # Refresh the status right away, as the blocking commands do
+        self._scheduler.wake()
+
+    def _identify(self):
+        self._set_identity(DeviceIdentity(*self.get_version()))
+
+    def _set_identity(self, identity: DeviceIdentity):
+        self._version, self._sub_version, self._number_of_slots = identity
+        self._identified = True
+        self._verified = True
+        if self._identity_cache is not None:
+            self._identity_cache.store(self._identity_key, identity)
+
+    def _needs_identity(self) -> bool:
+        """True if the next poll must read the version first: it is not known, or it
+        came from the cache and the handshake failed"""
+        if not self._identified:
+            return True
+        return not self._verified and self._handshake is not None and self._handshake.done()
+
+    def _background_handshake(self):
+        try:
+            self._identify()
+            self._get_status()
+        except Exception as ex:   # pylint: disable=broad-exception-caught
+            self._handshake.set_exception(ex)
+        else:
+            self._handshake.set_result(None)
+
     def _get_status(self):
+        # Status frames can only be decoded once the version is known
+        if not self._identified:
+            self._identify()
         resp: bytearray = self._status_connection.command(LoaderCommand.GET_STATUS)
-        next_idx = RESPONSE_BODY_OFFSET
-
-        next_idx = self._elevator_status.unpack(resp, next_idx, self._loader_type)
-        next_idx = self._loader_status.unpack(resp, next_idx, self._loader_type)
-        next_idx = self._main_status.unpack(resp, next_idx)
+        self._update_status(resp)
@@ -1,9 +1,16 @@
 """Communication with autoloader using a binary protocol over TCP"""
+from concurrent.futures import Future
 from enum import IntEnum
-from typing import List, Optional
+from threading import BoundedSemaphore, Lock, Thread, local
+from time import perf_counter, time
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
 
-from newpro_autoloader.connection import Connection, DEFAULT_TIMEOUT
+from newpro_autoloader.connection import Connection, DEFAULT_TIMEOUT, FrameParser, SELECT_TIMEOUT
+from newpro_autoloader.crc import CRC_TABLE, calculate_crc, crc16, crc16_batch, np, right_align
 from newpro_autoloader.device_error import DeviceError, DeviceException
+from newpro_autoloader.metrics import LinkMetrics
+from newpro_autoloader.recorder import RecordChannel, RecordKind, TelemetryRecorder
+from newpro_autoloader.tracing import CommandTrace, Stage, Tracer
 
 START_SYMBOL1 = 0x1
 START_SYMBOL2 = 0xFE
@@ -19,8 +26,23 @@ RECEIVE_BLOCK_SIZE = 5
 RECEIVE_DATA_START_INDEX = 7
 MINIMUM_RESPONSE_LENGTH = 9
 
+# Start symbols and addressing before the body, checksum and end symbols after it
+FRAME_OVERHEAD = RECEIVE_DATA_START_INDEX + 4
+# Offset of the checksum from the end of a frame
+CRC_END_OFFSET = 4
+
+_START_SYMBOLS = bytes([START_SYMBOL1, START_SYMBOL2])
+
 COMMAND_CODE_INDEX = 0
 
+# Most requests outstanding at once in pipelined mode.  Message IDs cycle through 255
+# values, so a late response is recognised as stale unless its ID has been reused.
+MAX_IN_FLIGHT = 32
+
+# Seconds the reader thread of a pipelined connection waits for further requests
+# before it exits, so that regular polls do not start a thread each
+READER_LINGER = 5.0
+
 class LoaderCommand(IntEnum):
     """Autoloader command codes"""
     GET_VERSION = 0
@@ -33,22 +55,152 @@ class LoaderCommand(IntEnum):
     EVAC = 22
     CLEAR_LAST_ERROR = 23
 
-class LoaderConnection:     # pylint: disable=too-few-public-methods
+class PendingRequest(NamedTuple):
+    """A request sent and waiting for its response"""
+    future: "Future[bytearray]"
+    cmd_type: "LoaderCommand"
+    deadline: float
+    started: float
+    trace: Optional[CommandTrace] = None
+    # Holds one of the places for requests in flight, which priority requests do not need
+    limited: bool = True
+
+class RequestTracker:   # pylint: disable=too-many-instance-attributes
+    """Bookkeeping shared by the connections that match responses to requests by
+    message ID: message IDs, metrics, recording and tracing, and the completion of
+    the future of each request"""
+
+    def __init__(self):
+        self._metrics = LinkMetrics()
+        self._device_address: int = 1
+        self._host_address: int = 0
+        self._message_id: int = 0
+        self._recorder: Optional[TelemetryRecorder] = None
+        self._channel: RecordChannel = RecordChannel.COMMAND
+        self._tracer: Optional[Tracer] = None
+        self._link: str = "command"
+        self._stale_responses: int = 0
+        self._pending: Dict[int, PendingRequest] = {}
+
+    @property
+    def stale_responses(self) -> int:
+        """Number of responses discarded because they did not answer a pending request,
+        such as late responses to requests that timed out"""
+        return self._stale_responses
+
+    @property
+    def metrics(self) -> LinkMetrics:
+        """Traffic, failures and command latency of the connection"""
+        return self._metrics
+
+    def attach_recorder(self,
+                        recorder: Optional[TelemetryRecorder],
+                        channel: RecordChannel = RecordChannel.COMMAND):
+        """Record the raw frames of every command and response, except the GetStatus
+        requests which never change.  Pass None to stop recording."""
+        self._recorder = recorder
+        self._channel = channel
+
+    def attach_tracer(self, tracer: Optional[Tracer], link: str = "command"):
+        """Report the stages of each command to tracer, naming the connection link.
+        Pass None to stop tracing."""
+        self._tracer = tracer
+        self._link = link
+
+    def _start_trace(self, cmd_type: "LoaderCommand") -> Optional[CommandTrace]:
+        tracer = self._tracer
+        if tracer is None:
+            return None
+        return CommandTrace(tracer, cmd_type, self._link)
+
+    def _complete(self, frame: bytearray, first_byte: float):
+        """Validate a response, whose first bytes arrived at first_byte, and complete
+        the future of the request it answers"""
+        request = self._take_request(response_message_id(frame))
+        if request is None:
+            self._discard_stale()
+            return
+
+        if self._recorder is not None:
+            self._recorder.record(self._channel, RecordKind.RESPONSE, frame)
+        validating = perf_counter()
+        trace = request.trace
+        if trace is not None:
+            # The response can arrive before the sending thread reports the send
+            sent = min(request.started if trace.sent is None else trace.sent, first_byte)
+            trace(Stage.FIRST_BYTE, sent, first_byte)
+            trace(Stage.REASSEMBLY, first_byte, validating)
+        try:
+            body = parse_response(frame, request.cmd_type)
+        except DeviceException as ex:
+            self._fail_request(request, ex)
+            return
+
+        self._release(request)
+        self._metrics.record_latency(request.cmd_type, perf_counter() - request.started)
+        if request.trace is not None:
+            request.trace(Stage.VALIDATE, validating, perf_counter())
+            request.trace.end()
+        request.future.set_result(body)
+
+    def _fail_request(self, request: PendingRequest, error: Exception):
+        self._release(request)
+        if isinstance(error, DeviceException):
+            self._metrics.record_error(error.error_code)
+        if request.trace is not None:
+            request.trace.end(error)
+        request.future.set_exception(error)
+
+    def _take_request(self, message_id: int) -> Optional[PendingRequest]:
+        return self._pending.pop(message_id, None)
+
+    def _discard_stale(self):
+        """Count a response that answers no pending request"""
+        self._stale_responses += 1
+
+    def _release(self, request: PendingRequest):
+        """Give back what request held while in flight, once it completes"""
+
+    def _next_message_id(self) -> int:
+        self._message_id = next_message_id(self._message_id)
+        return self._message_id
+
+class LoaderConnection(RequestTracker):     # pylint: disable=too-many-instance-attributes
     """Connects to the autoloader and manages formatting of commands and parsing
-    of responses"""
+    of responses.  Responses are matched to requests by message ID, and frames that
+    answer an earlier request are discarded.  In pipelined mode several requests can
+    be outstanding at once, and a reader thread completes their futures."""
 
-    def __init__(self, address: List[str], port: int):
+    def __init__(self,
+                 address: List[str],
+                 port: int,
+                 pipelined: bool = False,
+                 max_in_flight: int = MAX_IN_FLIGHT):
         """Create a loader connection.  Does not try to connect until
         a command is sent."""
+        if not 0 < max_in_flight < 255:
+            raise ValueError("Requests in flight must leave message IDs free")
 
+        super().__init__()
         self._connection: Connection = Connection(
             address,
             port,
             bytearray([END_SYMBOL1, END_SYMBOL2]),
+            LoaderFrameParser(),
+            self._metrics,
         )
-        self._device_address: int = 1
-        self._host_address: int = 0
-        self._message_id: int = 0
+        # A CommandEncoder per thread, as encoded frames are reused
+        self._encoders = local()
+
+        self._pipelined = pipelined
+        self._lock = Lock()
+        self._in_flight = BoundedSemaphore(max_in_flight)
+        self._reader: Optional[Thread] = None
+
+    @property
+    def pipelined(self) -> bool:
+        """True if requests are sent without waiting for earlier responses"""
+        return self._pipelined
 
     def command(self,
              cmd_type: LoaderCommand,
@@ -56,125 +208,424 @@ class LoaderConnection:     # pylint: disable=too-few-public-methods
              timeout: float = DEFAULT_TIMEOUT,
     ) -> bytearray:
         """Send a command and receive the response"""
+        return self._command(cmd_type, msg, timeout, False)
 
-        if self._message_id >= 255:
-            self._message_id = 1
-        else:
-            self._message_id += 1
+    def _command(self,
+                 cmd_type: LoaderCommand,
+                 msg: Optional[bytearray],
+                 timeout: float,
+                 priority: bool,
+    ) -> bytearray:
+        if self._pipelined:
+            return self.submit(cmd_type, msg, timeout, priority).result()
+
+        with self._lock:
+            message_id = self._next_message_id()
+        trace = self._start_trace(cmd_type)
+        cmd = self._encoder().encode(cmd_type, msg, message_id)
+        if trace is not None:
+            trace(Stage.BUILD, trace.start, perf_counter())
+        recorder = self._recorder
+        if recorder is not None and cmd_type != LoaderCommand.GET_STATUS:
+            recorder.record(self._channel, RecordKind.REQUEST, cmd)
+
+        started = perf_counter()
+        try:
+            resp = self._connection.send(
+                cmd,
+                timeout,
+                lambda frame: self._is_response(frame, message_id),
+                trace,
+                priority,
+            )
+            if recorder is not None:
+                recorder.record(self._channel, RecordKind.RESPONSE, resp)
+
+            validating = perf_counter()
+            body = parse_response(resp, cmd_type)
+        except Exception as ex:
+            if isinstance(ex, DeviceException):
+                self._metrics.record_error(ex.error_code)
+            if trace is not None:
+                trace.end(ex)
+            raise
 
-        # Add one for the command code
-        msg_len = 1 if msg is None else len(msg) + 1
+        self._metrics.record_latency(cmd_type, perf_counter() - started)
+        if trace is not None:
+            trace(Stage.VALIDATE, validating, perf_counter())
+            trace.end()
+        return body
 
-        cmd: bytearray = bytearray()
-        cmd.append(self._device_address)
-        cmd.append(self._host_address)
-        cmd.append(self._message_id)
-        cmd.extend(msg_len.to_bytes(2, "little"))
-        cmd.append(cmd_type)
-        if msg is not None:
-            cmd.extend(msg)
-        cmd.extend(calculate_crc(cmd))
-        cmd = bytearray([START_SYMBOL1, START_SYMBOL2]) + cmd
-        cmd.extend([END_SYMBOL1, END_SYMBOL2])
+    def priority_command(self,
+                         cmd_type: LoaderCommand,
+                         msg: Optional[bytearray] = None,
+                         timeout: float = DEFAULT_TIMEOUT,
+    ) -> bytearray:
+        """Send a command ahead of everything else, such as STOP.  In pipelined mode it
+        is written right away, without waiting for requests in flight.  Otherwise a
+        command waiting for its response is cancelled to free the connection, which
+        stays open, and the late response to it is discarded.  Commands that would take
+        the connection first are cancelled too."""
+        return self._command(cmd_type, msg, timeout, True)
 
-        resp = self._connection.send(cmd, timeout)
-        resp_len = len(resp)
+    def submit(self,
+               cmd_type: LoaderCommand,
+               msg: Optional[bytearray] = None,
+               timeout: float = DEFAULT_TIMEOUT,
+               priority: bool = False,
+    ) -> "Future[bytearray]":
+        """Send a command without waiting for the response.  Requires pipelined mode.
+        Waits if max_in_flight requests are already outstanding, unless priority.
+            returns a future for the message body, or for the DeviceException"""
+        if not self._pipelined:
+            raise RuntimeError("submit requires a pipelined LoaderConnection")
 
-        if resp is None or resp_len < MINIMUM_RESPONSE_LENGTH:
-            raise DeviceException(DeviceError.INVALID_RESPONSE_LENGTH)
+        if not priority:
+            # The semaphore is released when the request completes, on the reader thread
+            if not self._in_flight.acquire(timeout=timeout):  # pylint: disable=consider-using-with
+                self._metrics.record_error(DeviceError.TIMEOUT)
+                raise DeviceException(DeviceError.TIMEOUT)
 
-        if (resp[RECEIVE_START_SYMBOL1_INDEX] != START_SYMBOL1 or
-            resp[RECEIVE_START_SYMBOL2_INDEX] != START_SYMBOL2):
-            raise DeviceException(DeviceError.INVALID_START_BYTE)
+        future: "Future[bytearray]" = Future()
+        future.set_running_or_notify_cancel()
+        trace = self._start_trace(cmd_type)
+        with self._lock:
+            if trace is not None:
+                trace(Stage.LOCK_WAIT, trace.start, perf_counter())
+            message_id = self._next_message_id()
+            while message_id in self._pending:
+                message_id = self._next_message_id()
 
-        # Remove the end chars and crc
-        resp_body = resp[RECEIVE_TO_ID_INDEX:resp_len-4]
-        crc_low_byte, crc_high_byte = calculate_crc(resp_body)
-        if crc_low_byte != resp[resp_len-4] or crc_high_byte != resp[resp_len-3]:
-            raise DeviceException(DeviceError.INVALID_CRC)
+            try:
+                building = perf_counter()
+                cmd = self._encoder().encode(cmd_type, msg, message_id)
+                if trace is not None:
+                    trace(Stage.BUILD, building, perf_counter())
+                self._pending[message_id] = PendingRequest(
+                    future, cmd_type, time() + timeout, perf_counter(), trace, not priority)
+                if self._recorder is not None and cmd_type != LoaderCommand.GET_STATUS:
+                    self._recorder.record(self._channel, RecordKind.REQUEST, cmd)
+                self._connection.write(cmd, trace)
+            except Exception as ex:
+                self._pending.pop(message_id, None)
+                if not priority:
+                    self._in_flight.release()
+                if trace is not None:
+                    trace.end(ex)
+                raise
 
-        body_len = int.from_bytes(resp[RECEIVE_BLOCK_SIZE:RECEIVE_BLOCK_SIZE+2], "little")
+            if self._reader is None:
+                self._reader = Thread(
+                    target=self._read_responses,
+                    args=(self._connection.cancellable(),),
+                    name="Response reader",
+                    daemon=True,
+                )
+                self._reader.start()
 
-        message_body: bytearray = resp[RECEIVE_DATA_START_INDEX:RECEIVE_DATA_START_INDEX+body_len]
-        if message_body[COMMAND_CODE_INDEX] != int(cmd_type):
-            raise DeviceException(DeviceError.INVALID_RESPONSE_DATA_TYPE)
+        return future
 
+    def cancel(self):
+        """Interrupt the commands sent or waiting to be sent, which fail with CANCELLED"""
+        self._connection.cancel()
+
+    def close(self):
+        """Close the connection.  Outstanding requests fail."""
+        self._connection.close()
+
+    def _encoder(self) -> "CommandEncoder":
+        encoder = getattr(self._encoders, "encoder", None)
+        if encoder is None:
+            encoder = self._encoders.encoder = CommandEncoder(
+                self._device_address, self._host_address)
+        return encoder
+
+    def _is_response(self, frame: bytearray, message_id: int) -> bool:
+        if response_message_id(frame) == message_id:
+            return True
+
+        self._discard_stale()
+        return False
+
+    def _read_responses(self, ticket: int):
+        error: Exception = DeviceException(DeviceError.NETWORK_READ_FAILED)
+        idle_until: Optional[float] = None
         try:
-            code: DeviceError = DeviceError(message_body[COMMAND_CODE_INDEX+1])
-        except IndexError:
-            code = DeviceError.UNKNOWN
-
-        if code != DeviceError.NO_ERROR:
-            raise DeviceException(code)
-
-        return message_body
-
-
-CrcL = [0x0, 0x89, 0x12, 0x9B, 0x24, 0xAD, 0x36, 0xBF, 0x48, 0xC1,
-        0x5A, 0xD3, 0x6C, 0xE5, 0x7E, 0xF7, 0x81, 0x8, 0x93, 0x1A,
-        0xA5, 0x2C, 0xB7, 0x3E, 0xC9, 0x40, 0xDB, 0x52, 0xED, 0x64,
-        0xFF, 0x76, 0x2, 0x8B, 0x10, 0x99, 0x26, 0xAF, 0x34, 0xBD,
-        0x4A, 0xC3, 0x58, 0xD1, 0x6E, 0xE7, 0x7C, 0xF5, 0x83, 0xA,
-        0x91, 0x18, 0xA7, 0x2E, 0xB5, 0x3C, 0xCB, 0x42, 0xD9, 0x50,
-        0xEF, 0x66, 0xFD, 0x74, 0x4, 0x8D, 0x16, 0x9F, 0x20, 0xA9,
-        0x32, 0xBB, 0x4C, 0xC5, 0x5E, 0xD7, 0x68, 0xE1, 0x7A, 0xF3,
-        0x85, 0xC, 0x97, 0x1E, 0xA1, 0x28, 0xB3, 0x3A, 0xCD, 0x44,
-        0xDF, 0x56, 0xE9, 0x60, 0xFB, 0x72, 0x6, 0x8F, 0x14, 0x9D,
-        0x22, 0xAB, 0x30, 0xB9, 0x4E, 0xC7, 0x5C, 0xD5, 0x6A, 0xE3,
-        0x78, 0xF1, 0x87, 0xE, 0x95, 0x1C, 0xA3, 0x2A, 0xB1, 0x38,
-        0xCF, 0x46, 0xDD, 0x54, 0xEB, 0x62, 0xF9, 0x70, 0x8, 0x81,
-        0x1A, 0x93, 0x2C, 0xA5, 0x3E, 0xB7, 0x40, 0xC9, 0x52, 0xDB,
-        0x64, 0xED, 0x76, 0xFF, 0x89, 0x0, 0x9B, 0x12, 0xAD, 0x24,
-        0xBF, 0x36, 0xC1, 0x48, 0xD3, 0x5A, 0xE5, 0x6C, 0xF7, 0x7E,
-        0xA, 0x83, 0x18, 0x91, 0x2E, 0xA7, 0x3C, 0xB5, 0x42, 0xCB,
-        0x50, 0xD9, 0x66, 0xEF, 0x74, 0xFD, 0x8B, 0x2, 0x99, 0x10,
-        0xAF, 0x26, 0xBD, 0x34, 0xC3, 0x4A, 0xD1, 0x58, 0xE7, 0x6E,
-        0xF5, 0x7C, 0xC, 0x85, 0x1E, 0x97, 0x28, 0xA1, 0x3A, 0xB3,
-        0x44, 0xCD, 0x56, 0xDF, 0x60, 0xE9, 0x72, 0xFB, 0x8D, 0x4,
-        0x9F, 0x16, 0xA9, 0x20, 0xBB, 0x32, 0xC5, 0x4C, 0xD7, 0x5E,
-        0xE1, 0x68, 0xF3, 0x7A, 0xE, 0x87, 0x1C, 0x95, 0x2A, 0xA3,
-        0x38, 0xB1, 0x46, 0xCF, 0x54, 0xDD, 0x62, 0xEB, 0x70, 0xF9,
-        0x8F, 0x6, 0x9D, 0x14, 0xAB, 0x22, 0xB9, 0x30, 0xC7, 0x4E,
-        0xD5, 0x5C, 0xE3, 0x6A, 0xF1, 0x78]
-
-CrcH = [0x0, 0x11, 0x23, 0x32, 0x46, 0x57, 0x65, 0x74, 0x8C, 0x9D,
-        0xAF, 0xBE, 0xCA, 0xDB, 0xE9, 0xF8, 0x10, 0x1, 0x33, 0x22,
-        0x56, 0x47, 0x75, 0x64, 0x9C, 0x8D, 0xBF, 0xAE, 0xDA, 0xCB,
-        0xF9, 0xE8, 0x21, 0x30, 0x2, 0x13, 0x67, 0x76, 0x44, 0x55,
-        0xAD, 0xBC, 0x8E, 0x9F, 0xEB, 0xFA, 0xC8, 0xD9, 0x31, 0x20,
-        0x12, 0x3, 0x77, 0x66, 0x54, 0x45, 0xBD, 0xAC, 0x9E, 0x8F,
-        0xFB, 0xEA, 0xD8, 0xC9, 0x42, 0x53, 0x61, 0x70, 0x4, 0x15,
-        0x27, 0x36, 0xCE, 0xDF, 0xED, 0xFC, 0x88, 0x99, 0xAB, 0xBA,
-        0x52, 0x43, 0x71, 0x60, 0x14, 0x5, 0x37, 0x26, 0xDE, 0xCF,
-        0xFD, 0xEC, 0x98, 0x89, 0xBB, 0xAA, 0x63, 0x72, 0x40, 0x51,
-        0x25, 0x34, 0x6, 0x17, 0xEF, 0xFE, 0xCC, 0xDD, 0xA9, 0xB8,
-        0x8A, 0x9B, 0x73, 0x62, 0x50, 0x41, 0x35, 0x24, 0x16, 0x7,
-        0xFF, 0xEE, 0xDC, 0xCD, 0xB9, 0xA8, 0x9A, 0x8B, 0x84, 0x95,
-        0xA7, 0xB6, 0xC2, 0xD3, 0xE1, 0xF0, 0x8, 0x19, 0x2B, 0x3A,
-        0x4E, 0x5F, 0x6D, 0x7C, 0x94, 0x85, 0xB7, 0xA6, 0xD2, 0xC3,
-        0xF1, 0xE0, 0x18, 0x9, 0x3B, 0x2A, 0x5E, 0x4F, 0x7D, 0x6C,
-        0xA5, 0xB4, 0x86, 0x97, 0xE3, 0xF2, 0xC0, 0xD1, 0x29, 0x38,
-        0xA, 0x1B, 0x6F, 0x7E, 0x4C, 0x5D, 0xB5, 0xA4, 0x96, 0x87,
-        0xF3, 0xE2, 0xD0, 0xC1, 0x39, 0x28, 0x1A, 0xB, 0x7F, 0x6E,
-        0x5C, 0x4D, 0xC6, 0xD7, 0xE5, 0xF4, 0x80, 0x91, 0xA3, 0xB2,
-        0x4A, 0x5B, 0x69, 0x78, 0xC, 0x1D, 0x2F, 0x3E, 0xD6, 0xC7,
-        0xF5, 0xE4, 0x90, 0x81, 0xB3, 0xA2, 0x5A, 0x4B, 0x79, 0x68,
-        0x1C, 0xD, 0x3F, 0x2E, 0xE7, 0xF6, 0xC4, 0xD5, 0xA1, 0xB0,
-        0x82, 0x93, 0x6B, 0x7A, 0x48, 0x59, 0x2D, 0x3C, 0xE, 0x1F,
-        0xF7, 0xE6, 0xD4, 0xC5, 0xB1, 0xA0, 0x92, 0x83, 0x7B, 0x6A,
-        0x58, 0x49, 0x3D, 0x2C, 0x1E, 0xF]
-
-def calculate_crc(data: bytearray) -> bytearray:
-    """Calculate the checksum bytes (2) for the message to/from the device.
-        data: message data
-
-        returns 2 checksum bytes"""
-
-    crc_low_byte = 0
-    crc_high_byte = 0
-    for datum in data:
-        table_index = crc_low_byte ^ datum
-        crc_low_byte = CrcL[table_index] ^ crc_high_byte
-        crc_high_byte = CrcH[table_index]
-
-    return bytearray([crc_low_byte, crc_high_byte])
+            while True:
+                with self._lock:
+                    wait = self._expire_pending()
+                    if wait is not None:
+                        idle_until = None
+                    else:
+                        now = time()
+                        if idle_until is None:
+                            idle_until = now + READER_LINGER
+                        elif now >= idle_until:
+                            self._reader = None
+                            return
+                        wait = idle_until - now
+
+                frame = self._connection.receive(min(wait, SELECT_TIMEOUT), ticket)
+                if frame is not None:
+                    self._complete(frame, self._connection.first_byte)
+
+        except Exception as ex:   # pylint: disable=broad-exception-caught
+            error = ex
+
+        with self._lock:
+            self._reader = None
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for request in pending:
+            self._fail_request(request, error)
+
+    def _expire_pending(self) -> Optional[float]:
+        """Fail the requests past their deadline.
+            returns the time until the next deadline, or None if nothing is pending"""
+        now = time()
+        wait: Optional[float] = None
+        for message_id, request in list(self._pending.items()):
+            if request.deadline <= now:
+                del self._pending[message_id]
+                self._fail_request(request, DeviceException(DeviceError.TIMEOUT))
+            elif wait is None or request.deadline - now < wait:
+                wait = request.deadline - now
+
+        return wait
+
+    def _take_request(self, message_id: int) -> Optional[PendingRequest]:
+        with self._lock:
+            return self._pending.pop(message_id, None)
+
+    def _discard_stale(self):
+        # Counted on the reader thread and on the threads sending commands
+        with self._lock:
+            self._stale_responses += 1
+
+    def _release(self, request: PendingRequest):
+        if request.limited:
+            self._in_flight.release()
+
+
+class LoaderFrameParser(FrameParser):
+    """Splits the received stream using the length field of each frame header, so a
+    terminator sequence inside binary data does not end a frame early.  Bytes that
+    cannot start a frame are skipped to resynchronize on the next start symbols."""
+
+    def __init__(self):
+        super().__init__(bytearray([END_SYMBOL1, END_SYMBOL2]))
+
+    def _split(self):
+        buffer = self._buffer
+        while True:
+            start = self._start
+            available = self._end - start
+            if available < RECEIVE_DATA_START_INDEX:
+                return
+
+            if (buffer[start + RECEIVE_START_SYMBOL1_INDEX] != START_SYMBOL1 or
+                buffer[start + RECEIVE_START_SYMBOL2_INDEX] != START_SYMBOL2):
+                self._skip_to_start_symbols()
+                continue
+
+            body_len = (buffer[start + RECEIVE_BLOCK_SIZE] |
+                        buffer[start + RECEIVE_BLOCK_SIZE + 1] << 8)
+            total = body_len + FRAME_OVERHEAD
+            if available < total:
+                return
+
+            if buffer[start + total - 2] != END_SYMBOL1 or buffer[start + total - 1] != END_SYMBOL2:
+                # Not a real frame start, the length came from other data
+                self._start = start + 1
+                self._skip_to_start_symbols()
+                continue
+
+            self._emit(start + total)
+
+    def _skip_to_start_symbols(self):
+        idx = self._buffer.find(_START_SYMBOLS, self._start, self._end)
+        if idx == -1:
+            # Keep a trailing first start symbol, the second may be in the next receive
+            idx = self._end
+            if self._end > self._start and self._buffer[self._end - 1] == START_SYMBOL1:
+                idx -= 1
+        self._start = self._scan = idx
+
+def next_message_id(message_id: int) -> int:
+    """Message ID following message_id, cycling through 1 to 255"""
+    return 1 if message_id >= 255 else message_id + 1
+
+def build_command(cmd_type: LoaderCommand,
+                  msg: Optional[bytearray],
+                  message_id: int,
+                  device_address: int = 1,
+                  host_address: int = 0,
+) -> bytearray:
+    """Format a complete command frame, including start/end symbols and checksum"""
+
+    body: bytearray = bytearray([cmd_type])
+    if msg is not None:
+        body.extend(msg)
+
+    return build_frame(device_address, host_address, message_id, body)
+
+def build_frame(to_id: int, from_id: int, message_id: int, body: bytearray) -> bytearray:
+    """Format a frame in either direction around a message body, which starts with
+    the command code"""
+
+    # Sized once, so that nothing is copied to prepend the start symbols
+    frame: bytearray = bytearray(FRAME_OVERHEAD + len(body))
+    frame[RECEIVE_START_SYMBOL1_INDEX] = START_SYMBOL1
+    frame[RECEIVE_START_SYMBOL2_INDEX] = START_SYMBOL2
+    frame[RECEIVE_TO_ID_INDEX] = to_id
+    frame[RECEIVE_FROM_ID_INDEX] = from_id
+    frame[RECEIVE_BLOCK_NUMBER_INDEX] = message_id
+    frame[RECEIVE_BLOCK_SIZE:RECEIVE_DATA_START_INDEX] = len(body).to_bytes(2, "little")
+    frame[RECEIVE_DATA_START_INDEX:-CRC_END_OFFSET] = body
+    crc = crc16(bytes(frame[RECEIVE_TO_ID_INDEX:-CRC_END_OFFSET]))
+    frame[-CRC_END_OFFSET] = crc & 0xFF
+    frame[-CRC_END_OFFSET + 1] = crc >> 8
+    frame[-2] = END_SYMBOL1
+    frame[-1] = END_SYMBOL2
+
+    return frame
+
+class _FrameTemplate(NamedTuple):
+    """Reusable frame of one command code and body length.  The frame and checksums
+    are updated in place."""
+    frame: bytearray
+    crc_index: int
+    # Checksum for each message ID, filled in on first use, if the body never changes
+    crcs: Optional[List[int]]
+
+def _frame_template(to_id: int, from_id: int, body: bytearray, cached: bool) -> _FrameTemplate:
+    frame = build_frame(to_id, from_id, 0, body)
+    return _FrameTemplate(frame, len(frame) - CRC_END_OFFSET, [-1] * 256 if cached else None)
+
+class CommandEncoder:   # pylint: disable=too-few-public-methods
+    """Encodes command frames into reusable buffers, with a template per command code
+    and body length.  Only the message ID and arguments are patched in, and the
+    checksum resumes from the state after the addresses, so a steady stream of
+    GetStatus polls allocates nothing.  A returned frame is overwritten by the next
+    encode of the same command and must be sent first, so each thread needs its
+    own encoder."""
+
+    def __init__(self, device_address: int = 1, host_address: int = 0):
+        self._device_address = device_address
+        self._host_address = host_address
+        # Checksum state after the addresses, which are the same in every frame
+        self._prefix_state: int = crc16(bytes([device_address, host_address]))
+        # Commands without arguments, indexed by command code
+        self._fixed: List[Optional[_FrameTemplate]] = [None] * 256
+        self._templates: Dict[Tuple[int, int], _FrameTemplate] = {}
+
+    def encode(self,
+               cmd_type: LoaderCommand,
+               msg: Optional[bytearray],
+               message_id: int,
+    ) -> bytearray:
+        """Format a complete command frame, as build_command does"""
+        if msg:
+            template = self._templates.get((cmd_type, len(msg)))
+            if template is None:
+                template = self._templates[(cmd_type, len(msg))] = _frame_template(
+                    self._device_address, self._host_address,
+                    bytearray([cmd_type]) + msg, False)
+            template.frame[RECEIVE_DATA_START_INDEX + 1:template.crc_index] = msg
+        else:
+            template = self._fixed[cmd_type]
+            if template is None:
+                template = self._fixed[cmd_type] = _frame_template(
+                    self._device_address, self._host_address, bytearray([cmd_type]), True)
+
+        frame = template.frame
+        frame[RECEIVE_BLOCK_NUMBER_INDEX] = message_id
+        crcs = template.crcs
+        crc = crcs[message_id] if crcs is not None else -1
+        if crc < 0:
+            crc = self._prefix_state
+            table = CRC_TABLE
+            for index in range(RECEIVE_BLOCK_NUMBER_INDEX, template.crc_index):
+                crc = table[(crc ^ frame[index]) & 0xFF] ^ (crc >> 8)
+            if crcs is not None:
+                crcs[message_id] = crc
+
+        frame[template.crc_index] = crc & 0xFF
+        frame[template.crc_index + 1] = crc >> 8
+        return frame
+
+def response_message_id(resp: bytearray) -> Optional[int]:
+    """Message ID of a response frame, which echoes the ID of its request"""
+    if len(resp) > RECEIVE_BLOCK_NUMBER_INDEX:
+        return resp[RECEIVE_BLOCK_NUMBER_INDEX]
+    return None
+
+def parse_response(resp: bytearray, cmd_type: LoaderCommand) -> bytearray:
+    """Validate a complete response frame and return the message body, which starts
+    with the command code and the device error code"""
+
+    if resp is None or len(resp) < MINIMUM_RESPONSE_LENGTH:
+        raise DeviceException(DeviceError.INVALID_RESPONSE_LENGTH)
+
+    resp_len = len(resp)
+
+    if (resp[RECEIVE_START_SYMBOL1_INDEX] != START_SYMBOL1 or
+        resp[RECEIVE_START_SYMBOL2_INDEX] != START_SYMBOL2):
+        raise DeviceException(DeviceError.INVALID_START_BYTE)
+
+    # Remove the end chars and crc
+    resp_body = resp[RECEIVE_TO_ID_INDEX:resp_len-4]
+    crc_low_byte, crc_high_byte = calculate_crc(resp_body)
+    if crc_low_byte != resp[resp_len-4] or crc_high_byte != resp[resp_len-3]:
+        raise DeviceException(DeviceError.INVALID_CRC)
+
+    body_len = int.from_bytes(resp[RECEIVE_BLOCK_SIZE:RECEIVE_BLOCK_SIZE+2], "little")
+
+    message_body: bytearray = resp[RECEIVE_DATA_START_INDEX:RECEIVE_DATA_START_INDEX+body_len]
+    if message_body[COMMAND_CODE_INDEX] != int(cmd_type):
+        raise DeviceException(DeviceError.INVALID_RESPONSE_DATA_TYPE)
+
+    try:
+        code: DeviceError = DeviceError(message_body[COMMAND_CODE_INDEX+1])
+    except IndexError:
+        code = DeviceError.UNKNOWN
+
+    if code != DeviceError.NO_ERROR:
+        raise DeviceException(code)
+
+    return message_body
+
+def validate_frames(frames: Sequence[bytes]) -> "np.ndarray":
+    """Check the start and end symbols, length field and checksum of many recorded
+    frames at once with NumPy.
+        returns a boolean array, True for each valid frame"""
+
+    matrix, lengths = right_align(frames)
+    if matrix.shape[1] < FRAME_OVERHEAD:
+        return np.zeros(len(frames), dtype=bool)
+
+    width = matrix.shape[1]
+    rows = np.arange(len(frames))
+    valid = lengths >= max(MINIMUM_RESPONSE_LENGTH, FRAME_OVERHEAD)
+    # Short frames are rejected above, keep their header lookups inside the matrix
+    start = np.where(valid, width - lengths, 0)
+
+    def column(index: int) -> "np.ndarray":
+        return matrix[rows, np.minimum(start + index, width - 1)]
+
+    valid &= column(RECEIVE_START_SYMBOL1_INDEX) == START_SYMBOL1
+    valid &= column(RECEIVE_START_SYMBOL2_INDEX) == START_SYMBOL2
+    valid &= matrix[:, -2] == END_SYMBOL1
+    valid &= matrix[:, -1] == END_SYMBOL2
+
+    body_len = column(RECEIVE_BLOCK_SIZE).astype(np.int64) | \
+        column(RECEIVE_BLOCK_SIZE + 1).astype(np.int64) << 8
+    valid &= lengths == body_len + FRAME_OVERHEAD
+
+    # The start symbols are not part of the checksum, and as leading zeros they have no
+    # effect on it.  The checksum of a message followed by its own checksum is zero.
+    matrix[rows, start + RECEIVE_START_SYMBOL1_INDEX] = 0
+    matrix[rows, np.minimum(start + RECEIVE_START_SYMBOL2_INDEX, width - 1)] = 0
+    valid &= crc16_batch(matrix[:, :-2]) == 0
+
+    return valid
@@ -0,0 +1,283 @@
+"""Counters and latency histograms of the connections to the autoloader, with an
+optional local HTTP endpoint in the Prometheus text format"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Mapping, Optional, Tuple, Union
+
+from newpro_autoloader.device_error import DeviceError
+
+# Each power of two of microseconds is split into this many buckets, so a recorded
+# latency is within 1/SUB_BUCKETS of the bound of its bucket
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Latencies up to 2**MAX_EXPONENT microseconds, about 18 minutes, are told apart
+MAX_EXPONENT = 30
+BUCKET_COUNT = (MAX_EXPONENT - SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+
+# Range of the bucket bounds exported to Prometheus, in powers of two of microseconds
+EXPORT_MIN_EXPONENT = 6
+EXPORT_MAX_EXPONENT = 25
+
+MetricsSource = Union[Mapping[str, "LinkMetrics"], Callable[[], Mapping[str, "LinkMetrics"]]]
+
+def _bucket_index(microseconds: int) -> int:
+    if microseconds < 2 * SUB_BUCKETS:
+        return microseconds
+    shift = microseconds.bit_length() - SUB_BUCKET_BITS - 1
+    return min((shift + 1) * SUB_BUCKETS + (microseconds >> shift) - SUB_BUCKETS,
+               BUCKET_COUNT - 1)
+
+def _bucket_bound(index: int) -> int:
+    """Largest latency in microseconds that falls into the bucket"""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+class LatencyHistogram:
+    """Log-linear histogram of latencies in the manner of HdrHistogram.  Recording is
+    an index calculation and an increment, and memory is allocated once."""
+
+    def __init__(self):
+        self._counts: List[int] = [0] * BUCKET_COUNT
+        self._count: int = 0
+        self._sum: float = 0.0
+        self._max: float = 0.0
+
+    @property
+    def count(self) -> int:
+        """Number of latencies recorded"""
+        return self._count
+
+    @property
+    def sum(self) -> float:
+        """Total of the latencies recorded, in seconds"""
+        return self._sum
+
+    @property
+    def max(self) -> float:
+        """Largest latency recorded, in seconds"""
+        return self._max
+
+    @property
+    def mean(self) -> float:
+        """Mean latency in seconds, or 0 if nothing was recorded"""
+        return self._sum / self._count if self._count else 0.0
+
+    def record(self, seconds: float):
+        """Add a latency.  Not thread safe, LinkMetrics serializes the calls."""
+        self._counts[_bucket_index(max(int(seconds * 1e6), 0))] += 1
+        self._count += 1
+        self._sum += seconds
+        self._max = max(self._max, seconds)
+
+    def percentile(self, percent: float) -> float:
+        """Latency in seconds that the given percentage of the recorded latencies do
+        not exceed, to the precision of the buckets"""
+        if not self._count:
+            return 0.0
+
+        rank = max(self._count * percent / 100, 1)
+        total = 0
+        for index, count in enumerate(self._counts):
+            total += count
+            if total >= rank:
+                return min(_bucket_bound(index) / 1e6, self._max)
+
+        return self._max
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """Number of latencies up to each power of two of microseconds in the
+        exported range, as pairs of the bound in seconds and the count"""
+        buckets: List[Tuple[float, int]] = []
+        total = 0
+        index = 0
+        for exponent in range(EXPORT_MIN_EXPONENT, EXPORT_MAX_EXPONENT + 1):
+            bound = 1 << exponent
+            while index < BUCKET_COUNT and _bucket_bound(index) < bound:
+                total += self._counts[index]
+                index += 1
+            buckets.append((bound / 1e6, total))
+
+        return buckets
+
+class LinkMetrics:
+    """Traffic, failures and per-command latency of one connection.  Updates take one
+    uncontended lock, so they can stay enabled in production."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._bytes_sent: int = 0
+        self._bytes_received: int = 0
+        self._connects: int = 0
+        self._errors: Dict[DeviceError, int] = {}
+        self._latency: Dict[int, LatencyHistogram] = {}
+
+    @property
+    def bytes_sent(self) -> int:
+        """Bytes written to the socket"""
+        return self._bytes_sent
+
+    @property
+    def bytes_received(self) -> int:
+        """Bytes read from the socket"""
+        return self._bytes_received
+
+    @property
+    def connects(self) -> int:
+        """Connections established, the first one included"""
+        return self._connects
+
+    @property
+    def reconnects(self) -> int:
+        """Connections established after the first one"""
+        return max(self._connects - 1, 0)
+
+    def errors(self) -> Dict[DeviceError, int]:
+        """Number of failed commands by error code"""
+        with self._lock:
+            return dict(self._errors)
+
+    def latency(self, command: int) -> LatencyHistogram:
+        """Round trip times of a command code, such as LoaderCommand.GET_STATUS"""
+        with self._lock:
+            histogram = self._latency.get(command)
+            if histogram is None:
+                histogram = self._latency[command] = LatencyHistogram()
+            return histogram
+
+    def commands(self) -> List[int]:
+        """Command codes with recorded latencies"""
+        with self._lock:
+            return sorted(self._latency)
+
+    def record_sent(self, count: int):
+        """Count bytes written"""
+        with self._lock:
+            self._bytes_sent += count
+
+    def record_received(self, count: int):
+        """Count bytes read"""
+        with self._lock:
+            self._bytes_received += count
+
+    def record_connect(self):
+        """Count an established connection"""
+        with self._lock:
+            self._connects += 1
+
+    def record_error(self, code: DeviceError):
+        """Count a failed command"""
+        with self._lock:
+            self._errors[code] = self._errors.get(code, 0) + 1
+
+    def record_latency(self, command: int, seconds: float):
+        """Add the round trip time of a successful command"""
+        with self._lock:
+            histogram = self._latency.get(command)
+            if histogram is None:
+                histogram = self._latency[command] = LatencyHistogram()
+            histogram.record(seconds)
+
+def command_name(command: int) -> str:
+    """Name of a command recorded as a LoaderCommand member, or else its number"""
+    return getattr(command, "name", str(command))
+
+def prometheus_text(links: Mapping[str, LinkMetrics]) -> str:
+    """Format the metrics of named links in the Prometheus text exposition format"""
+    lines: List[str] = []
+
+    def family(name: str, kind: str, text: str):
+        lines.append(f"# HELP autoloader_{name} {text}")
+        lines.append(f"# TYPE autoloader_{name} {kind}")
+
+    family("bytes_sent_total", "counter", "Bytes written to the autoloader")
+    for link, metrics in links.items():
+        lines.append(f'autoloader_bytes_sent_total{{link="{link}"}} {metrics.bytes_sent}')
+    family("bytes_received_total", "counter", "Bytes read from the autoloader")
+    for link, metrics in links.items():
+        lines.append(f'autoloader_bytes_received_total{{link="{link}"}} {metrics.bytes_received}')
+    family("reconnects_total", "counter", "Connections established after the first one")
+    for link, metrics in links.items():
+        lines.append(f'autoloader_reconnects_total{{link="{link}"}} {metrics.reconnects}')
+
+    family("errors_total", "counter", "Failed commands by error code")
+    for link, metrics in links.items():
+        for code, count in sorted(metrics.errors().items()):
+            lines.append(f'autoloader_errors_total{{link="{link}",error="{code.name}"}} {count}')
+
+    family("command_seconds", "histogram", "Round trip time of successful commands")
+    for link, metrics in links.items():
+        for command in metrics.commands():
+            histogram = metrics.latency(command)
+            labels = f'link="{link}",command="{command_name(command)}"'
+            for bound, count in histogram.cumulative():
+                lines.append(
+                    f'autoloader_command_seconds_bucket{{{labels},le="{bound:g}"}} {count}')
+            lines.append(
+                f'autoloader_command_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"autoloader_command_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"autoloader_command_seconds_count{{{labels}}} {histogram.count}")
+
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    server: "_MetricsHttpServer"
+
+    def do_GET(self):   # pylint: disable=invalid-name
+        """Serve the metrics on any path"""
+        body = prometheus_text(self.server.links()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+class _MetricsHttpServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], source: MetricsSource):
+        super().__init__(address, _MetricsHandler)
+        self._source = source
+
+    def links(self) -> Mapping[str, LinkMetrics]:
+        """The metrics to serve"""
+        return self._source() if callable(self._source) else self._source
+
+class MetricsServer:
+    """Serves the metrics of named links over HTTP in the Prometheus text format.
+    Pass a mapping, or a function returning one if loaders come and go.  Listens on
+    localhost unless another address is given; port 0 picks a free port."""
+
+    def __init__(self, source: MetricsSource, port: int = 9464, address: str = "127.0.0.1"):
+        self._server = _MetricsHttpServer((address, port), source)
+        self._thread: Optional[Thread] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def port(self) -> int:
+        """Port being listened on"""
+        return self._server.server_address[1]
+
+    def start(self):
+        """Serve on a background thread"""
+        if self._thread is None:
+            self._thread = Thread(target=self._server.serve_forever, name="Metrics", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stop serving"""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
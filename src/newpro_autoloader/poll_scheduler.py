@@ -0,0 +1,143 @@
+"""Deadline-based scheduling of status polls, fast during motion and slower when idle"""
+from contextlib import contextmanager
+from threading import Event, Lock
+from time import monotonic
+from typing import Callable, Iterator, Optional
+
+from newpro_autoloader.axis_status import AxisStatus, MainStatus, OverallSystemStatus
+
+# The device aborts motion if no GetStatus arrives for this long
+HEARTBEAT_TIMEOUT: float = 10.0
+
+# Longest allowed idle interval, leaving room for a slow or retried poll
+MAX_POLL_INTERVAL: float = HEARTBEAT_TIMEOUT / 4
+
+FAST_POLL_INTERVAL: float = 0.25
+IDLE_POLL_INTERVAL: float = 2.0
+
+# Seconds without motion or a running action before polling backs off
+IDLE_AFTER: float = 5.0
+
+class PollScheduler:  # pylint: disable=too-many-instance-attributes
+    """Keeps status polls on a fixed grid of deadlines so that the period does not
+    drift by the round trip time.  Polls use the fast interval while an action runs,
+    while either axis is in motion and for a while afterwards, and the idle interval
+    otherwise.  Deadlines that pass before the previous poll completes are counted.
+    After a failed poll the interval doubles, up to MAX_POLL_INTERVAL so that retries
+    still keep the heartbeat, until a status arrives again."""
+
+    def __init__(self,
+                 interval: float = FAST_POLL_INTERVAL,
+                 idle_interval: float = IDLE_POLL_INTERVAL,
+                 idle_after: float = IDLE_AFTER):
+        if not 0 < interval <= idle_interval <= MAX_POLL_INTERVAL:
+            raise ValueError(
+                f"Poll intervals must satisfy 0 < {interval} <= {idle_interval} <= "
+                f"{MAX_POLL_INTERVAL} to keep the device heartbeat"
+            )
+
+        self._interval = interval
+        self._idle_interval = idle_interval
+        self._idle_after = idle_after
+
+        self._lock = Lock()
+        self._wake = Event()
+        self._deadline: Optional[float] = None
+        self._last_active: float = monotonic()
+        self._actions: int = 0
+        self._polls: int = 0
+        self._missed: int = 0
+        self._retry_interval: Optional[float] = None
+        self._wake_callback: Optional[Callable[[], None]] = None
+
+    @property
+    def is_active(self) -> bool:
+        """True while polling at the fast interval"""
+        return self._actions > 0 or monotonic() - self._last_active < self._idle_after
+
+    @property
+    def current_interval(self) -> float:
+        """Interval until the next poll deadline"""
+        if self._retry_interval is not None:
+            return self._retry_interval
+        return self._interval if self.is_active else self._idle_interval
+
+    @property
+    def polls(self) -> int:
+        """Number of polls scheduled"""
+        return self._polls
+
+    @property
+    def missed_deadlines(self) -> int:
+        """Number of polls that started late because the previous one took too long"""
+        return self._missed
+
+    def observe(self, elevator: AxisStatus, loader: AxisStatus, main: MainStatus):
+        """Keep polling fast while the latest status shows motion or an action"""
+        self._retry_interval = None
+        moving = (elevator.status | loader.status) & OverallSystemStatus.IN_MOTION
+        if moving or main.current_action:
+            self._last_active = monotonic()
+
+    def poll_failed(self):
+        """Wait longer before the next poll, as the device did not answer"""
+        if self._retry_interval is None:
+            self._retry_interval = self.current_interval
+        self._retry_interval = min(2 * self._retry_interval, MAX_POLL_INTERVAL)
+
+    @contextmanager
+    def action(self) -> Iterator[None]:
+        """Poll fast for the duration of a command, starting right away"""
+        self.begin_action()
+        try:
+            yield
+        finally:
+            self.end_action()
+
+    def begin_action(self):
+        """Poll fast from now until the matching end_action"""
+        with self._lock:
+            self._actions += 1
+        self.wake()
+
+    def end_action(self):
+        """End the fast polling of begin_action, after the idle delay"""
+        with self._lock:
+            self._actions -= 1
+        self._last_active = monotonic()
+
+    def next_delay(self) -> float:
+        """Advance to the next deadline.
+            returns the seconds to wait before polling"""
+        now = monotonic()
+        self._polls += 1
+        if self._deadline is None:
+            self._deadline = now
+
+        self._deadline += self.current_interval
+        if self._deadline < now:
+            self._missed += 1
+            self._deadline = now
+
+        return self._deadline - now
+
+    def restart(self):
+        """Restart the deadline grid from a poll made now, outside the grid"""
+        self._deadline = monotonic()
+
+    def wait(self):
+        """Block until the next deadline, or until woken"""
+        if self._wake.wait(self.next_delay()):
+            self._wake.clear()
+            # Restart the deadline grid from the early poll
+            self.restart()
+
+    def wake(self):
+        """Poll right away, such as when an action starts or polling stops"""
+        self._wake.set()
+        if self._wake_callback is not None:
+            self._wake_callback()
+
+    def set_wake_callback(self, callback: Optional[Callable[[], None]]):
+        """Also call back on wake, for polling driven by something other than wait"""
+        self._wake_callback = callback
@@ -0,0 +1,167 @@
+"""Append-only binary log of the raw frames exchanged with the autoloader, for
+post-mortem analysis and replay.
+
+A log file starts with FILE_MAGIC and holds a sequence of records, each a RECORD_HEADER
+(timestamp in seconds since the epoch, channel, kind, payload length) followed by the
+payload.  Every index_interval records an INDEX record is written whose payload is a
+sequence of INDEX_ENTRY (timestamp, file offset) for the records since the previous index,
+so a reader can seek by time without scanning every record."""
+import os
+from datetime import datetime
+from enum import IntEnum
+from queue import Empty, Full, Queue
+from struct import Struct
+from threading import Thread
+from time import time
+from typing import BinaryIO, List, Optional, Tuple
+
+FILE_MAGIC = b"NPALTLM1"
+FILE_SUFFIX = ".npal"
+
+RECORD_HEADER = Struct("<dBBI")
+INDEX_ENTRY = Struct("<dQ")
+
+DEFAULT_MAX_FILE_SIZE = 64 * 1024 * 1024
+DEFAULT_INDEX_INTERVAL = 1024
+DEFAULT_QUEUE_SIZE = 65536
+
+# Seconds between flushes of the file buffer when records arrive slowly
+FLUSH_INTERVAL: float = 1.0
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+class RecordChannel(IntEnum):
+    """Connection a frame was exchanged on"""
+    COMMAND = 0
+    STATUS = 1
+
+class RecordKind(IntEnum):
+    """Type of record"""
+    REQUEST = 0
+    RESPONSE = 1
+    INDEX = 2
+
+class TelemetryRecorder:    # pylint: disable=too-many-instance-attributes
+    """Writes records to rotating log files in a background thread.  record() only
+    queues the frame, so it never waits for the disk; if the writer falls behind by
+    more than queue_size records, new records are dropped and counted."""
+
+    def __init__(self,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 directory: str,
+                 prefix: str = "autoloader",
+                 max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+                 max_files: Optional[int] = None,
+                 index_interval: int = DEFAULT_INDEX_INTERVAL,
+                 queue_size: int = DEFAULT_QUEUE_SIZE):
+        """Start recording into new files in directory.  Files are rotated when they
+        exceed max_file_size bytes, and only the newest max_files are kept if given."""
+
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._prefix = prefix
+        self._max_file_size = max_file_size
+        self._max_files = max_files
+        self._index_interval = index_interval
+
+        self._queue: "Queue[Optional[Tuple[float, int, int, bytes]]]" = Queue(queue_size)
+        self._dropped: int = 0
+        self._files: List[str] = []
+        self._sequence: int = 0
+        self._file: Optional[BinaryIO] = None
+        self._offset: int = 0
+        self._index: List[bytes] = []
+
+        self._thread = Thread(target=self._writer, name="Telemetry recorder", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def dropped(self) -> int:
+        """Number of records discarded because the writer could not keep up"""
+        return self._dropped
+
+    @property
+    def files(self) -> List[str]:
+        """Log files kept so far, oldest first"""
+        return list(self._files)
+
+    def record(self, channel: RecordChannel, kind: RecordKind, frame: bytes):
+        """Queue a frame for writing, stamped with the current time"""
+        try:
+            self._queue.put_nowait((time(), channel, kind, bytes(frame)))
+        except Full:
+            self._dropped += 1
+
+    def close(self):
+        """Write all queued records and close the log"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _writer(self):
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=FLUSH_INTERVAL)
+                except Empty:
+                    if self._file is not None:
+                        self._file.flush()
+                    continue
+
+                if item is None:
+                    break
+                self._write(*item)
+        finally:
+            self._close_file()
+
+    def _write(self, timestamp: float, channel: int, kind: int, frame: bytes):
+        if self._file is None:
+            self._open_file()
+
+        self._index.append(INDEX_ENTRY.pack(timestamp, self._offset))
+        self._append(RECORD_HEADER.pack(timestamp, channel, kind, len(frame)) + frame)
+
+        if len(self._index) >= self._index_interval:
+            self._write_index()
+        if self._offset >= self._max_file_size:
+            self._close_file()
+
+    def _append(self, data: bytes):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def _write_index(self):
+        if not self._index:
+            return
+        payload = b"".join(self._index)
+        self._index.clear()
+        self._append(RECORD_HEADER.pack(time(), 0, RecordKind.INDEX, len(payload)) + payload)
+
+    def _open_file(self):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(
+            self._directory,
+            f"{self._prefix}-{stamp}-{self._sequence:04d}{FILE_SUFFIX}",
+        )
+        self._sequence += 1
+        # pylint: disable-next=consider-using-with
+        self._file = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+        self._files.append(path)
+        self._offset = 0
+        self._append(FILE_MAGIC)
+
+        if self._max_files is not None:
+            while len(self._files) > self._max_files:
+                os.remove(self._files.pop(0))
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        self._write_index()
+        self._file.close()
+        self._file = None
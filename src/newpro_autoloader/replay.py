@@ -0,0 +1,363 @@
+"""Replay of recorded telemetry logs through the normal response validation and status
+decoding, so that Loader behaves as if it were connected to the recorded device"""
+import mmap
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from time import monotonic, sleep
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+from newpro_autoloader.connection import DEFAULT_TIMEOUT
+from newpro_autoloader.loader import Loader
+from newpro_autoloader.loader_connection import (
+    LoaderCommand,
+    RECEIVE_DATA_START_INDEX,
+    parse_response,
+)
+from newpro_autoloader.recorder import (
+    FILE_MAGIC,
+    FILE_SUFFIX,
+    RECORD_HEADER,
+    RecordChannel,
+    RecordKind,
+    TelemetryRecorder,
+)
+
+class ReplayFinished(Exception):
+    """The recorded session has no more frames to play"""
+
+    def __init__(self, message: str = "End of the recorded session"):
+        super().__init__(message)
+
+class FrameLog:   # pylint: disable=too-many-instance-attributes
+    """Memory-mapped recorded responses from one or more log files.  Frames are read
+    in place from the mapped files and copied only when returned."""
+
+    def __init__(self, paths: Union[str, Sequence[str]]):
+        """Open log files in recording order.  A directory opens all the log files in
+        it.  A record cut short at the end of a file, as after a crash, is ignored."""
+        if isinstance(paths, str):
+            if os.path.isdir(paths):
+                paths = sorted(
+                    os.path.join(paths, name) for name in os.listdir(paths)
+                    if name.endswith(FILE_SUFFIX)
+                )
+            else:
+                paths = [paths]
+
+        self._maps: List[mmap.mmap] = []
+        # Per response record: time, channel, command code, file, offset and length
+        self._times = array("d")
+        self._channels = array("B")
+        self._commands = array("B")
+        self._files = array("H")
+        self._offsets = array("Q")
+        self._lengths = array("I")
+
+        for path in paths:
+            self._scan(path)
+
+        # Positions of the responses and their times for each channel
+        self._positions = {channel: array("L") for channel in RecordChannel}
+        self._channel_times = {channel: array("d") for channel in RecordChannel}
+        for idx, channel in enumerate(self._channels):
+            self._positions[RecordChannel(channel)].append(idx)
+            self._channel_times[RecordChannel(channel)].append(self._times[idx])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._times)
+
+    @property
+    def start(self) -> float:
+        """Time of the first response"""
+        return self._times[0] if self._times else 0.0
+
+    @property
+    def end(self) -> float:
+        """Time of the last response"""
+        return self._times[-1] if self._times else 0.0
+
+    def close(self):
+        """Unmap the log files"""
+        for mapped in self._maps:
+            mapped.close()
+        self._maps.clear()
+
+    def times(self, channel: RecordChannel) -> Sequence[float]:
+        """Times of the responses on a channel, in order"""
+        return self._channel_times[channel]
+
+    def position(self, channel: RecordChannel, idx: int) -> int:
+        """Position in the log of the idx-th response on a channel"""
+        return self._positions[channel][idx]
+
+    def command(self, position: int) -> int:
+        """Command code of a response"""
+        return self._commands[position]
+
+    def time(self, position: int) -> float:
+        """Time a response was received"""
+        return self._times[position]
+
+    def frame(self, position: int) -> bytearray:
+        """Copy of a complete response frame"""
+        start = self._offsets[position]
+        return bytearray(self._maps[self._files[position]][start:start + self._lengths[position]])
+
+    def find(self, command: LoaderCommand) -> int:
+        """Position of the first response to a command on any channel"""
+        try:
+            return self._commands.index(command)
+        except ValueError:
+            raise ReplayFinished(f"No {command.name} response was recorded") from None
+
+    def frames(self,
+               channel: RecordChannel = RecordChannel.STATUS,
+               command: Optional[LoaderCommand] = LoaderCommand.GET_STATUS,
+    ) -> Iterator[Tuple[float, bytearray]]:
+        """Iterate over the time and frame of the responses on a channel, optionally
+        only those to one command"""
+        for position in self._positions[channel]:
+            if command is None or self._commands[position] == command:
+                yield self._times[position], self.frame(position)
+
+    def _scan(self, path: str):
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size <= len(FILE_MAGIC):
+                return
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mapped[:len(FILE_MAGIC)] != FILE_MAGIC:
+            mapped.close()
+            raise ValueError(f"{path} is not a telemetry log")
+
+        file_number = len(self._maps)
+        self._maps.append(mapped)
+
+        offset = len(FILE_MAGIC)
+        size = len(mapped)
+        while offset + RECORD_HEADER.size <= size:
+            timestamp, channel, kind, length = RECORD_HEADER.unpack_from(mapped, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > size:
+                break
+
+            if kind == RecordKind.RESPONSE:
+                self._times.append(timestamp)
+                self._channels.append(channel)
+                self._commands.append(
+                    mapped[offset + RECEIVE_DATA_START_INDEX]
+                    if length > RECEIVE_DATA_START_INDEX else 0
+                )
+                self._files.append(file_number)
+                self._offsets.append(offset)
+                self._lengths.append(length)
+
+            offset += length
+
+class ReplayClock:
+    """Playback time of a replay.  At a given speed the recorded time advances that
+    many times faster than real time.  Without a speed the clock only moves when a
+    frame is played, so a replay runs as fast as it is consumed."""
+
+    def __init__(self, start: float, speed: Optional[float] = None):
+        if speed is not None and speed <= 0:
+            raise ValueError("Replay speed must be positive")
+
+        self._speed = speed
+        self._time = start
+        self._origin = monotonic()
+
+    @property
+    def speed(self) -> Optional[float]:
+        """Recorded seconds per real second, or None for as fast as possible"""
+        return self._speed
+
+    def now(self) -> float:
+        """Current recorded time"""
+        if self._speed is None:
+            return self._time
+        return self._time + (monotonic() - self._origin) * self._speed
+
+    def seek(self, timestamp: float):
+        """Jump to a recorded time"""
+        self._time = timestamp
+        self._origin = monotonic()
+
+    def wait_until(self, timestamp: float):
+        """Wait for the recorded time to reach timestamp"""
+        if self._speed is None:
+            self._time = max(self._time, timestamp)
+            return
+
+        delay = (timestamp - self.now()) / self._speed
+        if delay > 0:
+            sleep(delay)
+
+class ReplayConnection:    # pylint: disable=too-many-instance-attributes
+    """Stands in for a LoaderConnection, answering commands with the recorded responses
+    of one channel.  GetStatus returns the frame recorded at the playback time, or the
+    next frame when playing as fast as possible.  Other commands return the next
+    recorded response to the same command, after waiting for its time.  GetVersion
+    returns the first recorded version, since it never changes."""
+
+    def __init__(self, log: FrameLog, clock: ReplayClock, channel: RecordChannel):
+        self._log = log
+        self._clock = clock
+        self._channel = channel
+        self._times = log.times(channel)
+        # Index of the next GetStatus response on the channel
+        self._cursor: int = 0
+        self._recorder: Optional[TelemetryRecorder] = None
+        self._recorded_channel: RecordChannel = channel
+        self._last_time: float = clock.now()
+
+    @property
+    def last_time(self) -> float:
+        """Recorded time of the last response returned"""
+        return self._last_time
+
+    def attach_recorder(self,
+                        recorder: Optional[TelemetryRecorder],
+                        channel: RecordChannel = RecordChannel.COMMAND):
+        """Record the replayed responses, such as to extract part of a session"""
+        self._recorder = recorder
+        self._recorded_channel = channel
+
+    def rewind(self):
+        """Restart GetStatus playback from the playback time, after seeking"""
+        self._cursor = 0
+
+    def command(self,
+             cmd_type: LoaderCommand,
+             msg: Optional[bytearray] = None,  # pylint: disable=unused-argument
+             timeout: float = DEFAULT_TIMEOUT,  # pylint: disable=unused-argument
+    ) -> bytearray:
+        """Return the recorded response to a command"""
+        if cmd_type == LoaderCommand.GET_STATUS:
+            position = self._next_status()
+        elif cmd_type == LoaderCommand.GET_VERSION:
+            position = self._log.find(cmd_type)
+        else:
+            position = self._find(cmd_type, bisect_right(self._times, self._clock.now()))
+            self._clock.wait_until(self._log.time(position))
+
+        resp = self._log.frame(position)
+        self._last_time = self._log.time(position)
+        if self._recorder is not None:
+            self._recorder.record(self._recorded_channel, RecordKind.RESPONSE, resp)
+
+        return parse_response(resp, cmd_type)
+
+    def wait_for_next_status(self):
+        """Wait for the recorded time of the next GetStatus response"""
+        self._clock.wait_until(self._times[self._next_status_index(self._cursor)])
+
+    def _next_status(self) -> int:
+        times = self._times
+        now = self._clock.now()
+        if self._clock.speed is None:
+            idx = self._next_status_index(max(self._cursor, bisect_left(times, now)))
+            self._clock.wait_until(times[idx])
+        else:
+            idx = bisect_right(times, now) - 1
+            while idx >= 0 and not self._is_status(idx):
+                idx -= 1
+            if idx < 0:
+                idx = self._next_status_index(0)
+            elif idx < self._cursor and now > times[-1]:
+                raise ReplayFinished
+
+        self._cursor = idx + 1
+        return self._log.position(self._channel, idx)
+
+    def _next_status_index(self, idx: int) -> int:
+        while idx < len(self._times):
+            if self._is_status(idx):
+                return idx
+            idx += 1
+        raise ReplayFinished
+
+    def _is_status(self, idx: int) -> bool:
+        return self._log.command(self._log.position(self._channel, idx)) == \
+            LoaderCommand.GET_STATUS
+
+    def _find(self, cmd_type: LoaderCommand, start: int) -> int:
+        for idx in range(start, len(self._times)):
+            position = self._log.position(self._channel, idx)
+            if self._log.command(position) == cmd_type:
+                return position
+        raise ReplayFinished
+
+class ReplaySession:
+    """A recorded session that Loader instances can be connected to"""
+
+    def __init__(self, paths: Union[str, Sequence[str]], speed: Optional[float] = None):
+        """Open the log files of a session, see FrameLog.  Playback starts at the first
+        recorded response, at speed times real time or as fast as possible if None."""
+        self._log = FrameLog(paths)
+        self._clock = ReplayClock(self._log.start, speed)
+        self._connections: List[ReplayConnection] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def log(self) -> FrameLog:
+        """The recorded frames"""
+        return self._log
+
+    @property
+    def clock(self) -> ReplayClock:
+        """The playback time"""
+        return self._clock
+
+    def close(self):
+        """Release the log files"""
+        self._log.close()
+
+    def connection(self, channel: RecordChannel) -> ReplayConnection:
+        """A connection replaying the responses recorded on a channel"""
+        connection = ReplayConnection(self._log, self._clock, channel)
+        self._connections.append(connection)
+        return connection
+
+    def loader(self, **kwargs) -> Loader:
+        """A Loader connected to the recording.  Keyword arguments are passed to Loader.
+        Sample times in the loader history are the recorded times."""
+        status_connection = self.connection(RecordChannel.STATUS)
+        loader = Loader(
+            connection=self.connection(RecordChannel.COMMAND),
+            status_connection=status_connection,
+            **kwargs,
+        )
+        loader._clock = lambda: status_connection.last_time    # pylint: disable=protected-access
+        return loader
+
+    def seek(self, timestamp: float):
+        """Continue playback from a recorded time"""
+        self._clock.seek(timestamp)
+        for connection in self._connections:
+            connection.rewind()
+
+    def play(self, loader: Loader) -> Iterator[float]:
+        """Update loader with each recorded status in turn, waiting for its time when
+        playing at a speed.  Yields the recorded time after each update."""
+        # pylint: disable-next=protected-access
+        connection: ReplayConnection = loader._status_connection
+        while True:
+            try:
+                connection.wait_for_next_status()
+                loader._get_status()   # pylint: disable=protected-access
+            except ReplayFinished:
+                return
+            yield connection.last_time
@@ -0,0 +1,210 @@
+"""Publication of each status update in shared memory, so that other processes on the
+same computer can follow the loader without connecting to it.  One writer and any
+number of readers share a segment guarded by a sequence lock: the writer makes the
+sequence odd while it writes, and a reader retries if the sequence was odd or changed
+while it copied the frame."""
+import os
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from struct import Struct
+from sys import version_info
+from typing import Callable, NamedTuple, Optional, Tuple, TypeVar
+
+# Name of the segment unless another is given, one per loader
+DEFAULT_SEGMENT = "newpro_autoloader_status"
+
+# Sequence number, the process ID of the publisher, then the identity of the device,
+# the time of the status and the length of the status response that follows the header
+_SEQUENCE = Struct("<Q")
+_OWNER = Struct("<Q")
+_HEADER = Struct("<HHIdI4x")
+_HEADER_OFFSET = _SEQUENCE.size + _OWNER.size
+HEADER_SIZE = _HEADER_OFFSET + _HEADER.size
+# Largest status response that can be published, well above that of either loader type
+STATUS_CAPACITY = 1024
+
+# Attempts of a reader to copy a frame while the writer keeps replacing it
+READ_ATTEMPTS = 100
+
+_T = TypeVar("_T")
+
+class SharedHeader(NamedTuple):
+    """Identity of the device and time of one published status response"""
+    sequence: int
+    version: int
+    sub_version: int
+    number_of_slots: int
+    timestamp: float
+    length: int
+
+# Called with the header, the segment and the offset of the response within it
+StatusDecoder = Callable[[SharedHeader, memoryview, int], _T]
+
+class SharedFrame(NamedTuple):
+    """One published status response"""
+    sequence: int
+    version: int
+    sub_version: int
+    number_of_slots: int
+    timestamp: float
+    response: bytearray
+
+def _process_alive(pid: int) -> bool:
+    """False only if there is certainly no process pid"""
+    if pid == 0 or os.name != "posix":
+        # Not written yet, or no way to tell without signalling the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Another user's process
+        return True
+    return True
+
+class StatusPublisher:
+    """Writes status responses to a shared memory segment.  Attach to a Loader with
+    attach_publisher.  The segment is removed when the publisher is closed.  One left
+    behind by a publisher that did not close is taken over once its process is gone,
+    as there must never be two writers."""
+
+    def __init__(self, name: str = DEFAULT_SEGMENT):
+        """Create the segment.  Raises FileExistsError if a publisher that is still
+        running, or one whose process cannot be checked, has a segment of that name."""
+        size = HEADER_SIZE + STATUS_CAPACITY
+        try:
+            self._memory = SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            self._memory = SharedMemory(name)
+            if (self._memory.size < size or
+                    _process_alive(_OWNER.unpack_from(self._memory.buf, _SEQUENCE.size)[0])):
+                self._memory.close()
+                raise
+        self._buffer = self._memory.buf
+        self._sequence = 0
+        _SEQUENCE.pack_into(self._buffer, 0, self._sequence)
+        _OWNER.pack_into(self._buffer, _SEQUENCE.size, os.getpid())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def name(self) -> str:
+        """Name of the segment, for StatusReader"""
+        return self._memory.name
+
+    @property
+    def sequence(self) -> int:
+        """Number of responses published, times two"""
+        return self._sequence
+
+    def publish(self,   # pylint: disable=too-many-arguments,too-many-positional-arguments
+                version: int,
+                sub_version: int,
+                number_of_slots: int,
+                timestamp: float,
+                response: bytearray):
+        """Replace the published status response.  Only one thread may publish.
+        Does nothing once the publisher is closed."""
+        if len(response) > STATUS_CAPACITY:
+            raise ValueError(f"Status response of {len(response)} bytes does not fit")
+
+        buffer = self._buffer
+        if buffer is None:
+            return
+        _SEQUENCE.pack_into(buffer, 0, self._sequence + 1)
+        _HEADER.pack_into(
+            buffer, _HEADER_OFFSET, version, sub_version, number_of_slots, timestamp, len(response))
+        buffer[HEADER_SIZE:HEADER_SIZE + len(response)] = response
+        self._sequence += 2
+        _SEQUENCE.pack_into(buffer, 0, self._sequence)
+
+    def close(self):
+        """Remove the segment.  Readers keep the last status they read."""
+        if self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+            self._memory.close()
+            if version_info < (3, 13) and os.name == "posix":
+                # A reader sharing the resource tracker of this process unregisters
+                # the segment, which unlink expects to find
+                resource_tracker.register(
+                    self._memory._name, "shared_memory")  # pylint: disable=protected-access
+            self._memory.unlink()
+
+class SharedStatus:
+    """Reading side of a segment written by a StatusPublisher.  Reads take no lock and
+    make no system calls."""
+
+    def __init__(self, name: str = DEFAULT_SEGMENT):
+        """Open the segment of a running publisher.  Raises FileNotFoundError if there
+        is none."""
+        if version_info >= (3, 13):
+            self._memory = SharedMemory(name, track=False)  # pylint: disable=unexpected-keyword-arg
+        else:
+            self._memory = SharedMemory(name)
+            if os.name == "posix":
+                # Otherwise the segment is removed when this process exits
+                resource_tracker.unregister(
+                    self._memory._name, "shared_memory")  # pylint: disable=protected-access
+        self._buffer = self._memory.buf
+        self._response = bytearray(STATUS_CAPACITY)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def sequence(self) -> int:
+        """Sequence number of the latest status, 0 until one is published"""
+        return _SEQUENCE.unpack_from(self._buffer, 0)[0]
+
+    def read(self, last_sequence: int = 0) -> Optional[SharedFrame]:
+        """The latest status, or None if its sequence number is last_sequence or
+        nothing has been published yet"""
+        def copy(header: SharedHeader, buffer: memoryview, offset: int) -> int:
+            self._response[:header.length] = buffer[offset:offset + header.length]
+            return header.length
+
+        result = self.decode(copy, last_sequence)
+        if result is None:
+            return None
+        header, length = result
+        return SharedFrame(*header[:-1], self._response[:length])
+
+    def decode(self,
+               decoder: "StatusDecoder[_T]",
+               last_sequence: int = 0,
+    ) -> Optional[Tuple[SharedHeader, _T]]:
+        """Run decoder on the latest status where it lies in the segment, without
+        copying it, or return None as read does.  The result of a decoder that ran
+        while the status was replaced is discarded and decoder runs again, so it must
+        have no side effects, must accept any bytes, and must not keep the segment."""
+        buffer = self._buffer
+        for _ in range(READ_ATTEMPTS):
+            sequence = _SEQUENCE.unpack_from(buffer, 0)[0]
+            if sequence in (last_sequence, 0):
+                return None
+            if sequence & 1:
+                continue
+
+            header = SharedHeader(sequence, *_HEADER.unpack_from(buffer, _HEADER_OFFSET))
+            header = header._replace(length=min(header.length, STATUS_CAPACITY))
+            result = decoder(header, buffer, HEADER_SIZE)
+            if _SEQUENCE.unpack_from(buffer, 0)[0] == sequence:
+                return header, result
+
+        return None
+
+    def close(self):
+        """Detach from the segment, which stays for other readers"""
+        if self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+            self._memory.close()
@@ -0,0 +1,570 @@
+"""Simulated autoloader that speaks the binary protocol on the command and status
+ports, so that Loader can be exercised, load-tested and profiled without hardware"""
+import argparse
+import socketserver
+from contextlib import contextmanager
+from threading import Event, Lock, Thread, Timer
+from time import monotonic, perf_counter, sleep
+from typing import Any, BinaryIO, ContextManager, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from newpro_autoloader.axis_status import (
+    SIZE_OF_ACTION_NAME,
+    LoaderType,
+    OverallSystemStatus,
+    STATUS_CODECS,
+)
+from newpro_autoloader.crc import calculate_crc
+from newpro_autoloader.device_error import DeviceError
+from newpro_autoloader.loader import Axis, PORT_NUMBER, PORT_NUMBER_STATUS
+from newpro_autoloader.loader_connection import (
+    COMMAND_CODE_INDEX,
+    LoaderCommand,
+    RECEIVE_BLOCK_NUMBER_INDEX,
+    RECEIVE_BLOCK_SIZE,
+    RECEIVE_DATA_START_INDEX,
+    RECEIVE_FROM_ID_INDEX,
+    RECEIVE_START_SYMBOL1_INDEX,
+    RECEIVE_START_SYMBOL2_INDEX,
+    RECEIVE_TO_ID_INDEX,
+    START_SYMBOL1,
+    START_SYMBOL2,
+    build_frame,
+)
+
+# Seconds without a GetStatus after which the device aborts motion
+HEARTBEAT_TIMEOUT: float = 10.0
+
+# Simulated seconds between position updates during a move
+MOTION_STEP: float = 0.05
+
+HOME_DURATION: float = 5.0
+EXTEND_DURATION: float = 4.0
+ELEVATOR_DURATION_PER_SLOT: float = 0.3
+GRIP_DURATION: float = 1.0
+UNLOCK_DURATION: float = 3.0
+
+SLOT_PITCH: float = 2.0
+EXTENDED_POSITION: float = 300.0
+EVAC_POSITION: float = 250.0
+
+HOMED_STATUS = (OverallSystemStatus.ABSOLUTE_POSITION_KNOWN |
+                OverallSystemStatus.PHASE_DETECTED |
+                OverallSystemStatus.SERVO_ENABLED)
+
+# Checksum and end symbols follow the message body
+_FRAME_TRAILER_LENGTH = 4
+
+_UINT32_MASK = 0xFFFFFFFF
+
+class _Abort(Exception):
+    """Raised inside a simulated action to end it with an error code"""
+    def __init__(self, code: DeviceError):
+        super().__init__(code.name)
+        self.code = code
+
+class SimulatedAxis:    # pylint: disable=too-few-public-methods
+    """Position and motion state of one simulated axis"""
+
+    def __init__(self):
+        self.position: float = 0.0
+        self.velocity: float = 0.0
+        self.homed: bool = False
+        self.in_motion: bool = False
+
+    def fields(self) -> Dict[str, Any]:
+        """Status fields of the axis the way the device reports them"""
+        status = HOMED_STATUS if self.homed else 0
+        if self.in_motion:
+            status |= OverallSystemStatus.IN_MOTION
+
+        counts = int(self.position * 1000) & _UINT32_MASK
+        return {
+            "position": self.position,
+            "overall_status": status,
+            "actual_current_status": 500 if self.in_motion else 50,
+            "motion_status": 1 if self.in_motion else 0,
+            "motor_position": counts,
+            "encoder_position": counts,
+            "motor_velocity": int(self.velocity * 1000) & _UINT32_MASK,
+        }
+
+class SimulatedLoader:  # pylint: disable=too-many-instance-attributes
+    """Stateful model of the autoloader: axes, cassette, gripper and load lock.
+    Actions take simulated time, scaled by time_scale, and can be stopped."""
+
+    def __init__(self,   # pylint: disable=too-many-arguments
+                 loader_type: LoaderType = LoaderType.BETA,
+                 number_of_slots: int = 12,
+                 occupied: Optional[Iterable[int]] = None,
+                 time_scale: float = 1.0,
+                 heartbeat_timeout: Optional[float] = HEARTBEAT_TIMEOUT):
+        """Create the model.  The cassette starts installed and mapped with the slots in
+        occupied filled, or all slots filled if occupied is None."""
+
+        self.loader_type = loader_type
+        self.number_of_slots = number_of_slots
+        self.sub_version = 1
+        self.time_scale = time_scale
+        self.heartbeat_timeout = heartbeat_timeout
+        # Seconds each GetStatus response is held back, standing in for a slow poll,
+        # while frames that follow are still received and answered
+        self.status_delay: float = 0.0
+        # perf_counter time each command code was last received
+        self.received: Dict[int, float] = {}
+
+        self.elevator = SimulatedAxis()
+        self.loader = SimulatedAxis()
+
+        self.slot_known: int = 0
+        self.slot_state: int = 0
+        self.closest_slot: int = 0
+        self.current_action: str = ""
+        self.last_error: int = DeviceError.NO_ERROR
+        self.gripped_from_slot: int = 0
+
+        self._cassette_open: bool = False
+        self._next_cassette: List[int] = []
+        self._lock = Lock()
+        self._action_lock = Lock()
+        self._stop = Event()
+        self._last_heartbeat: float = monotonic()
+
+        self.insert_cassette(occupied)
+        self._map_cassette()
+
+    @property
+    def cassette_bit(self) -> int:
+        """Bitfield position of the cassette presence"""
+        return 1 << self.number_of_slots
+
+    @property
+    def gripper_bit(self) -> int:
+        """Bitfield position of the gripper payload"""
+        return 1 << (self.number_of_slots + 1)
+
+    def insert_cassette(self, occupied: Optional[Iterable[int]] = None):
+        """Set the contents of the cassette that will be found by the next cassette mapping"""
+        if occupied is None:
+            occupied = range(1, self.number_of_slots + 1)
+        self._next_cassette = [slot for slot in occupied if 1 <= slot <= self.number_of_slots]
+
+    def handle(self, cmd_type: int, payload: bytes) -> Tuple[DeviceError, bytes]:
+        """Execute one command and return the device error and response data"""
+        handlers = {
+            LoaderCommand.GET_VERSION: self._get_version,
+            LoaderCommand.HOME: self._home,
+            LoaderCommand.STOP: self._stop_action,
+            LoaderCommand.GET_STATUS: self._get_status,
+            LoaderCommand.SET_SLOT_STATE: self._set_slot_state,
+            LoaderCommand.LOAD: self._load,
+            LoaderCommand.LOAD_CASSETTE: self._load_cassette,
+            LoaderCommand.EVAC: self._evac,
+            LoaderCommand.CLEAR_LAST_ERROR: self._clear_last_error,
+        }
+        handler = handlers.get(cmd_type)
+        if handler is None:
+            return DeviceError.UNKNOWN, b""
+
+        try:
+            return DeviceError.NO_ERROR, handler(payload)
+        except _Abort as ex:
+            with self._lock:
+                self.last_error = ex.code
+            return ex.code, b""
+
+    def pack_status(self) -> bytes:
+        """Encode the GetStatus response data"""
+        with self._lock:
+            return STATUS_CODECS[self.loader_type].encode(
+                self.elevator.fields(),
+                self.loader.fields(),
+                {
+                    "slot_known": self.slot_known,
+                    "slot_state": self.slot_state,
+                    "closest_slot": self.closest_slot,
+                    "percent_extended": self.loader.position / EXTENDED_POSITION * 100.0,
+                    "current_action": self.current_action.encode()[:SIZE_OF_ACTION_NAME],
+                    "last_error": self.last_error,
+                    "gripped_from_slot": self.gripped_from_slot,
+                },
+            )
+
+    def _get_version(self, _payload: bytes) -> bytes:
+        version = 1 if self.loader_type == LoaderType.BETA else 0
+        return (version.to_bytes(2, "little") +
+                self.sub_version.to_bytes(2, "little") +
+                self.number_of_slots.to_bytes(4, "little"))
+
+    def _get_status(self, _payload: bytes) -> bytes:
+        self._last_heartbeat = monotonic()
+        return self.pack_status()
+
+    def _stop_action(self, _payload: bytes) -> bytes:
+        self._stop.set()
+        return b""
+
+    def _clear_last_error(self, _payload: bytes) -> bytes:
+        with self._lock:
+            self.last_error = DeviceError.NO_ERROR
+        return b""
+
+    def _set_slot_state(self, payload: bytes) -> bytes:
+        if len(payload) < 8:
+            raise _Abort(DeviceError.INVALID_SLOT_NUMBER)
+
+        with self._lock:
+            self.slot_known = int.from_bytes(payload[0:4], "little")
+            self.slot_state = int.from_bytes(payload[4:8], "little")
+            if not self.slot_state & self.gripper_bit:
+                self.gripped_from_slot = 0
+        return b""
+
+    def _home(self, payload: bytes) -> bytes:
+        axis = payload[0] if payload else Axis.ALL
+        with self._action():
+            if axis in (Axis.LOADER, Axis.ALL):
+                self._move(self.loader, 0.0, HOME_DURATION, "Homing loader")
+                self.loader.homed = True
+            if axis in (Axis.ELEVATOR, Axis.ALL):
+                self._move(self.elevator, 0.0, HOME_DURATION, "Homing elevator")
+                self.elevator.homed = True
+        return b""
+
+    def _load(self, payload: bytes) -> bytes:
+        if not payload:
+            raise _Abort(DeviceError.INVALID_SLOT_NUMBER)
+        slot = payload[0]
+
+        with self._action():
+            self._check_ready()
+            if not 1 <= slot <= self.number_of_slots:
+                raise _Abort(DeviceError.INVALID_SLOT_NUMBER)
+
+            if self.gripped_from_slot != slot:
+                bit = 1 << (slot - 1)
+                if not self.slot_known & bit:
+                    raise _Abort(DeviceError.UNKNOWN_SLOT_STATE)
+                if not self.slot_state & bit:
+                    raise _Abort(DeviceError.EMPTY_SLOT)
+
+                self._return_payload()
+                self._move_to_slot(slot)
+                self._grip(slot)
+
+            self._move(self.loader, EXTENDED_POSITION, EXTEND_DURATION, "Extending")
+        return b""
+
+    def _load_cassette(self, _payload: bytes) -> bytes:
+        with self._action():
+            if not (self.elevator.homed and self.loader.homed):
+                raise _Abort(DeviceError.NOT_HOMED)
+
+            if not self._cassette_open:
+                self._return_payload()
+                self._move(self.loader, 0.0, EXTEND_DURATION, "Retracting")
+                self._wait(UNLOCK_DURATION, "Unlocking load lock")
+                with self._lock:
+                    self._cassette_open = True
+                    self.slot_known = 0
+                    self.slot_state = 0
+            else:
+                self._wait(UNLOCK_DURATION, "Locking load lock")
+                self._move(
+                    self.elevator,
+                    self.number_of_slots * SLOT_PITCH,
+                    self.number_of_slots * ELEVATOR_DURATION_PER_SLOT,
+                    "Mapping cassette",
+                )
+                self._map_cassette()
+                self._move_to_slot(1)
+        return b""
+
+    def _evac(self, _payload: bytes) -> bytes:
+        with self._action():
+            self._check_ready()
+            if self.loader.position == EXTENDED_POSITION:
+                self._move(self.loader, EVAC_POSITION, EXTEND_DURATION / 4, "Evac")
+            elif self.loader.position == EVAC_POSITION:
+                self._move(self.loader, EXTENDED_POSITION, EXTEND_DURATION / 4, "Return from evac")
+            else:
+                raise _Abort(DeviceError.INVALID_EVAC_START_POSITION)
+        return b""
+
+    @contextmanager
+    def _action(self):
+        """Context for a motion command: one at a time, stoppable, and
+        leaves the action name blank when complete"""
+        if not self._action_lock.acquire(blocking=False):   # pylint: disable=consider-using-with
+            raise _Abort(DeviceError.STEPS_PENDING)
+        self._stop.clear()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.current_action = ""
+                for axis in (self.elevator, self.loader):
+                    axis.in_motion = False
+                    axis.velocity = 0.0
+            self._action_lock.release()
+
+    def _check_ready(self):
+        if not (self.elevator.homed and self.loader.homed):
+            raise _Abort(DeviceError.NOT_HOMED)
+        if self._cassette_open:
+            raise _Abort(DeviceError.LOAD_CASSETTE_IN_PROGRESS)
+
+    def _map_cassette(self):
+        slots_mask = self.cassette_bit - 1
+        with self._lock:
+            self._cassette_open = False
+            self.slot_known = slots_mask | self.cassette_bit | self.gripper_bit
+            self.slot_state = self.cassette_bit
+            for slot in self._next_cassette:
+                if slot != self.gripped_from_slot:
+                    self.slot_state |= 1 << (slot - 1)
+            if self.gripped_from_slot:
+                self.slot_state |= self.gripper_bit
+
+    def _return_payload(self):
+        slot = self.gripped_from_slot
+        if not slot:
+            return
+
+        self._move(self.loader, 0.0, EXTEND_DURATION, "Retracting")
+        self._move_to_slot(slot)
+        self._wait(GRIP_DURATION, "Placing")
+        with self._lock:
+            self.slot_state |= 1 << (slot - 1)
+            self.slot_state &= ~self.gripper_bit
+            self.gripped_from_slot = 0
+
+    def _grip(self, slot: int):
+        self._wait(GRIP_DURATION, "Picking")
+        with self._lock:
+            self.slot_state &= ~(1 << (slot - 1))
+            self.slot_state |= self.gripper_bit
+            self.slot_known |= self.gripper_bit
+            self.gripped_from_slot = slot
+
+    def _move_to_slot(self, slot: int):
+        target = slot * SLOT_PITCH
+        distance = abs(target - self.elevator.position) / SLOT_PITCH
+        self._move(self.loader, 0.0, EXTEND_DURATION, "Retracting")
+        self._move(self.elevator, target, distance * ELEVATOR_DURATION_PER_SLOT, "Moving elevator")
+
+    def _wait(self, duration: float, action: str):
+        with self._lock:
+            self.current_action = action
+        end = monotonic() + duration * self.time_scale
+        while monotonic() < end:
+            self._check_abort()
+            sleep(min(MOTION_STEP * self.time_scale, max(end - monotonic(), 0.0)))
+        self._check_abort()
+
+    def _move(self, axis: SimulatedAxis, target: float, duration: float, action: str):
+        start_position = axis.position
+        if start_position == target:
+            return
+
+        # Moves are proportional to the full travel duration
+        if axis is self.loader:
+            duration *= abs(target - start_position) / EXTENDED_POSITION
+
+        with self._lock:
+            self.current_action = action
+            axis.in_motion = True
+            axis.velocity = (target - start_position) / max(duration, MOTION_STEP)
+
+        start = monotonic()
+        scaled = duration * self.time_scale
+        try:
+            while True:
+                self._check_abort()
+                fraction = 1.0 if scaled <= 0 else min((monotonic() - start) / scaled, 1.0)
+                with self._lock:
+                    axis.position = start_position + (target - start_position) * fraction
+                    if axis is self.elevator:
+                        self.closest_slot = max(round(axis.position / SLOT_PITCH), 0)
+                if fraction >= 1.0:
+                    break
+                sleep(min(MOTION_STEP * self.time_scale, scaled))
+        finally:
+            with self._lock:
+                axis.in_motion = False
+                axis.velocity = 0.0
+
+    def _check_abort(self):
+        if self._stop.is_set():
+            raise _Abort(DeviceError.MOVE_STOPPED)
+        if (self.heartbeat_timeout is not None and
+                monotonic() - self._last_heartbeat > self.heartbeat_timeout):
+            raise _Abort(DeviceError.HEARTBEAT_TIMEOUT)
+
+
+class RequestFrame(NamedTuple):
+    """One command frame read from a client"""
+    header: bytes
+    # Command code followed by the payload
+    body: bytes
+    crc_valid: bool
+
+def read_request(rfile: BinaryIO) -> Optional[RequestFrame]:
+    """Read the next command frame of a client.
+        returns None once the client disconnects or sends anything but a frame"""
+    header = rfile.read(RECEIVE_DATA_START_INDEX)
+    if len(header) < RECEIVE_DATA_START_INDEX:
+        return None
+    if (header[RECEIVE_START_SYMBOL1_INDEX] != START_SYMBOL1 or
+        header[RECEIVE_START_SYMBOL2_INDEX] != START_SYMBOL2):
+        return None
+
+    body_len = int.from_bytes(header[RECEIVE_BLOCK_SIZE:RECEIVE_BLOCK_SIZE+2], "little")
+    rest = rfile.read(body_len + _FRAME_TRAILER_LENGTH)
+    if len(rest) < body_len + _FRAME_TRAILER_LENGTH or body_len == 0:
+        return None
+
+    frame = header + rest
+    crc_valid = bytes(calculate_crc(frame[RECEIVE_TO_ID_INDEX:-_FRAME_TRAILER_LENGTH])) == \
+        frame[-_FRAME_TRAILER_LENGTH:-2]
+    return RequestFrame(header, rest[:body_len], crc_valid)
+
+class _FrameHandler(socketserver.StreamRequestHandler):
+    """Reads command frames from one client and answers each from the model"""
+
+    def handle(self):
+        model: SimulatedLoader = self.server.model     # type: ignore[attr-defined]
+        write_lock = Lock()
+
+        def write(response: bytearray):
+            with write_lock:
+                try:
+                    self.wfile.write(response)
+                except (OSError, ValueError):
+                    # Closed, ValueError if a held response outlives the connection
+                    pass
+
+        while True:
+            request = read_request(self.rfile)
+            if request is None:
+                return
+
+            header = request.header
+            cmd_type = request.body[COMMAND_CODE_INDEX]
+            model.received[cmd_type] = perf_counter()
+            if not request.crc_valid:
+                code, data = DeviceError.INVALID_CRC, b""
+            else:
+                code, data = model.handle(cmd_type, request.body[1:])
+
+            response = build_frame(
+                header[RECEIVE_FROM_ID_INDEX],
+                header[RECEIVE_TO_ID_INDEX],
+                header[RECEIVE_BLOCK_NUMBER_INDEX],
+                bytearray([cmd_type, code, 0]) + data,
+            )
+            if cmd_type == LoaderCommand.GET_STATUS and model.status_delay > 0:
+                Timer(model.status_delay, write, (response,)).start()
+            else:
+                write(response)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], model: SimulatedLoader):
+        self.model = model
+        super().__init__(address, _FrameHandler)
+
+
+class LoaderSimulator:
+    """Serves a SimulatedLoader on the command and status ports.  Use port 0 to
+    pick free ports, then pass the port and status_port properties to Loader."""
+
+    def __init__(self,
+                 model: Optional[SimulatedLoader] = None,
+                 host: str = "127.0.0.1",
+                 port: int = PORT_NUMBER,
+                 status_port: int = PORT_NUMBER_STATUS):
+        """Bind both ports.  Serving starts with start() or by entering the context."""
+        self.model = model if model is not None else SimulatedLoader()
+        self._servers = [
+            _Server((host, port), self.model),
+            _Server((host, status_port), self.model),
+        ]
+        self._threads: List[Thread] = []
+
+    @property
+    def port(self) -> int:
+        """Bound command port"""
+        return self._servers[0].server_address[1]
+
+    @property
+    def status_port(self) -> int:
+        """Bound status port"""
+        return self._servers[1].server_address[1]
+
+    def start(self):
+        """Serve both ports from background threads"""
+        for server in self._servers:
+            thread = Thread(target=server.serve_forever, name="Simulator", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        """Stop serving and release the ports"""
+        for server in self._servers:
+            if self._threads:
+                server.shutdown()
+            server.server_close()
+        self._threads.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    """Options for the interface and ports that a server listens on"""
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="interface to serve on, 0.0.0.0 for all")
+    parser.add_argument("--port", type=int, default=PORT_NUMBER)
+    parser.add_argument("--status-port", type=int, default=PORT_NUMBER_STATUS)
+
+
+def serve_until_interrupted(server: ContextManager[Any], message: str):
+    """Serve from the background threads of server until Ctrl+C"""
+    with server:
+        print(message)
+        try:
+            Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+def main():
+    """Run a simulator until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_server_arguments(parser)
+    parser.add_argument("--type", choices=["alpha", "beta"], default="beta")
+    parser.add_argument("--slots", type=int, default=12)
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="multiplier on simulated action durations")
+    args = parser.parse_args()
+
+    model = SimulatedLoader(
+        LoaderType.ALPHA if args.type == "alpha" else LoaderType.BETA,
+        args.slots,
+        time_scale=args.time_scale,
+    )
+    simulator = LoaderSimulator(model, args.host, args.port, args.status_port)
+    serve_until_interrupted(
+        simulator,
+        f"Simulating on {args.host}:{simulator.port} and {args.host}:{simulator.status_port}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Notification of changes between successive status updates"""
+from enum import IntEnum
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from newpro_autoloader.axis_status import AxisStatus, MainStatus, OverallSystemStatus
+
+class StatusField(IntEnum):
+    """Status values that can be subscribed to"""
+    SLOT_STATE = 0
+    SLOT_KNOWN = 1
+    GRIPPED_FROM_SLOT = 2
+    LAST_ERROR = 3
+    ELEVATOR_IN_MOTION = 4
+    LOADER_IN_MOTION = 5
+    CURRENT_ACTION = 6
+
+class StatusChange(NamedTuple):
+    """One status value that differs from the previous update"""
+    field: StatusField
+    old: Any
+    new: Any
+
+StatusCallback = Callable[[List[StatusChange]], None]
+
+_EXTRACTORS: Dict[StatusField, Callable[[AxisStatus, AxisStatus, MainStatus], Any]] = {
+    StatusField.SLOT_STATE: lambda elevator, loader, main: main.slot_state,
+    StatusField.SLOT_KNOWN: lambda elevator, loader, main: main.slot_known,
+    StatusField.GRIPPED_FROM_SLOT: lambda elevator, loader, main: main.gripped_from_slot,
+    StatusField.LAST_ERROR: lambda elevator, loader, main: main.last_error,
+    StatusField.ELEVATOR_IN_MOTION:
+        lambda elevator, loader, main: bool(elevator.status & OverallSystemStatus.IN_MOTION),
+    StatusField.LOADER_IN_MOTION:
+        lambda elevator, loader, main: bool(loader.status & OverallSystemStatus.IN_MOTION),
+    StatusField.CURRENT_ACTION: lambda elevator, loader, main: main.current_action,
+}
+
+class StatusNotifier:
+    """Keeps the subscriptions of one loader and dispatches the fields that changed
+    between successive status updates.  Callbacks run on the thread or event loop
+    that polls the status, so they should return quickly."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._subscriptions: Dict[int, Tuple[frozenset, StatusCallback]] = {}
+        self._next_handle: int = 1
+        self._watched: Tuple[StatusField, ...] = ()
+        self._previous: Dict[StatusField, Any] = {}
+
+    def subscribe(self,
+                  callback: StatusCallback,
+                  fields: Optional[Iterable[StatusField]] = None,
+    ) -> int:
+        """Call back with the list of changes to any of the fields, or to any
+        field if none are given.
+            returns a handle for unsubscribe"""
+        watched = frozenset(StatusField if fields is None else fields)
+        with self._lock:
+            handle = self._next_handle
+            self._next_handle += 1
+            self._subscriptions[handle] = (watched, callback)
+            self._update_watched()
+        return handle
+
+    def unsubscribe(self, handle: int):
+        """Stop the callbacks of a subscription"""
+        with self._lock:
+            self._subscriptions.pop(handle, None)
+            self._update_watched()
+
+    def _update_watched(self):
+        watched = frozenset().union(*(fields for fields, _ in self._subscriptions.values()))
+        self._watched = tuple(sorted(watched))
+
+    def update(self, elevator: AxisStatus, loader: AxisStatus, main: MainStatus):
+        """Compare a new status with the previous one and notify subscribers"""
+        watched = self._watched
+        if not watched:
+            self._previous.clear()
+            return
+
+        changes: Dict[StatusField, StatusChange] = {}
+        previous = self._previous
+        for field in watched:
+            new = _EXTRACTORS[field](elevator, loader, main)
+            if field in previous and previous[field] != new:
+                changes[field] = StatusChange(field, previous[field], new)
+            previous[field] = new
+
+        if not changes:
+            return
+
+        with self._lock:
+            subscriptions = list(self._subscriptions.values())
+
+        for fields, callback in subscriptions:
+            selected = [change for field, change in changes.items() if field in fields]
+            if selected:
+                try:
+                    callback(selected)
+                except Exception as ex:   # pylint: disable=broad-exception-caught
+                    print(ex)
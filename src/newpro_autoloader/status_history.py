@@ -0,0 +1,124 @@
+"""Fixed-capacity history of timestamped status samples in a NumPy structured array"""
+from threading import Lock
+from typing import Tuple
+
+from newpro_autoloader.axis_status import AxisStatus, MainStatus
+
+try:
+    import numpy as np
+except ImportError:
+    np = None     # pylint: disable=invalid-name
+
+_AXIS_FIELDS = (
+    ("position", "<f8"),
+    ("status", "<u2"),
+    ("actual_current_status", "<u4"),
+    ("motor_position", "<u4"),
+    ("encoder_position", "<u4"),
+    ("motor_velocity", "<u4"),
+)
+
+_MAIN_FIELDS = (
+    ("slot_known", "<u4"),
+    ("slot_state", "<u4"),
+    ("closest_slot", "<i4"),
+    ("percent_extended", "<f8"),
+    ("last_error", "<u4"),
+    ("gripped_from_slot", "<i4"),
+)
+
+# One sample: time in seconds since the epoch, then the elevator_ and loader_ axis
+# fields, then the main status fields
+SAMPLE_FIELDS = (
+    (("time", "<f8"),) +
+    tuple((f"elevator_{name}", fmt) for name, fmt in _AXIS_FIELDS) +
+    tuple((f"loader_{name}", fmt) for name, fmt in _AXIS_FIELDS) +
+    _MAIN_FIELDS
+)
+
+class StatusHistory:
+    """Ring buffer of the most recent status samples.  Memory is allocated once for
+    the given capacity and the oldest samples are overwritten.  Views returned by
+    segments and window share memory with the buffer, so copy them to keep data
+    beyond the next capacity samples."""
+
+    def __init__(self, capacity: int):
+        if np is None:
+            raise ImportError("NumPy is required for the status history: pip install numpy")
+        if capacity < 1:
+            raise ValueError("History capacity must be at least one sample")
+
+        self._data = np.zeros(capacity, dtype=np.dtype(list(SAMPLE_FIELDS)))
+        self._lock = Lock()
+        # Index of the next sample to write
+        self._head: int = 0
+        self._count: int = 0
+
+    @property
+    def capacity(self) -> int:
+        """Maximum number of samples kept"""
+        return len(self._data)
+
+    @property
+    def dtype(self) -> "np.dtype":
+        """Structured type of one sample"""
+        return self._data.dtype
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self,
+               timestamp: float,
+               elevator: AxisStatus,
+               loader: AxisStatus,
+               main: MainStatus):
+        """Add a sample, overwriting the oldest when full"""
+        sample = (
+            (timestamp,) +
+            tuple(getattr(elevator, name) for name, _ in _AXIS_FIELDS) +
+            tuple(getattr(loader, name) for name, _ in _AXIS_FIELDS) +
+            tuple(getattr(main, name) for name, _ in _MAIN_FIELDS)
+        )
+        with self._lock:
+            self._data[self._head] = sample
+            self._head = (self._head + 1) % len(self._data)
+            self._count = min(self._count + 1, len(self._data))
+
+    def clear(self):
+        """Discard all samples"""
+        with self._lock:
+            self._head = 0
+            self._count = 0
+
+    def segments(self) -> Tuple["np.ndarray", ...]:
+        """Zero-copy views of the samples, oldest first.  There are two views once
+        the buffer has wrapped around."""
+        with self._lock:
+            start = (self._head - self._count) % len(self._data)
+            if start + self._count <= len(self._data):
+                return (self._data[start:start + self._count],)
+            return (self._data[start:], self._data[:self._head])
+
+    def to_array(self) -> "np.ndarray":
+        """Copy of all samples, oldest first"""
+        return np.concatenate(self.segments())
+
+    def latest(self, count: int) -> "np.ndarray":
+        """Copy of the most recent samples, oldest first"""
+        return self.to_array()[-count:] if count > 0 else self._data[:0].copy()
+
+    def window(self, start: float, end: float) -> "np.ndarray":
+        """Samples with start <= time < end.  A view when the samples are contiguous
+        in the buffer, otherwise a copy."""
+        parts = []
+        for segment in self.segments():
+            times = segment["time"]
+            first, last = np.searchsorted(times, (start, end), side="left")
+            if last > first:
+                parts.append(segment[first:last])
+
+        if not parts:
+            return self._data[:0]
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
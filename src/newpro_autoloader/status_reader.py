@@ -0,0 +1,117 @@
+"""Loader status published by another process, read from shared memory"""
+from threading import RLock
+from time import monotonic, perf_counter, sleep
+from typing import Optional, Tuple
+
+from newpro_autoloader.axis_status import AxisStatus, LoaderType, MainStatus, STATUS_CODECS
+from newpro_autoloader.loader import RESPONSE_BODY_OFFSET, BaseLoader
+from newpro_autoloader.shared_status import DEFAULT_SEGMENT, SharedHeader, SharedStatus
+from newpro_autoloader.status_snapshot import StatusSnapshot
+
+# Seconds between checks of wait_for_update
+WAIT_INTERVAL = 0.0005
+
+class StatusReader(BaseLoader):  # pylint: disable=too-many-instance-attributes
+    """The status properties of Loader, such as is_homed, slot_state and grip_state,
+    for the loader whose status another process publishes with a StatusPublisher.
+    Reading a property checks the sequence number of the segment, without locking or
+    touching the network, and decodes a new status only if one was published.  Only
+    that decoding takes a lock, so that each status is applied, and its subscriptions
+    called back, once.  They are called back on the thread that reads the new status.  A reader
+    does not publish the status again with attach_publisher."""
+
+    def __init__(self, name: str = DEFAULT_SEGMENT):
+        """Open the segment of a running publisher.  Raises FileNotFoundError if there
+        is none."""
+        self._shared = SharedStatus(name)
+        # Held while a new status is applied.  Reentrant, as subscriptions called back
+        # by refresh may read the properties.
+        self._lock = RLock()
+        self._sequence: int = 0
+        self._published_time: float = 0.0
+        super().__init__()
+        self._clock = lambda: self._published_time
+        self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # The state that BaseLoader keeps as attributes is refreshed on every read
+
+    def _current_snapshot(self) -> StatusSnapshot:
+        self.refresh()
+        return self._snapshot
+
+    @property
+    def version(self) -> int:
+        self.refresh()
+        return self._version
+
+    @property
+    def sub_version(self) -> int:
+        self.refresh()
+        return self._sub_version
+
+    @property
+    def number_of_slots(self) -> int:
+        self.refresh()
+        return self._number_of_slots
+
+    @property
+    def identified(self) -> bool:
+        self.refresh()
+        return self._identified
+
+    def refresh(self) -> bool:
+        """Decode the latest published status, if it is new.
+            returns True if it was"""
+        shared = self._shared
+        if shared is None or shared.sequence == self._sequence:
+            # The common case, which takes no lock
+            return False
+
+        with self._lock:
+            if self._shared is None:
+                return False
+            decoding = perf_counter() if self._tracer is not None else None
+            result = self._shared.decode(self._decode, self._sequence)
+            if result is None:
+                return False
+
+            header, (elevator, loader, main) = result
+            self._sequence = header.sequence
+            self._version = header.version
+            self._sub_version = header.sub_version
+            self._number_of_slots = header.number_of_slots
+            self._identified = True
+            self._published_time = header.timestamp
+            self._apply_status(elevator, loader, main, None, decoding)
+            return True
+
+    @staticmethod
+    def _decode(header: SharedHeader,
+                buffer: memoryview,
+                offset: int,
+    ) -> Tuple[AxisStatus, AxisStatus, MainStatus]:
+        codec = STATUS_CODECS[LoaderType.BETA if header.version else LoaderType.ALPHA]
+        return codec.decode(buffer, offset + RESPONSE_BODY_OFFSET)
+
+    def wait_for_update(self, timeout: Optional[float] = None) -> bool:
+        """Wait until a new status is published.
+            returns False if none was within timeout"""
+        deadline = None if timeout is None else monotonic() + timeout
+        while not self.refresh():
+            if deadline is not None and monotonic() >= deadline:
+                return False
+            sleep(WAIT_INTERVAL)
+        return True
+
+    def close(self):
+        """Detach from the segment.  The last status read stays available."""
+        with self._lock:
+            if self._shared is not None:
+                self._shared.close()
+                self._shared = None
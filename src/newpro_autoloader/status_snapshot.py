@@ -0,0 +1,146 @@
+"""Immutable view of one decoded status frame"""
+from typing import Optional, Union
+
+from newpro_autoloader.axis_status import AxisStatus, MainStatus, OverallSystemStatus
+from newpro_autoloader.cassette_map import CassetteMap, PayloadState
+from newpro_autoloader.device_error import DeviceError
+
+class StatusSnapshot:
+    """Both axis statuses and the main status of one GetStatus response, with the time
+    it was received.  Snapshots are never modified, so all properties of one snapshot
+    describe the same frame, and they can be shared between threads without locking."""
+
+    __slots__ = ("_elevator", "_loader", "_main", "_timestamp", "_number_of_slots", "_cassette")
+    _elevator: AxisStatus
+    _loader: AxisStatus
+    _main: MainStatus
+    _timestamp: float
+    _number_of_slots: int
+    # Decoded on first use
+    _cassette: Optional[CassetteMap]
+
+    def __init__(self,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 elevator: AxisStatus,
+                 loader: AxisStatus,
+                 main: MainStatus,
+                 timestamp: float = 0.0,
+                 number_of_slots: int = 0):
+        setter = object.__setattr__
+        setter(self, "_elevator", elevator)
+        setter(self, "_loader", loader)
+        setter(self, "_main", main)
+        setter(self, "_timestamp", timestamp)
+        setter(self, "_number_of_slots", number_of_slots)
+        setter(self, "_cassette", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("StatusSnapshot is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("StatusSnapshot is immutable")
+
+    def __repr__(self) -> str:
+        return (
+            f"StatusSnapshot(timestamp={self._timestamp}, homed={self.is_homed}, "
+            f"index_loaded={self.index_loaded}, action={self.current_action!r})"
+        )
+
+    @property
+    def elevator(self) -> AxisStatus:
+        """Elevator axis status"""
+        return self._elevator
+
+    @property
+    def loader(self) -> AxisStatus:
+        """Loader axis status"""
+        return self._loader
+
+    @property
+    def main(self) -> MainStatus:
+        """Overall autoloader status"""
+        return self._main
+
+    @property
+    def timestamp(self) -> float:
+        """Time the status was received, in seconds since the epoch"""
+        return self._timestamp
+
+    @property
+    def number_of_slots(self) -> int:
+        """Number of slots in the cassette"""
+        return self._number_of_slots
+
+    @property
+    def cassette(self) -> CassetteMap:
+        """State of every cassette slot"""
+        cassette = self._cassette
+        if cassette is None:
+            cassette = CassetteMap(
+                self._main.slot_state,
+                self._main.slot_known,
+                self._number_of_slots,
+            )
+            # Equal maps from any thread, so a race only decodes twice
+            object.__setattr__(self, "_cassette", cassette)
+        return cassette
+
+    @property
+    def is_cassette_present(self) -> bool:
+        """Return True if a cassette is installed in the loader"""
+        return self.slot_state(self._number_of_slots + 1) == PayloadState.PRESENT
+
+    @property
+    def is_gripped(self) -> bool:
+        """Return True if the gripper is full"""
+        return self._main.gripped_from_slot != 0
+
+    @property
+    def grip_state(self) -> PayloadState:
+        """Return the payload state of the gripper"""
+        return self.slot_state(self._number_of_slots + 2)
+
+    @property
+    def index_loaded(self) -> Optional[int]:
+        """This indicates the slot number of the currently gripped payload, if any.
+        It does not indicate if the payload is fully loaded into the microscope."""
+        slot = self._main.gripped_from_slot
+        if slot:
+            return slot
+
+        return None
+
+    @property
+    def is_homed(self) -> bool:
+        """This indicates if the homing process has been completed so that
+        the positions have been determined.  It does not indicate if the loader
+        is presently at the home position."""
+        loader_homed: bool = self._loader.status & \
+            OverallSystemStatus.ABSOLUTE_POSITION_KNOWN
+        elevator_homed: bool = self._elevator.status & \
+            OverallSystemStatus.ABSOLUTE_POSITION_KNOWN
+        return loader_homed and elevator_homed
+
+    @property
+    def last_error(self) -> Union[DeviceError, int]:
+        """The latched last error code"""
+        try:
+            return DeviceError(self._main.last_error)
+        except (IndexError, ValueError):
+            return self._main.last_error
+
+    @property
+    def current_action(self) -> str:
+        """Name of the action in progress, empty when idle"""
+        return self._main.current_action
+
+    def slot_state(self, slot_number: int) -> PayloadState:
+        """Get the state of the given slot number: Present, Absent, or Unknown."""
+        state: bool = self._main.slot_state & (1 << slot_number-1) > 0
+        known: bool = self._main.slot_known & (1 << slot_number-1) > 0
+        if known:
+            if state:
+                return PayloadState.PRESENT
+
+            return PayloadState.ABSENT
+
+        return PayloadState.UNKNOWN
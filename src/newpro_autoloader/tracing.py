@@ -0,0 +1,192 @@
+"""Hooks that report the time spent in each stage of a command, for finding out where
+a slow command spent its time.  Tracing is off unless a tracer is attached."""
+import json
+from enum import IntEnum
+from itertools import count
+from threading import Lock
+from time import perf_counter, time_ns
+from typing import IO, Any, Dict, List, NamedTuple, Optional, Union
+
+from newpro_autoloader.metrics import command_name
+
+class Stage(IntEnum):
+    """Stages of a command.  COMMAND spans the others of the same trace."""
+    COMMAND = 0
+    # Formatting the frame, including the checksum
+    BUILD = 1
+    # Waiting for another thread to finish with the connection, one span for each
+    # lock the command takes
+    LOCK_WAIT = 2
+    # Writing the frame to the socket
+    SEND = 3
+    # From the end of the send until the first bytes of the response arrive
+    FIRST_BYTE = 4
+    # From the first bytes until the response frame is complete
+    REASSEMBLY = 5
+    # Checking the response frame and extracting the body
+    VALIDATE = 6
+    # Decoding a status response into the loader status
+    DECODE = 7
+
+class Span(NamedTuple):
+    """One stage of one command.  Times are perf_counter seconds.  Spans of the same
+    command share a trace ID, which is 0 for DECODE spans."""
+    trace_id: int
+    stage: Stage
+    command: int
+    link: str
+    start: float
+    end: float
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        """Length of the stage in seconds"""
+        return self.end - self.start
+
+class Tracer:  # pylint: disable=too-few-public-methods
+    """Receives the spans of traced commands.  Subclass and override span.  Spans are
+    reported on the thread that ran the stage, once it has ended, so the COMMAND span
+    of a trace comes after its stages."""
+
+    def span(self, span: Span):
+        """Called for each stage that ends.  Does nothing by default."""
+
+class CommandTrace:
+    """Reports the spans of one command to a tracer.  Created only while a tracer is
+    attached, so untraced commands pay for a None check per stage."""
+
+    __slots__ = ("_tracer", "_command", "_link", "trace_id", "start", "sent")
+
+    def __init__(self, tracer: Tracer, command: int, link: str):
+        self._tracer = tracer
+        self._command = command
+        self._link = link
+        self.trace_id = next_trace_id()
+        self.start = perf_counter()
+        # End of the SEND stage, from which FIRST_BYTE is measured, once reported
+        self.sent: Optional[float] = None
+
+    def __call__(self, stage: Stage, start: float, end: float):
+        """Report a stage of the command"""
+        if stage == Stage.SEND:
+            self.sent = end
+        self._tracer.span(Span(self.trace_id, stage, self._command, self._link, start, end))
+
+    def end(self, error: Optional[BaseException] = None):
+        """Report the whole command, which failed if error is given"""
+        self._tracer.span(Span(
+            self.trace_id,
+            Stage.COMMAND,
+            self._command,
+            self._link,
+            self.start,
+            perf_counter(),
+            None if error is None else str(error) or type(error).__name__,
+        ))
+
+# Taking the next value is atomic, so threads need no lock
+_TRACE_IDS = count(1)
+
+def next_trace_id() -> int:
+    """A new ID for the spans of one command, unique in this process"""
+    return next(_TRACE_IDS)
+
+def _span_name(span: Span) -> str:
+    return command_name(span.command) if span.stage == Stage.COMMAND else span.stage.name
+
+class JsonTraceWriter(Tracer):
+    """Writes spans as Trace Event Format complete events, one JSON object per line,
+    which chrome://tracing and Perfetto display on a timeline.  Each link is shown
+    as a thread, so waits for the lock stand out from device latency."""
+
+    def __init__(self, file: Union[str, IO[str]]):
+        self._owned = isinstance(file, str)
+        if isinstance(file, str):
+            self._file: IO[str] = open(  # pylint: disable=consider-using-with
+                file, "w", encoding="utf-8")
+        else:
+            self._file = file
+        self._lock = Lock()
+        # Converts perf_counter times to the wall clock, in microseconds
+        self._offset = time_ns() / 1000 - perf_counter() * 1e6
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def span(self, span: Span):
+        event: Dict[str, Any] = {
+            "name": _span_name(span),
+            "cat": span.stage.name,
+            "ph": "X",
+            "ts": span.start * 1e6 + self._offset,
+            "dur": span.duration * 1e6,
+            "pid": 1,
+            "tid": span.link,
+            "args": {"trace_id": span.trace_id, "command": command_name(span.command)},
+        }
+        if span.error is not None:
+            event["args"]["error"] = span.error
+
+        line = json.dumps(event) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        """Flush the trace, and close the file if it was opened here"""
+        with self._lock:
+            self._file.flush()
+            if self._owned:
+                self._file.close()
+
+class OpenTelemetryTracer(Tracer):  # pylint: disable=too-few-public-methods
+    """Reports each command as an OpenTelemetry span with a child span per stage.
+    Requires the opentelemetry-api package and a configured tracer provider."""
+
+    def __init__(self, tracer: Any = None):
+        try:
+            from opentelemetry import trace  # pylint: disable=import-outside-toplevel
+        except ImportError as ex:
+            raise ImportError(
+                "OpenTelemetry is required for this tracer: pip install opentelemetry-api"
+            ) from ex
+
+        self._trace = trace
+        self._tracer = tracer if tracer is not None else trace.get_tracer("newpro_autoloader")
+        self._lock = Lock()
+        # Stages reported before the COMMAND span that contains them
+        self._stages: Dict[int, List[Span]] = {}
+        self._offset = time_ns() - int(perf_counter() * 1e9)
+
+    def span(self, span: Span):
+        if span.stage != Stage.COMMAND and span.trace_id != 0:
+            with self._lock:
+                self._stages.setdefault(span.trace_id, []).append(span)
+            return
+
+        with self._lock:
+            stages = self._stages.pop(span.trace_id, []) if span.trace_id != 0 else []
+
+        parent = self._start(span, None)
+        context = self._trace.set_span_in_context(parent)
+        for stage in stages:
+            self._end(self._start(stage, context), stage)
+        self._end(parent, span)
+
+    def _start(self, span: Span, context: Any) -> Any:
+        return self._tracer.start_span(
+            _span_name(span),
+            context=context,
+            start_time=int(span.start * 1e9) + self._offset,
+            attributes={"autoloader.link": span.link,
+                        "autoloader.command": command_name(span.command)},
+        )
+
+    def _end(self, otel_span: Any, span: Span):
+        if span.error is not None:
+            otel_span.set_attribute("autoloader.error", span.error)
+            otel_span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int(span.end * 1e9) + self._offset)
@@ -0,0 +1,253 @@
+"""Reproducible benchmarks for the framing, checksum, status decoding and status round trip.
+Runs against a local simulator, so no hardware is needed.  Results are written as JSON:
+
+    python tests/benchmark.py --output bench.json
+"""
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime, timezone
+from statistics import median
+from threading import Thread
+from time import perf_counter, perf_counter_ns, sleep
+from typing import Callable, Dict, List
+
+from newpro_autoloader.axis_status import AxisStatus, LoaderType, MainStatus
+from newpro_autoloader.crc import calculate_crc, np
+from newpro_autoloader.device_error import DeviceException
+from newpro_autoloader.loader import BaseLoader, RESPONSE_BODY_OFFSET
+from newpro_autoloader.loader_connection import (
+    CommandEncoder,
+    LoaderCommand,
+    LoaderConnection,
+    build_command,
+    build_frame,
+    parse_response,
+    validate_frames,
+)
+from newpro_autoloader.simulator import LoaderSimulator, SimulatedLoader
+
+# Seconds the simulator holds each status response while STOP is sent
+STOP_POLL_DELAY = 0.05
+# Longest allowed time from a stop request to its arrival at the device
+STOP_BUDGET_US = 5000.0
+
+def time_per_call(func: Callable[[], object], number: int, repeat: int = 5) -> Dict[str, float]:
+    """Time func in batches of number calls, reporting nanoseconds per call"""
+    results: List[float] = []
+    for _ in range(repeat):
+        start = perf_counter_ns()
+        for _ in range(number):
+            func()
+        results.append((perf_counter_ns() - start) / number)
+
+    return {"best_ns": min(results), "median_ns": median(results), "calls": number * repeat}
+
+def percentiles(samples_ns: List[int]) -> Dict[str, float]:
+    """Summarize latency samples in microseconds"""
+    ordered = sorted(samples_ns)
+
+    def pick(fraction: float) -> float:
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] / 1000
+
+    return {
+        "p50_us": pick(0.50),
+        "p90_us": pick(0.90),
+        "p99_us": pick(0.99),
+        "max_us": ordered[-1] / 1000,
+        "samples": len(ordered),
+    }
+
+def status_response(loader_type: LoaderType) -> bytearray:
+    """A complete GetStatus response frame from a simulated device"""
+    model = SimulatedLoader(loader_type, time_scale=0.0, heartbeat_timeout=None)
+    body = bytearray([LoaderCommand.GET_STATUS, 0, 0]) + model.pack_status()
+    return build_frame(0, 1, 1, body)
+
+def bench_crc(scale: int) -> Dict[str, object]:
+    """Checksum throughput on a status-sized frame and on a large buffer"""
+    results: Dict[str, object] = {}
+    for name, size in (("frame_160B", 160), ("buffer_64KiB", 65536)):
+        data = bytearray(i & 0xFF for i in range(size))
+        number = max(scale * 16 // size, 1)
+        timing = time_per_call(lambda data=data: calculate_crc(data), number)
+        timing["MB_per_s"] = size / timing["best_ns"] * 1000
+        results[name] = timing
+
+    if np is not None:
+        frames = [bytes(status_response(LoaderType.BETA))] * 10000
+        timing = time_per_call(lambda: validate_frames(frames), max(scale // 10000, 1))
+        timing["frames_per_s"] = len(frames) / timing["best_ns"] * 1e9
+        results["batch_validate_10000_frames"] = timing
+
+    return results
+
+def bench_framing(scale: int) -> Dict[str, object]:
+    """Cost of building command frames and validating response frames"""
+    status = status_response(LoaderType.BETA)
+    encoder = CommandEncoder()
+    slot = bytearray([3])
+    return {
+        "build_get_status": time_per_call(
+            lambda: build_command(LoaderCommand.GET_STATUS, None, 1), scale),
+        "build_load": time_per_call(
+            lambda: build_command(LoaderCommand.LOAD, bytearray([3]), 1), scale),
+        "encode_get_status": time_per_call(
+            lambda: encoder.encode(LoaderCommand.GET_STATUS, None, 1), scale),
+        "encode_load": time_per_call(
+            lambda: encoder.encode(LoaderCommand.LOAD, slot, 1), scale),
+        "validate_get_status": time_per_call(
+            lambda: parse_response(status, LoaderCommand.GET_STATUS), scale),
+    }
+
+def _decode_timings(body: bytearray, loader_type: LoaderType, scale: int) -> Dict[str, object]:
+    axis = AxisStatus()
+    main_status = MainStatus()
+    main_idx = axis.unpack(body, axis.unpack(body, RESPONSE_BODY_OFFSET, loader_type), loader_type)
+
+    # Decode the way Loader does for each status poll
+    state = BaseLoader()
+    state._version = int(loader_type)    # pylint: disable=protected-access
+
+    return {
+        "axis_unpack": time_per_call(
+            lambda: axis.unpack(body, RESPONSE_BODY_OFFSET, loader_type), scale),
+        "main_unpack": time_per_call(lambda: main_status.unpack(body, main_idx), scale),
+        "full_status": time_per_call(
+            lambda: state._update_status(body), scale),    # pylint: disable=protected-access
+    }
+
+def bench_decode(scale: int) -> Dict[str, object]:
+    """Status decode time for both loader types"""
+    return {
+        loader_type.name: _decode_timings(
+            parse_response(status_response(loader_type), LoaderCommand.GET_STATUS),
+            loader_type,
+            scale,
+        )
+        for loader_type in LoaderType
+    }
+
+def bench_round_trip(count: int) -> Dict[str, object]:
+    """GetStatus latency through Connection.send and LoaderConnection.command, and
+    throughput with pipelined requests"""
+    model = SimulatedLoader(time_scale=0.0, heartbeat_timeout=None)
+    with LoaderSimulator(model, port=0, status_port=0) as simulator:
+        connection = LoaderConnection(["127.0.0.1"], simulator.status_port)
+        # pylint: disable-next=protected-access
+        transport = connection._connection
+        frame = build_command(LoaderCommand.GET_STATUS, None, 1)
+
+        for _ in range(min(count // 10, 100)):
+            connection.command(LoaderCommand.GET_STATUS)
+
+        send_samples: List[int] = []
+        for _ in range(count):
+            start = perf_counter_ns()
+            transport.send(frame)
+            send_samples.append(perf_counter_ns() - start)
+
+        command_samples: List[int] = []
+        for _ in range(count):
+            start = perf_counter_ns()
+            connection.command(LoaderCommand.GET_STATUS)
+            command_samples.append(perf_counter_ns() - start)
+
+        pipelined = LoaderConnection(["127.0.0.1"], simulator.status_port, pipelined=True)
+        start_time = perf_counter()
+        futures = [pipelined.submit(LoaderCommand.GET_STATUS) for _ in range(count)]
+        for future in futures:
+            future.result()
+        pipelined_rate = count / (perf_counter() - start_time)
+        pipelined.close()
+
+    return {
+        "connection_send": percentiles(send_samples),
+        "loader_command": percentiles(command_samples),
+        "pipelined_requests_per_s": pipelined_rate,
+    }
+
+def _poll(connection: LoaderConnection):
+    try:
+        connection.command(LoaderCommand.GET_STATUS)
+    except DeviceException:
+        # Cancelled to make way for STOP
+        pass
+
+def bench_stop(count: int) -> Dict[str, object]:
+    """Time from a STOP request until it reaches the device while a status poll waits
+    for a slow response, on a pipelined connection and on one whose poll is cancelled"""
+    model = SimulatedLoader(time_scale=0.0, heartbeat_timeout=None)
+    model.status_delay = STOP_POLL_DELAY
+    results: Dict[str, object] = {"budget_us": STOP_BUDGET_US}
+    within_budget = True
+
+    with LoaderSimulator(model, port=0, status_port=0) as simulator:
+        for name, pipelined in (("pipelined", True), ("cancel_poll", False)):
+            connection = LoaderConnection(
+                ["127.0.0.1"], simulator.status_port, pipelined=pipelined)
+            connection.command(LoaderCommand.GET_VERSION)
+
+            wire_samples: List[int] = []
+            response_samples: List[int] = []
+            for _ in range(count):
+                sent = perf_counter()
+                poll = Thread(target=_poll, args=(connection,))
+                poll.start()
+                while model.received.get(LoaderCommand.GET_STATUS, 0.0) < sent:
+                    sleep(0.0005)
+
+                start = perf_counter()
+                connection.priority_command(LoaderCommand.STOP)
+                response_samples.append(int((perf_counter() - start) * 1e9))
+                wire_samples.append(int((model.received[LoaderCommand.STOP] - start) * 1e9))
+                poll.join()
+            connection.close()
+
+            wire = percentiles(wire_samples)
+            within_budget = within_budget and wire["p99_us"] <= STOP_BUDGET_US
+            results[name] = {"stop_to_wire": wire, "stop_response": percentiles(response_samples)}
+
+    results["within_budget"] = within_budget
+    return results
+
+def main():
+    """Run all benchmarks and write the JSON report"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", help="file for the JSON report, default is stdout")
+    parser.add_argument("--scale", type=int, default=20000,
+                        help="calls per timing batch for the micro benchmarks")
+    parser.add_argument("--round-trips", type=int, default=2000)
+    parser.add_argument("--stops", type=int, default=50)
+    parser.add_argument("--check", action="store_true",
+                        help="exit with status 1 if a latency budget is exceeded")
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version,
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+        },
+        "crc": bench_crc(args.scale),
+        "framing": bench_framing(args.scale),
+        "decode": bench_decode(args.scale),
+        "round_trip": bench_round_trip(args.round_trips),
+        "stop": bench_stop(args.stops),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text)
+    else:
+        print(text)
+
+    if args.check and not report["stop"]["within_budget"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
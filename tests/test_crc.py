@@ -0,0 +1,34 @@
+"""The checksum implementations agree with each other and with the reference tables"""
+import random
+
+import pytest
+
+from newpro_autoloader.crc import calculate_crc, crc16, crc16_batch, crc16_table, np
+
+def _messages():
+    rng = random.Random(1)
+    return [bytes(rng.randrange(256) for _ in range(length))
+            for length in (0, 1, 2, 3, 17, 160, 1023)]
+
+def test_check_value():
+    """The checksum is CRC-16/KERMIT"""
+    assert crc16(b"123456789") == 0x2189
+    assert calculate_crc(bytearray(b"123456789")) == bytearray([0x89, 0x21])
+
+@pytest.mark.parametrize("message", _messages())
+def test_crc16_matches_table(message):
+    """The fast checksum gives the result of the lookup table"""
+    assert crc16(message) == crc16_table(message)
+    assert crc16(memoryview(message)) == crc16_table(message)
+
+@pytest.mark.parametrize("message", _messages())
+def test_crc16_continues_from_state(message):
+    """A checksum can be continued over data that follows"""
+    half = len(message) // 2
+    assert crc16(message[half:], crc16(message[:half])) == crc16(message)
+
+@pytest.mark.skipif(np is None, reason="NumPy is not installed")
+def test_crc16_batch_matches_crc16():
+    """Batch checksums of messages of mixed lengths match one at a time"""
+    messages = _messages()
+    assert list(crc16_batch(messages)) == [crc16(message) for message in messages]
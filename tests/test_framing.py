@@ -0,0 +1,80 @@
+"""Frames are built, split from the received stream and validated"""
+from socket import socketpair
+
+import pytest
+
+from newpro_autoloader.device_error import DeviceError, DeviceException
+from newpro_autoloader.loader_connection import (
+    END_SYMBOL1,
+    END_SYMBOL2,
+    CommandEncoder,
+    LoaderCommand,
+    LoaderFrameParser,
+    build_command,
+    build_frame,
+    parse_response,
+    response_message_id,
+)
+
+def _response(message_id: int, payload: bytes = b"") -> bytearray:
+    body = bytearray([LoaderCommand.GET_STATUS, DeviceError.NO_ERROR]) + payload
+    return build_frame(0, 1, message_id, body)
+
+def _split(chunks):
+    """Frames the parser returns for chunks arriving one receive at a time"""
+    parser = LoaderFrameParser()
+    receive, send = socketpair()
+    frames = []
+    with receive, send:
+        for chunk in chunks:
+            send.sendall(chunk)
+            parser.recv_into(receive)
+            frame = parser.next_frame()
+            while frame is not None:
+                frames.append(frame)
+                frame = parser.next_frame()
+    return frames
+
+def test_encoder_matches_build_command():
+    """The cached encoder produces the frames of build_command"""
+    encoder = CommandEncoder()
+    for message_id in (1, 2, 255):
+        assert encoder.encode(LoaderCommand.GET_STATUS, None, message_id) == \
+            build_command(LoaderCommand.GET_STATUS, None, message_id)
+        assert encoder.encode(LoaderCommand.LOAD, bytearray([3]), message_id) == \
+            build_command(LoaderCommand.LOAD, bytearray([3]), message_id)
+
+def test_parse_response():
+    """A response gives its message ID and body"""
+    frame = _response(7, b"\x01\x02")
+    assert response_message_id(frame) == 7
+    assert parse_response(frame, LoaderCommand.GET_STATUS) == bytearray(
+        [LoaderCommand.GET_STATUS, DeviceError.NO_ERROR, 1, 2])
+
+def test_parse_response_rejects_bad_checksum():
+    """A corrupted frame fails with INVALID_CRC"""
+    frame = _response(7, b"\x01\x02")
+    frame[-5] ^= 0xFF
+    with pytest.raises(DeviceException) as error:
+        parse_response(frame, LoaderCommand.GET_STATUS)
+    assert error.value.error_code == DeviceError.INVALID_CRC
+
+def test_frames_split_across_receives():
+    """A frame arriving a byte at a time is returned once complete"""
+    frame = _response(1, b"status")
+    assert _split([frame[i:i + 1] for i in range(len(frame))]) == [frame]
+
+def test_frames_arriving_together():
+    """Frames that arrive in one receive are all returned in order"""
+    frames = [_response(message_id, b"x" * message_id) for message_id in (1, 2, 3)]
+    assert _split([b"".join(frames)]) == frames
+
+def test_terminator_inside_body():
+    """End symbols inside the body do not end the frame early"""
+    frame = _response(1, bytes([END_SYMBOL1, END_SYMBOL2]) * 3)
+    assert _split([frame[:10], frame[10:]]) == [frame]
+
+def test_resynchronizes_after_garbage():
+    """Bytes that cannot start a frame are skipped"""
+    frame = _response(1, b"status")
+    assert _split([b"\x00\xff\x01\x00" + frame[:5], frame[5:]]) == [frame]
@@ -0,0 +1,42 @@
+"""Poll intervals stay within the device heartbeat"""
+import pytest
+
+from newpro_autoloader.axis_status import AxisStatus, MainStatus
+from newpro_autoloader.poll_scheduler import MAX_POLL_INTERVAL, PollScheduler
+
+@pytest.mark.parametrize("interval, idle_interval", [
+    (0.0, 1.0),
+    (-1.0, 1.0),
+    (1.0, 0.5),
+    (0.25, MAX_POLL_INTERVAL * 2),
+])
+def test_rejects_intervals(interval, idle_interval):
+    """Intervals that are not positive, out of order or past the heartbeat are refused"""
+    with pytest.raises(ValueError):
+        PollScheduler(interval, idle_interval)
+
+def test_idle_interval_when_idle():
+    """Without motion or actions, polls use the idle interval"""
+    scheduler = PollScheduler(0.25, 2.0, idle_after=0.0)
+    assert scheduler.current_interval == 2.0
+    scheduler.begin_action()
+    assert scheduler.current_interval == 0.25
+    scheduler.end_action()
+    assert scheduler.current_interval == 2.0
+
+def test_backoff_is_capped():
+    """Failed polls back off, but never past MAX_POLL_INTERVAL"""
+    scheduler = PollScheduler(0.25, 2.0, idle_after=0.0)
+    intervals = []
+    for _ in range(10):
+        scheduler.poll_failed()
+        intervals.append(scheduler.current_interval)
+    assert intervals == sorted(intervals)
+    assert max(intervals) == MAX_POLL_INTERVAL
+
+def test_status_ends_backoff():
+    """A status after failed polls returns to the normal interval"""
+    scheduler = PollScheduler(0.25, 2.0, idle_after=0.0)
+    scheduler.poll_failed()
+    scheduler.observe(AxisStatus(), AxisStatus(), MainStatus())
+    assert scheduler.current_interval == 2.0
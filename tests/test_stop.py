@@ -0,0 +1,42 @@
+"""STOP reaches a simulated device ahead of a slow status poll"""
+from time import perf_counter, sleep
+
+import pytest
+
+from newpro_autoloader.loader import Loader
+from newpro_autoloader.loader_connection import LoaderCommand
+from newpro_autoloader.simulator import LoaderSimulator, SimulatedLoader
+
+# Seconds the simulator holds each status response
+STATUS_DELAY: float = 0.5
+# Longest allowed time from stop until STOP arrives, well below STATUS_DELAY
+STOP_BUDGET: float = 0.05
+
+@pytest.fixture(name="simulator")
+def simulator_fixture():
+    """A simulated device on free ports"""
+    with LoaderSimulator(SimulatedLoader(time_scale=0.01), port=0, status_port=0) as simulator:
+        yield simulator
+
+def _wait_for_poll(model: SimulatedLoader, since: float):
+    while model.received.get(LoaderCommand.GET_STATUS, 0.0) < since:
+        sleep(0.001)
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_stop_overtakes_status_poll(simulator, pipelined):
+    """stop is sent while the status poll waits for its response, and the status
+    keeps updating afterwards"""
+    model = simulator.model
+    with Loader("127.0.0.1", "127.0.0.1", simulator.port, simulator.status_port,
+                poll_interval=0.05, idle_poll_interval=0.05, pipelined=pipelined) as loader:
+        model.status_delay = STATUS_DELAY
+        for _ in range(3):
+            _wait_for_poll(model, perf_counter())
+            start = perf_counter()
+            loader.stop()
+            assert model.received[LoaderCommand.STOP] - start < STOP_BUDGET
+
+        model.status_delay = 0.0
+        before = loader.snapshot().timestamp
+        sleep(STATUS_DELAY + 0.5)
+        assert loader.snapshot().timestamp > before